@@ -1,13 +1,32 @@
+import argparse
+import concurrent.futures
+import os
+import sys
 import cv2
 from PIL import Image
 import numpy as np
 import torch
-from transformers import AutoImageProcessor, SiglipForImageClassification
 import torch.nn.functional as F
 import mediapipe as mp
-from collections import defaultdict, deque
+from collections import deque
+from contextlib import contextmanager
+import json
 import time
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "../worker"))
+
+from siglip_runtime import SiglipOptions, SiglipRunner
+
+# Output classes of the SigLIP model
+EMOTION_LABELS = {
+    0: "Ahegao",
+    1: "Angry",
+    2: "Happy",
+    3: "Neutral",
+    4: "Sad",
+    5: "Surprise",
+}
+
 
 class EmotionDetectionConfig:
     """Configuration class for emotion detection parameters"""
@@ -20,10 +39,41 @@ class EmotionDetectionConfig:
         self.base_skip_frames = 1
         self.max_skip_frames = 10
         self.smoothing_window = 5
+        self.smoothing_ema_alpha = None  # e.g. 0.4 to use an EMA
         self.face_tracking_threshold = 0.3
         self.performance_check_interval = 10  # frames
         self.target_fps = 10
 
+        # Per-track re-classification scheduling
+        self.change_signal_size = 16  # side of the downsampled grayscale crop
+        self.change_threshold = 0.04  # mean abs difference (0-1) to re-classify
+        self.max_classification_age = 30  # frames; re-classify even if stable
+
+        # Face detection cadence; boxes are propagated with optical flow in between
+        self.detection_interval = 5  # run MediaPipe every N frames (1 = every frame)
+        self.detection_scale = 0.5  # downscale factor for detection and tracking
+        self.min_tracking_confidence = 0.5  # flow points kept, else re-detect
+
+        # Closed-loop quality/performance control
+        self.face_model_selection = 0  # MediaPipe: 0 short range, 1 full range
+        self.max_faces_per_frame = None  # classifications per frame cap
+        self.detection_scale_steps = (1.0, 0.75, 0.5, 0.35, 0.25)
+        self.profile_window = 120  # frames kept by the stage profiler
+        self.profile_report_path = None  # JSON report written on exit and on 'p'
+
+        # SigLIP CPU inference mode (see worker/siglip_runtime.py); defaults are the FP32 model
+        self.siglip_precision = "fp32"  # "bf16" or "int8" (dynamic quantisation)
+        self.siglip_attention = "sdpa"  # or "eager"
+        self.siglip_backend = "torch"  # "compile" or "onnx" (ONNX Runtime)
+        self.siglip_image_size = None  # e.g. 160 instead of the native 224
+        self.siglip_threads = None  # torch/ONNX Runtime threads, None = default
+
+        # Multi-stream mode (multi_stream.py): one classifier batches the crops of every stream
+        self.max_batch_size = 16  # crops per forward pass
+        self.max_batch_wait_ms = 20  # longest a crop waits for the batch to fill
+        self.latency_budget_ms = 250  # per stream; older crops are dropped, not classified
+        self.max_queued_per_stream = 8  # oldest crops of a stream are dropped beyond this
+
         # Filter out inappropriate emotions
         self.emotion_filter = {"Ahegao"}  # Emotions to exclude
 
@@ -115,59 +165,241 @@ class FaceTracker:
 
 
 class EmotionSmoother:
-    """Smooth emotion predictions over time"""
+    """Smooth class-probability vectors over time
 
-    def __init__(self, window_size=5):
-        self.window_size = window_size
-        self.emotion_history = defaultdict(lambda: deque(maxlen=window_size))
+    Each track owns a fixed ``(window_size, n_classes)`` ring buffer and a
+    running sum, so adding a prediction costs O(classes) and reading the
+    smoothed emotion is a cached lookup. With ``ema_alpha`` set, an
+    exponential moving average is kept instead of the window mean.
+    """
 
-    def add_prediction(self, track_id, emotion, confidence):
-        """Add new prediction for a tracked face"""
-        self.emotion_history[track_id].append((emotion, confidence))
+    def __init__(self, labels, window_size=5, ema_alpha=None):
+        self.labels = list(labels)
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        self.window_size = window_size
+        self.ema_alpha = ema_alpha
+        self.track_state = {}
+
+    def _new_state(self):
+        n_classes = len(self.labels)
+        return {
+            "buffer": np.zeros((self.window_size, n_classes), dtype=np.float32),
+            "sum": np.zeros(n_classes, dtype=np.float64),
+            "smoothed": np.zeros(n_classes, dtype=np.float64),
+            "position": 0,
+            "count": 0,
+            "best": ("Unknown", 0.0),
+        }
+
+    def add_prediction(self, track_id, probabilities):
+        """Add a class-probability vector (or label -> probability mapping)"""
+        state = self.track_state.get(track_id)
+        if state is None:
+            state = self.track_state[track_id] = self._new_state()
+
+        if isinstance(probabilities, dict):
+            vector = np.zeros(len(self.labels), dtype=np.float32)
+            for label, prob in probabilities.items():
+                if label in self.label_index:
+                    vector[self.label_index[label]] = prob
+        else:
+            vector = np.asarray(probabilities, dtype=np.float32)
+
+        smoothed = state["smoothed"]
+        if self.ema_alpha:
+            if state["count"] == 0:
+                smoothed[:] = vector
+            else:
+                smoothed *= 1.0 - self.ema_alpha
+                smoothed += self.ema_alpha * vector
+            state["count"] = min(state["count"] + 1, self.window_size)
+        else:
+            # Replace the oldest slot and keep the running sum in step
+            position = state["position"]
+            state["sum"] -= state["buffer"][position]
+            state["buffer"][position] = vector
+            state["sum"] += vector
+            state["position"] = (position + 1) % self.window_size
+            state["count"] = min(state["count"] + 1, self.window_size)
+            np.divide(state["sum"], state["count"], out=smoothed)
+
+        total = smoothed.sum()
+        if total <= 0:
+            state["best"] = ("Unknown", 0.0)
+        else:
+            best = int(smoothed.argmax())
+            state["best"] = (self.labels[best], float(smoothed[best] / total))
 
     def get_smoothed_emotion(self, track_id):
         """Get smoothed emotion for a tracked face"""
-        if (
-            track_id not in self.emotion_history
-            or len(self.emotion_history[track_id]) == 0
-        ):
+        state = self.track_state.get(track_id)
+        if state is None:
             return "Unknown", 0.0
+        return state["best"]
 
-        history = list(self.emotion_history[track_id])
+    def get_smoothed_distribution(self, track_id):
+        """Get the smoothed probability vector for a tracked face"""
+        state = self.track_state.get(track_id)
+        return state["smoothed"] if state else None
 
-        # Weight recent predictions more heavily
-        weights = np.linspace(0.5, 1.0, len(history))
-        emotion_scores = defaultdict(float)
-        total_weight = 0
+    def cleanup_old_tracks(self, active_track_ids):
+        """Remove emotion history for tracks that no longer exist"""
+        to_remove = [
+            track_id
+            for track_id in self.track_state.keys()
+            if track_id not in active_track_ids
+        ]
+        for track_id in to_remove:
+            del self.track_state[track_id]
+
+
+class FaceBoxPropagator:
+    """Propagate face boxes between detections with sparse optical flow"""
+
+    def __init__(self, max_points=20, min_points=4, max_fb_error=1.0):
+        self.max_points = max_points
+        self.min_points = min_points
+        self.max_fb_error = max_fb_error
+        self.prev_gray = None
+        self.scale = 1.0
+        self.tracks = []  # list of (bbox in full resolution, points in scaled frame)
+
+    def reset(self, gray, boxes, scale):
+        """Seed flow points inside freshly detected boxes"""
+        self.prev_gray = gray
+        self.scale = scale
+        self.tracks = []
+        for box in boxes:
+            x, y, w, h = (int(round(v * scale)) for v in box)
+            mask = np.zeros_like(gray)
+            mask[max(0, y) : max(0, y + h), max(0, x) : max(0, x + w)] = 255
+            points = cv2.goodFeaturesToTrack(
+                gray, self.max_points, qualityLevel=0.01, minDistance=3, mask=mask
+            )
+            self.tracks.append((box, points))
+
+    def propagate(self, gray):
+        """Move every box by the median flow of its points
+
+        Returns the propagated boxes (full resolution) and the fraction of
+        points of each box that survived the forward-backward check.
+        """
+        boxes, confidences, tracks = [], [], []
+        for box, points in self.tracks:
+            if points is None or len(points) < self.min_points:
+                boxes.append(box)
+                confidences.append(0.0)
+                tracks.append((box, points))
+                continue
+
+            next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.prev_gray, gray, points, None
+            )
+            back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+                gray, self.prev_gray, next_points, None
+            )
+            fb_error = np.linalg.norm(points - back_points, axis=2).ravel()
+            good = (
+                (status.ravel() == 1)
+                & (back_status.ravel() == 1)
+                & (fb_error < self.max_fb_error)
+            )
+            confidence = float(good.sum()) / len(points)
+
+            if good.sum() < self.min_points:
+                boxes.append(box)
+                confidences.append(0.0)
+                tracks.append((box, None))
+                continue
+
+            old = points[good].reshape(-1, 2)
+            new = next_points[good].reshape(-1, 2)
+            dx, dy = np.median(new - old, axis=0) / self.scale
+
+            # Scale change from the spread of points around their centroid
+            old_spread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+            new_spread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+            valid = old_spread > 1e-3
+            zoom = 1.0
+            if valid.any():
+                zoom = float(np.median(new_spread[valid] / old_spread[valid]))
+
+            x, y, w, h = box
+            new_w, new_h = w * zoom, h * zoom
+            cx, cy = x + w / 2 + dx, y + h / 2 + dy
+            new_box = (
+                int(round(cx - new_w / 2)),
+                int(round(cy - new_h / 2)),
+                int(round(new_w)),
+                int(round(new_h)),
+            )
 
-        for i, (emotion, confidence) in enumerate(history):
-            weight = weights[i] * confidence
-            emotion_scores[emotion] += weight
-            total_weight += weight
+            boxes.append(new_box)
+            confidences.append(confidence)
+            tracks.append((new_box, next_points[good].reshape(-1, 1, 2)))
 
-        if total_weight == 0:
-            return "Unknown", 0.0
+        self.prev_gray = gray
+        self.tracks = tracks
+        return boxes, confidences
+
+
+class ClassificationScheduler:
+    """Decide per track when a face crop needs to be re-classified"""
+
+    def __init__(
+        self, signal_size=16, change_threshold=0.04, max_age=30, min_interval=1
+    ):
+        self.signal_size = signal_size
+        self.change_threshold = change_threshold
+        self.max_age = max_age
+        self.min_interval = min_interval
+        self.track_state = {}
+
+    def compute_signature(self, crop):
+        """Downsample a face crop to a small grayscale signature in [0, 1]"""
+        gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(
+            gray, (self.signal_size, self.signal_size), interpolation=cv2.INTER_AREA
+        )
+        return small.astype(np.float32) * (1.0 / 255.0)
+
+    def should_classify(self, track_id, signature, frame_count):
+        """Return True if the track has no result, has changed or is too old"""
+        state = self.track_state.get(track_id)
+        if state is None:
+            return True
+
+        age = frame_count - state["frame"]
+        if age < self.min_interval:
+            return False
+        if age >= self.max_age:
+            return True
 
-        # Normalize scores
-        for emotion in emotion_scores:
-            emotion_scores[emotion] /= total_weight
+        change = float(np.mean(np.abs(signature - state["signature"])))
+        return change > self.change_threshold
 
-        best_emotion = max(emotion_scores, key=emotion_scores.get)  # type: ignore
-        return best_emotion, emotion_scores[best_emotion]
+    def get_age(self, track_id, frame_count):
+        """Frames since the track was last classified, or None if never"""
+        state = self.track_state.get(track_id)
+        return frame_count - state["frame"] if state else None
+
+    def update(self, track_id, signature, frame_count):
+        """Store the signature and frame of a fresh classification"""
+        self.track_state[track_id] = {"signature": signature, "frame": frame_count}
 
     def cleanup_old_tracks(self, active_track_ids):
-        """Remove emotion history for tracks that no longer exist"""
+        """Forget tracks that no longer exist"""
         to_remove = [
             track_id
-            for track_id in self.emotion_history.keys()
+            for track_id in self.track_state.keys()
             if track_id not in active_track_ids
         ]
         for track_id in to_remove:
-            del self.emotion_history[track_id]
+            del self.track_state[track_id]
 
 
 class PerformanceMonitor:
-    """Monitor and adapt performance based on FPS"""
+    """Monitor FPS over a rolling window of frame times"""
 
     def __init__(self, target_fps=15, check_interval=30):
         self.target_fps = target_fps
@@ -194,89 +426,314 @@ class PerformanceMonitor:
         avg_frame_time = sum(self.frame_times) / len(self.frame_times)
         return 1.0 / max(avg_frame_time, 0.001)
 
-    def get_recommended_skip_frames(self, base_skip, max_skip):
-        """Get recommended frame skip based on performance"""
-        current_fps = self.get_current_fps()
-        if current_fps < self.target_fps * 0.8:  # If FPS is too low
-            return min(max_skip, base_skip + 2)
-        elif current_fps > self.target_fps * 1.2:  # If FPS is too high
-            return max(1, base_skip - 1)
-        return base_skip
+
+class StageProfiler:
+    """Time each pipeline stage per frame over a rolling window"""
+
+    STAGES = (
+        "capture",
+        "detection",
+        "tracking",
+        "crop",
+        "preprocess",
+        "inference",
+        "draw",
+    )
+
+    def __init__(self, window=120):
+        self.window = window
+        self.history = {stage: deque(maxlen=window) for stage in self.STAGES}
+        self.frame_totals = deque(maxlen=window)
+        self.current = dict.fromkeys(self.STAGES, 0.0)
+
+    @contextmanager
+    def stage(self, name):
+        """Accumulate the time spent in ``name`` for the current frame"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] = self.current.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def end_frame(self, frame_time):
+        """Close the current frame and start a new one"""
+        for name, elapsed in self.current.items():
+            self.history.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+            self.current[name] = 0.0
+        self.frame_totals.append(frame_time)
+
+    def report(self):
+        """Per-stage mean/p95 milliseconds per frame and share of frame time"""
+        frame_mean = float(np.mean(self.frame_totals)) if self.frame_totals else 0.0
+        stages = {}
+        for name, samples in self.history.items():
+            if not samples:
+                continue
+            values = np.asarray(samples) * 1000.0
+            mean_ms = float(values.mean())
+            stages[name] = {
+                "mean_ms": round(mean_ms, 3),
+                "p95_ms": round(float(np.percentile(values, 95)), 3),
+                "share": (
+                    round(mean_ms / (frame_mean * 1000.0), 3) if frame_mean > 0 else 0.0
+                ),
+            }
+        return {
+            "frames": len(self.frame_totals),
+            "frame_mean_ms": round(frame_mean * 1000.0, 3),
+            "fps": round(1.0 / frame_mean, 2) if frame_mean > 0 else 0.0,
+            "stages": stages,
+        }
+
+    def export(self, path):
+        """Write the rolling report to ``path`` as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class QualityController:
+    """Adjust quality controls to hold a target FPS
+
+    Controls are degraded one step at a time when FPS is below target and
+    restored when there is headroom. The stage group that dominates the
+    profile decides which control moves first.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.target_fps = config.target_fps
+        self.scale_steps = sorted(config.detection_scale_steps, reverse=True)
+        self.default_model_selection = config.face_model_selection
+        self.controls = {
+            "skip_interval": config.base_skip_frames,
+            "detection_scale": config.detection_scale,
+            "model_selection": config.face_model_selection,
+            "max_faces": config.max_faces_per_frame,
+        }
+
+    def _next_scale(self, scale, direction):
+        smaller = [s for s in self.scale_steps if s < scale]
+        larger = [s for s in self.scale_steps if s > scale]
+        if direction < 0:
+            return smaller[0] if smaller else scale
+        # Never restore beyond the configured resolution
+        larger = [s for s in larger if s <= self.config.detection_scale]
+        return larger[-1] if larger else scale
+
+    def _degrade(self, group, face_count):
+        controls = dict(self.controls)
+        if group == "classification":
+            if controls["skip_interval"] < self.config.max_skip_frames:
+                controls["skip_interval"] += 1
+            elif face_count > 1 and (
+                controls["max_faces"] is None or controls["max_faces"] > 1
+            ):
+                current = controls["max_faces"] or face_count
+                controls["max_faces"] = max(1, current - 1)
+        else:
+            scale = self._next_scale(controls["detection_scale"], -1)
+            if scale != controls["detection_scale"]:
+                controls["detection_scale"] = scale
+            elif controls["model_selection"] != 0:
+                controls["model_selection"] = 0
+        return controls
+
+    def _restore(self, group, face_count):
+        controls = dict(self.controls)
+        limit = self.config.max_faces_per_frame
+        if group == "classification":
+            if controls["max_faces"] is not None and controls["max_faces"] != limit:
+                max_faces = controls["max_faces"] + 1
+                if limit is None and max_faces > face_count:
+                    max_faces = None
+                elif limit is not None:
+                    max_faces = min(max_faces, limit)
+                controls["max_faces"] = max_faces
+            elif controls["skip_interval"] > self.config.base_skip_frames:
+                controls["skip_interval"] -= 1
+        else:
+            if controls["model_selection"] != self.default_model_selection:
+                controls["model_selection"] = self.default_model_selection
+            else:
+                controls["detection_scale"] = self._next_scale(
+                    controls["detection_scale"], 1
+                )
+        return controls
+
+    def update(self, fps, report, face_count):
+        """Return the controls that changed as ``{name: (old, new)}``"""
+        stages = report["stages"]
+
+        def cost(names):
+            return sum(stages.get(name, {}).get("mean_ms", 0.0) for name in names)
+
+        classification_cost = cost(("crop", "preprocess", "inference"))
+        detection_cost = cost(("detection", "tracking"))
+        heavy, light = (
+            ("classification", "detection")
+            if classification_cost >= detection_cost
+            else ("detection", "classification")
+        )
+
+        if fps < self.target_fps * 0.8:
+            controls = self._degrade(heavy, face_count)
+            if controls == self.controls:
+                controls = self._degrade(light, face_count)
+        elif fps > self.target_fps * 1.2:
+            # Give quality back to the cheaper group first
+            controls = self._restore(light, face_count)
+            if controls == self.controls:
+                controls = self._restore(heavy, face_count)
+        else:
+            return {}
+
+        changes = {
+            name: (self.controls[name], value)
+            for name, value in controls.items()
+            if value != self.controls[name]
+        }
+        self.controls = controls
+        return changes
+
+
+def build_runner(config, device):
+    """Load the SigLIP runner for the config's inference mode"""
+    options = SiglipOptions(
+        precision=config.siglip_precision,
+        attention=config.siglip_attention,
+        backend=config.siglip_backend,
+        image_size=config.siglip_image_size,
+        threads=config.siglip_threads,
+    )
+    runner = SiglipRunner(config.model_name, options, device)
+    runner.load()
+    return runner
 
 
 class ImprovedEmotionDetector:
-    """Main emotion detection class with all improvements"""
+    """Main emotion detection class with all improvements
+
+    With ``classifier`` (a ``multi_stream.BatchedClassifier``) the detector
+    holds only the per-stream state and sends its crops, tagged with
+    ``stream_id``, to the shared model instead of loading its own.
+    """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, classifier=None, stream_id=0):
         self.config = config or EmotionDetectionConfig()
+        self.classifier = classifier
+        self.stream_id = stream_id
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"Using device: {self.device}")
+        if classifier is None:
+            print(f"Using device: {self.device}")
 
         # Initialize components
         self.face_tracker = FaceTracker(self.config.face_tracking_threshold)
-        self.emotion_smoother = EmotionSmoother(self.config.smoothing_window)
         self.performance_monitor = PerformanceMonitor(
             self.config.target_fps, self.config.performance_check_interval
         )
+        self.scheduler = ClassificationScheduler(
+            self.config.change_signal_size,
+            self.config.change_threshold,
+            self.config.max_classification_age,
+            self.config.base_skip_frames,
+        )
+
+        self.profiler = StageProfiler(self.config.profile_window)
+        self.controller = QualityController(self.config)
 
         # Initialize MediaPipe
-        mp_face_detection = mp.solutions.face_detection  # type: ignore
-        self.face_detection = mp_face_detection.FaceDetection(
-            model_selection=0,
-            min_detection_confidence=self.config.min_detection_confidence,
+        self.face_detection = None
+        self.set_model_selection(self.config.face_model_selection)
+
+        # Load model, unless it is shared with other streams
+        if classifier is None:
+            self._load_model()
+        else:
+            self.runner = classifier.runner
+            self.labels = self._filter_labels()
+        self.emotion_smoother = EmotionSmoother(
+            self.labels.values(),
+            self.config.smoothing_window,
+            self.config.smoothing_ema_alpha,
         )
 
-        # Load model
-        self._load_model()
-
         # Dynamic parameters
-        self.current_skip_frames = self.config.base_skip_frames
+        self.detection_scale = self.config.detection_scale
+        self.max_faces_per_frame = self.config.max_faces_per_frame
         self.frame_count = 0
+        self.classified_last_frame = 0
+        self.box_propagator = FaceBoxPropagator()
+        self.frames_since_detection = self.config.detection_interval
+        # Shared classifier only: track_id -> (future, signature, frame submitted)
+        self.pending = {}
+
+    def _filter_labels(self):
+        """Emotion labels without the filtered-out ones"""
+        return {
+            k: v
+            for k, v in EMOTION_LABELS.items()
+            if v not in self.config.emotion_filter
+        }
 
     def _load_model(self):
         """Load the emotion classification model"""
         try:
-            self.model = SiglipForImageClassification.from_pretrained(
-                self.config.model_name
-            ).to(self.device)  # type: ignore
-            self.processor = AutoImageProcessor.from_pretrained(
-                self.config.model_name, use_fast=True
-            )
-            self.model.eval()
-
-            # Define emotion labels (filtered)
-            all_labels = {
-                0: "Ahegao",
-                1: "Angry",
-                2: "Happy",
-                3: "Neutral",
-                4: "Sad",
-                5: "Surprise",
-            }
+            self.runner = build_runner(self.config, self.device)
+            self.model = self.runner.model
+            self.processor = self.runner.processor
 
             # Filter out inappropriate emotions
-            self.labels = {
-                k: v
-                for k, v in all_labels.items()
-                if v not in self.config.emotion_filter
-            }
+            self.labels = self._filter_labels()
 
-            print("Model loaded successfully")
+            print(f"Model loaded successfully ({self.runner.options.describe()})")
             print(f"Available emotions: {list(self.labels.values())}")
         except Exception as e:
             print(f"Error loading model: {e}")
             exit()
 
-    def detect_faces_mediapipe(self, frame):
-        """Detect faces using MediaPipe and return bounding boxes"""
+    def set_model_selection(self, model_selection):
+        """(Re)create the MediaPipe face detector with the given model"""
+        if self.face_detection is not None:
+            self.face_detection.close()
+        mp_face_detection = mp.solutions.face_detection  # type: ignore
+        self.face_detection = mp_face_detection.FaceDetection(
+            model_selection=model_selection,
+            min_detection_confidence=self.config.min_detection_confidence,
+        )
+        self.model_selection = model_selection
+
+    def apply_controls(self, changes):
+        """Apply control changes from the quality controller"""
+        for name, (old, new) in changes.items():
+            if name == "skip_interval":
+                self.scheduler.min_interval = new
+            elif name == "detection_scale":
+                self.detection_scale = new
+                # Propagated boxes were seeded at the old scale
+                self.frames_since_detection = self.config.detection_interval
+            elif name == "model_selection":
+                self.set_model_selection(new)
+                self.frames_since_detection = self.config.detection_interval
+            elif name == "max_faces":
+                self.max_faces_per_frame = new
+            print(f"Controller: {name} {old} -> {new}")
+
+    def detect_faces_mediapipe(self, frame, output_shape=None):
+        """Detect faces using MediaPipe and return bounding boxes
+
+        ``frame`` may be a downscaled copy; boxes are mapped to
+        ``output_shape`` (defaults to the frame's own shape).
+        """
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         results = self.face_detection.process(rgb_frame)
 
         faces = []
         if results.detections:
+            h, w = (output_shape or frame.shape)[:2]
             for detection in results.detections:
                 bbox = detection.location_data.relative_bounding_box
-                h, w, _ = frame.shape
 
                 # Convert relative coordinates to absolute coordinates
                 x = int(bbox.xmin * w)
@@ -293,6 +750,36 @@ class ImprovedEmotionDetector:
 
         return faces
 
+    def locate_faces(self, frame):
+        """Detect faces every ``detection_interval`` frames, propagate in between
+
+        Detection and optical flow run on a frame downscaled by
+        the current detection scale; returned boxes are in full-resolution
+        coordinates.
+        """
+        scale = self.detection_scale
+        if scale < 1.0:
+            small = cv2.resize(
+                frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+        else:
+            small = frame
+
+        if self.config.detection_interval > 1:
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            if self.frames_since_detection < self.config.detection_interval:
+                boxes, confidences = self.box_propagator.propagate(gray)
+                if all(c >= self.config.min_tracking_confidence for c in confidences):
+                    self.frames_since_detection += 1
+                    return boxes
+                # Tracking degraded: fall through and re-detect on this frame
+
+        faces = self.detect_faces_mediapipe(small, frame.shape)
+        self.frames_since_detection = 1
+        if self.config.detection_interval > 1:
+            self.box_propagator.reset(gray, faces, scale)
+        return faces
+
     def crop_face(self, frame, face_coords):
         """Crop face from frame with proportional padding"""
         x, y, w, h = face_coords
@@ -310,18 +797,33 @@ class ImprovedEmotionDetector:
         cropped_face = frame[y_start:y_end, x_start:x_end]
         return cropped_face
 
+    def predictions_from_probs(self, probs):
+        """(label, score, predictions) over the filtered emotions of a probability vector"""
+        # Only include filtered emotions
+        predictions = {}
+        for i, prob in enumerate(probs):
+            if i in self.labels:
+                predictions[self.labels[i]] = round(float(prob), 3)
+
+        if not predictions:
+            return "Unknown", 0.0, {}
+
+        top_label = max(predictions, key=predictions.get)  # type: ignore
+        top_score = predictions[top_label]
+        return top_label, top_score, predictions
+
     def emotion_classification(self, image: np.ndarray):
         """Classify emotion from cropped face image"""
         try:
             if image.size == 0:
                 return "No Face", 0.0, {}
 
-            pil_img = Image.fromarray(image).convert("RGB")
-            inputs = self.processor(images=pil_img, return_tensors="pt").to(self.device)
+            with self.profiler.stage("preprocess"):
+                pil_img = Image.fromarray(image).convert("RGB")
+                pixel_values = self.runner.preprocess([pil_img])
 
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits = outputs.logits
+            with self.profiler.stage("inference"):
+                logits = self.runner.logits(pixel_values)
                 probs = F.softmax(logits, dim=1).squeeze()
 
                 if probs.dim() == 0:
@@ -329,23 +831,237 @@ class ImprovedEmotionDetector:
 
                 probs = probs.cpu().tolist()
 
-            # Only include filtered emotions
-            predictions = {}
-            for i, prob in enumerate(probs):
-                if i in self.labels:
-                    predictions[self.labels[i]] = round(prob, 3)
-
-            if not predictions:
-                return "Unknown", 0.0, {}
-
-            top_label = max(predictions, key=predictions.get)  # type: ignore
-            top_score = predictions[top_label]
-            return top_label, top_score, predictions
+            return self.predictions_from_probs(probs)
 
         except Exception as e:
             print(f"Error in emotion classification: {e}")
             return "Error", 0.0, {}
 
+    def _store_result(self, track_id, signature, frame_count, result):
+        """Record a classification with the scheduler and feed the smoother"""
+        label, _, predictions = result
+        if label not in ["No Face", "Error", "Unknown"]:
+            self.scheduler.update(track_id, signature, frame_count)
+            self.emotion_smoother.add_prediction(track_id, predictions)
+
+    def select_candidates(self, frame, tracked_faces):
+        """Crops of the tracks that need classifying: (age, track_id, crop, signature)
+
+        Only faces whose crop changed or whose result is too old are
+        returned; stable faces keep their cached result.
+        """
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        candidates = []
+        for track_id, face_coords in tracked_faces.items():
+            # Still waiting for the shared classifier
+            if track_id in self.pending:
+                continue
+
+            cropped_face = self.crop_face(rgb_frame, face_coords)
+            if cropped_face.size == 0:
+                continue
+
+            signature = self.scheduler.compute_signature(cropped_face)
+            if self.scheduler.should_classify(track_id, signature, self.frame_count):
+                age = self.scheduler.get_age(track_id, self.frame_count)
+                candidates.append((age, track_id, cropped_face, signature))
+
+        # Stalest faces first when the per-frame budget is capped
+        if self.max_faces_per_frame is not None:
+            candidates.sort(
+                key=lambda c: float("inf") if c[0] is None else c[0],
+                reverse=True,
+            )
+            candidates = candidates[: self.max_faces_per_frame]
+        return candidates
+
+    def classify_candidates(self, candidates):
+        """Classify the candidate crops; returns the number of results stored"""
+        if self.classifier is None:
+            for _, track_id, cropped_face, signature in candidates:
+                self._store_result(
+                    track_id,
+                    signature,
+                    self.frame_count,
+                    self.emotion_classification(cropped_face),
+                )
+            return len(candidates)
+
+        futures = []
+        if candidates:
+            with self.profiler.stage("preprocess"):
+                pixel_values = self.runner.preprocess(
+                    [Image.fromarray(c[2]).convert("RGB") for c in candidates]
+                )
+            futures = self.classifier.submit(self.stream_id, pixel_values)
+            for (_, track_id, _, signature), future in zip(candidates, futures):
+                self.pending[track_id] = (future, signature, self.frame_count)
+
+        # Wait for this frame's crops up to the stream's latency budget; results
+        # that arrive later are picked up on a following frame
+        with self.profiler.stage("inference"):
+            if futures:
+                concurrent.futures.wait(
+                    futures, timeout=self.classifier.budget(self.stream_id)
+                )
+
+        classified = 0
+        for track_id, (future, signature, frame_count) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[track_id]
+            try:
+                probs = future.result()
+            except Exception as e:
+                print(f"Error in emotion classification: {e}")
+                continue
+            # None: dropped by the classifier after its budget ran out
+            if probs is not None:
+                self._store_result(
+                    track_id, signature, frame_count, self.predictions_from_probs(probs)
+                )
+                classified += 1
+        return classified
+
+    def process_frame(self, frame):
+        """Detect, track and classify the faces of a BGR frame
+
+        Returns the tracked faces as ``{track_id: (x, y, w, h)}``.
+        """
+        self.frame_count += 1
+
+        # Detect faces (or propagate boxes from the last detection)
+        with self.profiler.stage("detection"):
+            faces = self.locate_faces(frame)
+
+        # Update face tracking
+        with self.profiler.stage("tracking"):
+            tracked_faces = self.face_tracker.update_tracks(faces)
+
+        with self.profiler.stage("crop"):
+            candidates = self.select_candidates(frame, tracked_faces)
+
+        self.classified_last_frame = self.classify_candidates(candidates)
+
+        # Clean up old emotion history
+        active_track_ids = set(tracked_faces.keys())
+        self.emotion_smoother.cleanup_old_tracks(active_track_ids)
+        self.scheduler.cleanup_old_tracks(active_track_ids)
+        for track_id in [t for t in self.pending if t not in active_track_ids]:
+            # Skipped by the classifier if it has not started on it yet
+            self.pending.pop(track_id)[0].cancel()
+
+        return tracked_faces
+
+    def draw_frame(self, frame, tracked_faces, show_detailed=False):
+        """Draw boxes, smoothed emotions and frame info onto ``frame``"""
+        for track_id, (x, y, w, h) in tracked_faces.items():
+            # Get smoothed emotion
+            emotion, confidence = self.emotion_smoother.get_smoothed_emotion(track_id)
+
+            # Choose color based on emotion
+            color_map = {
+                "Happy": (0, 255, 0),  # Green
+                "Sad": (255, 0, 0),  # Blue
+                "Angry": (0, 0, 255),  # Red
+                "Surprise": (0, 255, 255),  # Yellow
+                "Neutral": (128, 128, 128),  # Gray
+            }
+            color = color_map.get(emotion, (255, 255, 255))  # Default white
+
+            # Draw bounding box
+            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+
+            # Draw track ID
+            cv2.putText(
+                frame,
+                f"ID: {track_id}",
+                (x, y - 30),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                color,
+                2,
+                cv2.LINE_AA,
+            )
+
+            # Display emotion
+            display_text = f"{emotion}: {confidence:.2f}"
+            text_y = max(y - 10, 20)
+            cv2.putText(
+                frame,
+                display_text,
+                (x, text_y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.6,
+                color,
+                2,
+                cv2.LINE_AA,
+            )
+
+        # Show frame info
+        current_fps = self.performance_monitor.get_current_fps()
+        controls = self.controller.controls
+        info_text = (
+            f"Faces: {len(tracked_faces)} | Classified: {self.classified_last_frame}"
+            f" | FPS: {current_fps:.1f} | Interval: {controls['skip_interval']}"
+            f" | Scale: {controls['detection_scale']}"
+        )
+        cv2.putText(
+            frame,
+            info_text,
+            (10, 30),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (255, 255, 255),
+            2,
+            cv2.LINE_AA,
+        )
+
+        if show_detailed and tracked_faces:
+            y_offset = 60
+            for track_id in tracked_faces.keys():
+                emotion, confidence = self.emotion_smoother.get_smoothed_emotion(
+                    track_id
+                )
+                detail_text = f"ID {track_id}: {emotion} ({confidence:.2f})"
+                cv2.putText(
+                    frame,
+                    detail_text,
+                    (10, y_offset),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.5,
+                    (255, 255, 255),
+                    1,
+                    cv2.LINE_AA,
+                )
+                y_offset += 25
+
+    def end_frame(self, frame_time, face_count):
+        """Record the frame time and let the quality controller react"""
+        self.performance_monitor.add_frame_time(frame_time)
+        self.profiler.end_frame(frame_time)
+
+        if self.performance_monitor.should_adjust_performance():
+            changes = self.controller.update(
+                self.performance_monitor.get_current_fps(),
+                self.profiler.report(),
+                face_count,
+            )
+            if changes:
+                self.apply_controls(changes)
+
+    def _export_profile(self):
+        """Print the stage profile and write it to the configured path"""
+        report = self.profiler.report()
+        for name, stats in report["stages"].items():
+            print(
+                f"{name:>10}: {stats['mean_ms']:8.2f} ms "
+                f"(p95 {stats['p95_ms']:.2f} ms, {stats['share'] * 100:.0f}%)"
+            )
+        if self.config.profile_report_path:
+            self.profiler.export(self.config.profile_report_path)
+            print(f"Profile written to {self.config.profile_report_path}")
+
     def run_detection(self):
         """Main detection loop"""
         # Initialize webcam
@@ -360,122 +1076,23 @@ class ImprovedEmotionDetector:
 
         print("Starting emotion detection. Press 'q' to quit.")
         print("Press 's' to show detailed emotion probabilities.")
+        print("Press 'p' to print the per-stage profile.")
 
         show_detailed = False
 
         try:
             while True:
                 frame_start_time = time.time()
-                ret, frame = cap.read()
+                with self.profiler.stage("capture"):
+                    ret, frame = cap.read()
                 if not ret:
                     break
 
-                self.frame_count += 1
-
-                # Detect faces
-                faces = self.detect_faces_mediapipe(frame)
-
-                # Update face tracking
-                tracked_faces = self.face_tracker.update_tracks(faces)
-
-                # Process emotions every nth frame
-                if self.frame_count % self.current_skip_frames == 0:
-                    for track_id, face_coords in tracked_faces.items():
-                        # Crop face from RGB frame
-                        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        cropped_face = self.crop_face(rgb_frame, face_coords)
-
-                        # Classify emotion
-                        label, score, predictions = self.emotion_classification(
-                            cropped_face
-                        )
-
-                        if label not in ["No Face", "Error", "Unknown"]:
-                            self.emotion_smoother.add_prediction(track_id, label, score)
-
-                # Clean up old emotion history
-                self.emotion_smoother.cleanup_old_tracks(set(tracked_faces.keys()))
-
-                # Draw results
-                for track_id, (x, y, w, h) in tracked_faces.items():
-                    # Get smoothed emotion
-                    emotion, confidence = self.emotion_smoother.get_smoothed_emotion(
-                        track_id
-                    )
-
-                    # Choose color based on emotion
-                    color_map = {
-                        "Happy": (0, 255, 0),  # Green
-                        "Sad": (255, 0, 0),  # Blue
-                        "Angry": (0, 0, 255),  # Red
-                        "Surprise": (0, 255, 255),  # Yellow
-                        "Neutral": (128, 128, 128),  # Gray
-                    }
-                    color = color_map.get(emotion, (255, 255, 255))  # Default white
-
-                    # Draw bounding box
-                    cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
-
-                    # Draw track ID
-                    cv2.putText(
-                        frame,
-                        f"ID: {track_id}",
-                        (x, y - 30),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.5,
-                        color,
-                        2,
-                        cv2.LINE_AA,
-                    )
-
-                    # Display emotion
-                    display_text = f"{emotion}: {confidence:.2f}"
-                    text_y = max(y - 10, 20)
-                    cv2.putText(
-                        frame,
-                        display_text,
-                        (x, text_y),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.6,
-                        color,
-                        2,
-                        cv2.LINE_AA,
-                    )
-
-                # Show frame info
-                current_fps = self.performance_monitor.get_current_fps()
-                info_text = f"Faces: {len(tracked_faces)} | FPS: {current_fps:.1f} | Skip: {self.current_skip_frames}"
-                cv2.putText(
-                    frame,
-                    info_text,
-                    (10, 30),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.6,
-                    (255, 255, 255),
-                    2,
-                    cv2.LINE_AA,
-                )
+                tracked_faces = self.process_frame(frame)
 
-                if show_detailed and tracked_faces:
-                    y_offset = 60
-                    for track_id in tracked_faces.keys():
-                        emotion, confidence = (
-                            self.emotion_smoother.get_smoothed_emotion(track_id)
-                        )
-                        detail_text = f"ID {track_id}: {emotion} ({confidence:.2f})"
-                        cv2.putText(
-                            frame,
-                            detail_text,
-                            (10, y_offset),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.5,
-                            (255, 255, 255),
-                            1,
-                            cv2.LINE_AA,
-                        )
-                        y_offset += 25
-
-                cv2.imshow("Improved Facial Emotion Detection", frame)
+                with self.profiler.stage("draw"):
+                    self.draw_frame(frame, tracked_faces, show_detailed)
+                    cv2.imshow("Improved Facial Emotion Detection", frame)
 
                 # Handle key presses
                 key = cv2.waitKey(1) & 0xFF
@@ -484,34 +1101,50 @@ class ImprovedEmotionDetector:
                 elif key == ord("s"):
                     show_detailed = not show_detailed
                     print(f"Detailed view: {'ON' if show_detailed else 'OFF'}")
+                elif key == ord("p"):
+                    self._export_profile()
 
                 # Performance monitoring and adjustment
-                frame_time = time.time() - frame_start_time
-                self.performance_monitor.add_frame_time(frame_time)
-
-                if self.performance_monitor.should_adjust_performance():
-                    new_skip_frames = (
-                        self.performance_monitor.get_recommended_skip_frames(
-                            self.config.base_skip_frames, self.config.max_skip_frames
-                        )
-                    )
-                    if new_skip_frames != self.current_skip_frames:
-                        self.current_skip_frames = new_skip_frames
-                        print(f"Adjusted skip frames to: {self.current_skip_frames}")
+                self.end_frame(time.time() - frame_start_time, len(tracked_faces))
 
         except KeyboardInterrupt:
             print("Interrupted by user")
         finally:
             cap.release()
             cv2.destroyAllWindows()
+            if self.config.profile_report_path:
+                self._export_profile()
             if self.device.type == "cuda":
                 torch.cuda.empty_cache()
             print("Cleanup completed")
 
 
+def add_siglip_arguments(parser):
+    """Command line flags for the SigLIP inference mode"""
+    parser.add_argument("--precision", choices=["fp32", "bf16", "int8"], default="fp32")
+    parser.add_argument("--attention", choices=["sdpa", "eager"], default="sdpa")
+    parser.add_argument("--backend", choices=["torch", "compile", "onnx"], default="torch")
+    parser.add_argument("--image-size", type=int, help="SigLIP input size, e.g. 160 (native 224)")
+    parser.add_argument("--threads", type=int)
+
+
+def apply_siglip_arguments(config, args):
+    """Copy the flags added by add_siglip_arguments onto a config"""
+    config.siglip_precision = args.precision
+    config.siglip_attention = args.attention
+    config.siglip_backend = args.backend
+    config.siglip_image_size = args.image_size
+    config.siglip_threads = args.threads
+    return config
+
+
 # Usage
 if __name__ == "__main__":
-    config = EmotionDetectionConfig()
+    parser = argparse.ArgumentParser(description="Webcam facial emotion detection")
+    add_siglip_arguments(parser)
+    args = parser.parse_args()
+
+    config = apply_siglip_arguments(EmotionDetectionConfig(), args)
     # config.min_face_size = 60  
     # config.smoothing_window = 7 
 
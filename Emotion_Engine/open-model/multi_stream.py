@@ -0,0 +1,490 @@
+"""Emotion detection on several video sources with one shared SigLIP model
+
+Every source gets its own thread and ``ImprovedEmotionDetector`` (face
+detector, tracker, smoother, scheduler and quality controller), but the
+detectors send their face crops to a single ``BatchedClassifier``, so the
+model is loaded once and crops from all streams share forward passes.
+
+    python multi_stream.py --sources 0 1 rtsp://camera/stream lecture.mp4
+    python multi_stream.py --sources 0 rtsp://camera/stream --budgets 150 400 --headless
+
+Batches are filled round-robin across streams, so a busy classroom cannot
+starve a quiet one, and are dispatched when full, after ``max_batch_wait_ms``
+or when waiting longer would miss a stream's latency budget. A crop still
+queued after its stream's budget is dropped rather than classified: that
+stream has moved on and re-submits the face on a later frame.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from SIGLIP import (
+    EmotionDetectionConfig,
+    ImprovedEmotionDetector,
+    add_siglip_arguments,
+    apply_siglip_arguments,
+    build_runner,
+)
+
+
+class _Request:
+    __slots__ = ("stream", "pixels", "future", "submitted", "deadline")
+
+    def __init__(self, stream, pixels, budget):
+        self.stream = stream
+        self.pixels = pixels
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.deadline = self.submitted + budget
+
+
+class _StreamQueue:
+    """Queued crops and counters of one registered stream"""
+
+    def __init__(self, stream_id, budget, weight, window=200):
+        self.stream_id = stream_id
+        self.budget = budget
+        self.weight = weight
+        self.queue = deque()
+        self.submitted = 0
+        self.classified = 0
+        self.expired = 0  # still queued when the budget ran out
+        self.overflowed = 0  # pushed out by newer crops of the same stream
+        self.late = 0  # classified, but after the budget
+        self.latencies = deque(maxlen=window)
+
+    def stats(self):
+        latencies = np.asarray(self.latencies) * 1000.0
+        return {
+            "budget_ms": round(self.budget * 1000.0, 1),
+            "weight": self.weight,
+            "queued": len(self.queue),
+            "submitted": self.submitted,
+            "classified": self.classified,
+            "expired": self.expired,
+            "overflowed": self.overflowed,
+            "late": self.late,
+            "mean_ms": round(float(latencies.mean()), 2) if latencies.size else 0.0,
+            "p95_ms": (
+                round(float(np.percentile(latencies, 95)), 2) if latencies.size else 0.0
+            ),
+        }
+
+
+class BatchedClassifier:
+    """One SigLIP runner serving face crops from many streams
+
+    ``submit`` queues preprocessed crops and returns a future per crop that
+    resolves to the probability vector over the runner's labels, or to None if
+    the crop was dropped. A single dispatcher thread runs the forward passes.
+    """
+
+    def __init__(
+        self,
+        runner,
+        max_batch_size=16,
+        max_wait_ms=20,
+        default_budget_ms=250,
+        max_queued_per_stream=8,
+    ):
+        self.runner = runner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.default_budget = default_budget_ms / 1000.0
+        self.max_queued_per_stream = max_queued_per_stream
+        self.streams = {}
+        self.rotation = 0
+        self.queued = 0
+        self.item_time = None  # EWMA of forward-pass seconds per crop
+        self.batches = 0
+        self.batched_items = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self._run, name="batched-classifier", daemon=True
+        )
+        self.thread.start()
+
+    def register(self, stream_id, budget_ms=None, weight=1):
+        """Add a stream with its latency budget and its share of each batch"""
+        budget = self.default_budget if budget_ms is None else budget_ms / 1000.0
+        with self.condition:
+            self.streams[stream_id] = _StreamQueue(stream_id, budget, max(1, weight))
+
+    def budget(self, stream_id):
+        """Latency budget of a stream in seconds"""
+        return self.streams[stream_id].budget
+
+    def submit(self, stream_id, pixel_values):
+        """Queue ``(n, 3, H, W)`` pixel values; returns n futures"""
+        stream = self.streams[stream_id]
+        requests = [_Request(stream, pixels, stream.budget) for pixels in pixel_values]
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Classifier is closed")
+            stream.queue.extend(requests)
+            stream.submitted += len(requests)
+            self.queued += len(requests)
+            # Newer crops of the same faces are worth more than old ones
+            while len(stream.queue) > self.max_queued_per_stream:
+                self._drop(stream.queue.popleft())
+                stream.overflowed += 1
+            self.condition.notify()
+        return [request.future for request in requests]
+
+    def _drop(self, request):
+        self.queued -= 1
+        if request.future.set_running_or_notify_cancel():
+            request.future.set_result(None)
+
+    def _expire(self, now):
+        for stream in self.streams.values():
+            while stream.queue and stream.queue[0].deadline <= now:
+                self._drop(stream.queue.popleft())
+                stream.expired += 1
+
+    def _estimate(self, batch_size):
+        return (self.item_time or 0.0) * batch_size
+
+    def _take(self):
+        """Fill a batch round-robin, ``weight`` crops per stream per pass"""
+        order = list(self.streams.values())
+        if order:
+            start = self.rotation % len(order)
+            order = order[start:] + order[:start]
+        self.rotation += 1
+
+        batch = []
+        while len(batch) < self.max_batch_size and self.queued:
+            for stream in order:
+                taken = 0
+                while (
+                    stream.queue
+                    and taken < stream.weight
+                    and len(batch) < self.max_batch_size
+                ):
+                    request = stream.queue.popleft()
+                    self.queued -= 1
+                    # False if the stream cancelled it (the face is gone)
+                    if request.future.set_running_or_notify_cancel():
+                        batch.append(request)
+                        taken += 1
+        return batch
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.closed:
+                now = time.perf_counter()
+                self._expire(now)
+                if not self.queued:
+                    self.condition.wait()
+                    continue
+
+                heads = [stream.queue[0] for stream in self.streams.values() if stream.queue]
+                size = min(self.queued, self.max_batch_size)
+                # Leave enough time to classify the batch before the tightest budget
+                wait = min(
+                    min(r.submitted for r in heads) + self.max_wait,
+                    min(r.deadline for r in heads) - self._estimate(size),
+                ) - now
+                if self.queued >= self.max_batch_size or wait <= 0:
+                    batch = self._take()
+                    if batch:
+                        return batch
+                    continue
+                self.condition.wait(wait)
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._classify(batch)
+
+    def _classify(self, batch):
+        started = time.perf_counter()
+        try:
+            logits = self.runner.logits(torch.stack([r.pixels for r in batch]))
+            probs = F.softmax(logits, dim=1).numpy()
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        per_item = (finished - started) / len(batch)
+        self.item_time = (
+            per_item if self.item_time is None else 0.8 * self.item_time + 0.2 * per_item
+        )
+        with self.condition:
+            self.batches += 1
+            self.batched_items += len(batch)
+            for request in batch:
+                stream = request.stream
+                stream.classified += 1
+                stream.latencies.append(finished - request.submitted)
+                if finished > request.deadline:
+                    stream.late += 1
+        for request, row in zip(batch, probs):
+            request.future.set_result(row)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "batches": self.batches,
+                "mean_batch_size": (
+                    round(self.batched_items / self.batches, 2) if self.batches else 0.0
+                ),
+                "ms_per_crop": round((self.item_time or 0.0) * 1000.0, 2),
+                "queued": self.queued,
+                "streams": {
+                    str(stream_id): stream.stats()
+                    for stream_id, stream in self.streams.items()
+                },
+            }
+
+    def close(self):
+        """Stop the dispatcher; queued crops resolve to None"""
+        with self.condition:
+            self.closed = True
+            for stream in self.streams.values():
+                while stream.queue:
+                    self._drop(stream.queue.popleft())
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class VideoStream:
+    """Capture thread running one detector on one video source"""
+
+    def __init__(self, stream_id, source, detector):
+        self.stream_id = stream_id
+        # Webcam indices are given as numbers, everything else is a path or URL
+        self.source = int(source) if str(source).isdigit() else source
+        self.detector = detector
+        self.window = f"Stream {stream_id}: {source}"
+        self.show_detailed = False
+        self.frame = None
+        self.tracked_faces = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name=f"stream-{stream_id}", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def latest(self):
+        """Latest annotated frame and its tracked faces"""
+        with self.lock:
+            return self.frame, self.tracked_faces
+
+    def _run(self):
+        detector = self.detector
+        config = detector.config
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            print(f"Error: Could not open {self.window}")
+            return
+        if isinstance(self.source, int):
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, config.webcam_width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, config.webcam_height)
+            cap.set(cv2.CAP_PROP_FPS, config.webcam_fps)
+
+        try:
+            while not self.stop_event.is_set():
+                frame_start_time = time.time()
+                with detector.profiler.stage("capture"):
+                    ret, frame = cap.read()
+                if not ret:
+                    print(f"{self.window} ended")
+                    break
+
+                tracked_faces = detector.process_frame(frame)
+
+                with detector.profiler.stage("draw"):
+                    detector.draw_frame(frame, tracked_faces, self.show_detailed)
+                with self.lock:
+                    self.frame = frame
+                    self.tracked_faces = tracked_faces
+
+                detector.end_frame(time.time() - frame_start_time, len(tracked_faces))
+        except Exception as e:
+            print(f"Error in {self.window}: {e}")
+        finally:
+            cap.release()
+
+
+class MultiStreamDetector:
+    """Runs one VideoStream per source against a shared BatchedClassifier"""
+
+    def __init__(self, config, sources, budgets_ms=None, weights=None):
+        self.config = config
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        print(f"Using device: {device}")
+        runner = build_runner(config, device)
+        print(f"Model loaded successfully ({runner.options.describe()})")
+
+        self.classifier = BatchedClassifier(
+            runner,
+            config.max_batch_size,
+            config.max_batch_wait_ms,
+            config.latency_budget_ms,
+            config.max_queued_per_stream,
+        )
+        self.streams = []
+        for stream_id, source in enumerate(sources):
+            budget = budgets_ms[stream_id] if budgets_ms and stream_id < len(budgets_ms) else None
+            weight = weights[stream_id] if weights and stream_id < len(weights) else 1
+            self.classifier.register(stream_id, budget, weight)
+            detector = ImprovedEmotionDetector(
+                config, classifier=self.classifier, stream_id=stream_id
+            )
+            self.streams.append(VideoStream(stream_id, source, detector))
+
+    def report(self):
+        """Per-stream stage profiles and the classifier's batching statistics"""
+        return {
+            "classifier": self.classifier.stats(),
+            "streams": {
+                str(stream.stream_id): {
+                    "source": str(stream.source),
+                    "profile": stream.detector.profiler.report(),
+                }
+                for stream in self.streams
+            },
+        }
+
+    def print_report(self):
+        report = self.report()
+        classifier = report["classifier"]
+        print(
+            f"Classifier: {classifier['batches']} batches, mean size "
+            f"{classifier['mean_batch_size']}, {classifier['ms_per_crop']} ms/crop"
+        )
+        for stream_id, stats in classifier["streams"].items():
+            profile = report["streams"][stream_id]["profile"]
+            print(
+                f"Stream {stream_id}: {profile['fps']:.1f} FPS | classified "
+                f"{stats['classified']}/{stats['submitted']} | expired {stats['expired']}"
+                f" | overflowed {stats['overflowed']} | late {stats['late']}"
+                f" | latency {stats['mean_ms']:.1f} ms (p95 {stats['p95_ms']:.1f} ms,"
+                f" budget {stats['budget_ms']:.0f} ms)"
+            )
+        if self.config.profile_report_path:
+            with open(self.config.profile_report_path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Profile written to {self.config.profile_report_path}")
+
+    def _print_emotions(self):
+        for stream in self.streams:
+            _, tracked_faces = stream.latest()
+            smoother = stream.detector.emotion_smoother
+            faces = ", ".join(
+                "{}={}({:.2f})".format(track_id, *smoother.get_smoothed_emotion(track_id))
+                for track_id in tracked_faces
+            )
+            print(f"{stream.window} | {faces or 'no faces'}")
+
+    def run(self, show=True, report_interval=10.0):
+        """Run until every stream has ended, 'q' or Ctrl+C"""
+        for stream in self.streams:
+            stream.start()
+
+        if show:
+            print("Starting emotion detection. Press 'q' to quit.")
+            print("Press 's' to show detailed emotion probabilities.")
+            print("Press 'p' to print the per-stream profile.")
+
+        last_report = time.time()
+        try:
+            while any(stream.is_alive() for stream in self.streams):
+                if show:
+                    # HighGUI windows must be driven from the main thread
+                    for stream in self.streams:
+                        frame, _ = stream.latest()
+                        if frame is not None:
+                            cv2.imshow(stream.window, frame)
+
+                    key = cv2.waitKey(15) & 0xFF
+                    if key == ord("q"):
+                        break
+                    elif key == ord("s"):
+                        for stream in self.streams:
+                            stream.show_detailed = not stream.show_detailed
+                    elif key == ord("p"):
+                        self.print_report()
+                else:
+                    time.sleep(0.1)
+                    if time.time() - last_report >= report_interval:
+                        self._print_emotions()
+                        self.print_report()
+                        last_report = time.time()
+        except KeyboardInterrupt:
+            print("Interrupted by user")
+        finally:
+            for stream in self.streams:
+                stream.stop()
+            for stream in self.streams:
+                stream.thread.join()
+            self.classifier.close()
+            if show:
+                cv2.destroyAllWindows()
+            self.print_report()
+            print("Cleanup completed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Facial emotion detection on several video sources with one shared model"
+    )
+    parser.add_argument(
+        "--sources",
+        nargs="+",
+        required=True,
+        help="Webcam indices, video files or stream URLs",
+    )
+    parser.add_argument(
+        "--budgets",
+        type=float,
+        nargs="+",
+        help="Latency budget per source in ms (default --budget-ms)",
+    )
+    parser.add_argument(
+        "--weights", type=int, nargs="+", help="Crops per batching turn per source"
+    )
+    parser.add_argument("--budget-ms", type=float, default=250)
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-queued", type=int, default=8, help="Queued crops per source")
+    parser.add_argument("--headless", action="store_true", help="No windows, print results")
+    parser.add_argument("--report", help="Write the final JSON report here")
+    add_siglip_arguments(parser)
+    args = parser.parse_args()
+
+    config = apply_siglip_arguments(EmotionDetectionConfig(), args)
+    config.latency_budget_ms = args.budget_ms
+    config.max_batch_size = args.max_batch
+    config.max_batch_wait_ms = args.max_wait_ms
+    config.max_queued_per_stream = args.max_queued
+    config.profile_report_path = args.report
+
+    detector = MultiStreamDetector(config, args.sources, args.budgets, args.weights)
+    detector.run(show=not args.headless)
@@ -24,23 +24,43 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0finterface.proto\x12\x07\x65motion\"&\n\nKeyRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x0b\n\x03key\x18\x02 \x01(\t\"4\n\x0cImageRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x17\n\x0f\x65ncrypted_image\x18\x02 \x01(\x0c\"2\n\x0eStatusResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\",\n\x0e\x45motionRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\r\n\x05image\x18\x02 \x01(\x0c\"2\n\x0f\x45motionResponse\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x12\n\nclass_name\x18\x02 \x01(\t2\xd7\x01\n\x0e\x45motionService\x12\x41\n\x11SendDecryptionKey\x12\x13.emotion.KeyRequest\x1a\x17.emotion.StatusResponse\x12\x44\n\x12SendEncryptedImage\x12\x15.emotion.ImageRequest\x1a\x17.emotion.StatusResponse\x12<\n\x07Predict\x12\x17.emotion.EmotionRequest\x1a\x18.emotion.EmotionResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0finterface.proto\x12\x07\x65motion\"&\n\nKeyRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x0b\n\x03key\x18\x02 \x01(\t\"4\n\x0fKeyBatchRequest\x12!\n\x04keys\x18\x01 \x03(\x0b\x32\x13.emotion.KeyRequest\":\n\tKeyStatus\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x0f\n\x07success\x18\x02 \x01(\x08\x12\x0f\n\x07message\x18\x03 \x01(\t\"I\n\x10KeyBatchResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12$\n\x08statuses\x18\x02 \x03(\x0b\x32\x12.emotion.KeyStatus\"5\n\x10SubscribeRequest\x12\x0c\n\x04uids\x18\x01 \x03(\t\x12\x13\n\x0b\x62uffer_size\x18\x02 \x01(\r\"\xcb\x02\n\x10PredictionResult\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x12\n\nclass_name\x18\x02 \x01(\t\x12\x43\n\rprobabilities\x18\x03 \x03(\x0b\x32,.emotion.PredictionResult.ProbabilitiesEntry\x12\x15\n\rmodel_version\x18\x04 \x01(\t\x12\x0e\n\x06source\x18\x05 \x01(\t\x12\x14\n\x0ctimestamp_ms\x18\x06 \x01(\x03\x12\x10\n\x08queue_ms\x18\x07 \x01(\x02\x12\x12\n\ndecrypt_ms\x18\x08 \x01(\x02\x12\x14\n\x0cinference_ms\x18\t \x01(\x02\x12\x10\n\x08total_ms\x18\n \x01(\x02\x12\x10\n\x08sequence\x18\x0b \x01(\x04\x1a\x34\n\x12ProbabilitiesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x02:\x02\x38\x01\"4\n\x0cImageRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x17\n\x0f\x65ncrypted_image\x18\x02 \x01(\x0c\"<\n\x10\x45mbeddingRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x1b\n\x13\x65ncrypted_embedding\x18\x02 \x01(\x0c\"\x0f\n\rHealthRequest\"D\n\x0eHealthResponse\x12\x0f\n\x07serving\x18\x01 \x01(\x08\x12\x0e\n\x06queued\x18\x02 \x01(\x04\x12\x11\n\tprocessed\x18\x03 \x01(\x04\"2\n\x0eStatusResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\",\n\x0e\x45motionRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\r\n\x05image\x18\x02 \x01(\x0c\"2\n\x0f\x45motionResponse\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x12\n\nclass_name\x18\x02 \x01(\t2\xc6\x04\n\x0e\x45motionService\x12\x41\n\x11SendDecryptionKey\x12\x13.emotion.KeyRequest\x1a\x17.emotion.StatusResponse\x12\x44\n\x12SendEncryptedImage\x12\x15.emotion.ImageRequest\x1a\x17.emotion.StatusResponse\x12<\n\x07Predict\x12\x17.emotion.EmotionRequest\x1a\x18.emotion.EmotionResponse\x12I\n\x12SendDecryptionKeys\x12\x18.emotion.KeyBatchRequest\x1a\x19.emotion.KeyBatchResponse\x12H\n\x14StreamDecryptionKeys\x12\x13.emotion.KeyRequest\x1a\x19.emotion.KeyBatchResponse(\x01\x12J\n\x10SubscribeResults\x12\x19.emotion.SubscribeRequest\x1a\x19.emotion.PredictionResult0\x01\x12L\n\x16SendEncryptedEmbedding\x12\x19.emotion.EmbeddingRequest\x1a\x17.emotion.StatusResponse\x12>\n\x0b\x43heckHealth\x12\x16.emotion.HealthRequest\x1a\x17.emotion.HealthResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'interface_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_PREDICTIONRESULT_PROBABILITIESENTRY']._loaded_options = None
+  _globals['_PREDICTIONRESULT_PROBABILITIESENTRY']._serialized_options = b'8\001'
   _globals['_KEYREQUEST']._serialized_start=28
   _globals['_KEYREQUEST']._serialized_end=66
-  _globals['_IMAGEREQUEST']._serialized_start=68
-  _globals['_IMAGEREQUEST']._serialized_end=120
-  _globals['_STATUSRESPONSE']._serialized_start=122
-  _globals['_STATUSRESPONSE']._serialized_end=172
-  _globals['_EMOTIONREQUEST']._serialized_start=174
-  _globals['_EMOTIONREQUEST']._serialized_end=218
-  _globals['_EMOTIONRESPONSE']._serialized_start=220
-  _globals['_EMOTIONRESPONSE']._serialized_end=270
-  _globals['_EMOTIONSERVICE']._serialized_start=273
-  _globals['_EMOTIONSERVICE']._serialized_end=488
+  _globals['_KEYBATCHREQUEST']._serialized_start=68
+  _globals['_KEYBATCHREQUEST']._serialized_end=120
+  _globals['_KEYSTATUS']._serialized_start=122
+  _globals['_KEYSTATUS']._serialized_end=180
+  _globals['_KEYBATCHRESPONSE']._serialized_start=182
+  _globals['_KEYBATCHRESPONSE']._serialized_end=255
+  _globals['_SUBSCRIBEREQUEST']._serialized_start=257
+  _globals['_SUBSCRIBEREQUEST']._serialized_end=310
+  _globals['_PREDICTIONRESULT']._serialized_start=313
+  _globals['_PREDICTIONRESULT']._serialized_end=644
+  _globals['_PREDICTIONRESULT_PROBABILITIESENTRY']._serialized_start=592
+  _globals['_PREDICTIONRESULT_PROBABILITIESENTRY']._serialized_end=644
+  _globals['_IMAGEREQUEST']._serialized_start=646
+  _globals['_IMAGEREQUEST']._serialized_end=698
+  _globals['_EMBEDDINGREQUEST']._serialized_start=700
+  _globals['_EMBEDDINGREQUEST']._serialized_end=760
+  _globals['_HEALTHREQUEST']._serialized_start=762
+  _globals['_HEALTHREQUEST']._serialized_end=777
+  _globals['_HEALTHRESPONSE']._serialized_start=779
+  _globals['_HEALTHRESPONSE']._serialized_end=847
+  _globals['_STATUSRESPONSE']._serialized_start=849
+  _globals['_STATUSRESPONSE']._serialized_end=899
+  _globals['_EMOTIONREQUEST']._serialized_start=901
+  _globals['_EMOTIONREQUEST']._serialized_end=945
+  _globals['_EMOTIONRESPONSE']._serialized_start=947
+  _globals['_EMOTIONRESPONSE']._serialized_end=997
+  _globals['_EMOTIONSERVICE']._serialized_start=1000
+  _globals['_EMOTIONSERVICE']._serialized_end=1582
 # @@protoc_insertion_point(module_scope)
@@ -49,6 +49,31 @@ class EmotionServiceStub(object):
                 request_serializer=interface__pb2.EmotionRequest.SerializeToString,
                 response_deserializer=interface__pb2.EmotionResponse.FromString,
                 _registered_method=True)
+        self.SendDecryptionKeys = channel.unary_unary(
+                '/emotion.EmotionService/SendDecryptionKeys',
+                request_serializer=interface__pb2.KeyBatchRequest.SerializeToString,
+                response_deserializer=interface__pb2.KeyBatchResponse.FromString,
+                _registered_method=True)
+        self.StreamDecryptionKeys = channel.stream_unary(
+                '/emotion.EmotionService/StreamDecryptionKeys',
+                request_serializer=interface__pb2.KeyRequest.SerializeToString,
+                response_deserializer=interface__pb2.KeyBatchResponse.FromString,
+                _registered_method=True)
+        self.SubscribeResults = channel.unary_stream(
+                '/emotion.EmotionService/SubscribeResults',
+                request_serializer=interface__pb2.SubscribeRequest.SerializeToString,
+                response_deserializer=interface__pb2.PredictionResult.FromString,
+                _registered_method=True)
+        self.SendEncryptedEmbedding = channel.unary_unary(
+                '/emotion.EmotionService/SendEncryptedEmbedding',
+                request_serializer=interface__pb2.EmbeddingRequest.SerializeToString,
+                response_deserializer=interface__pb2.StatusResponse.FromString,
+                _registered_method=True)
+        self.CheckHealth = channel.unary_unary(
+                '/emotion.EmotionService/CheckHealth',
+                request_serializer=interface__pb2.HealthRequest.SerializeToString,
+                response_deserializer=interface__pb2.HealthResponse.FromString,
+                _registered_method=True)
 
 
 class EmotionServiceServicer(object):
@@ -76,6 +101,43 @@ class EmotionServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendDecryptionKeys(self, request, context):
+        """Bulk key provisioning, e.g. when a session opens for a whole class.
+        All keys of a call are stored in one transaction.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StreamDecryptionKeys(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SubscribeResults(self, request, context):
+        """Pushes every completed prediction as it is made. Slow subscribers are
+        disconnected with RESOURCE_EXHAUSTED once their buffer is full.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendEncryptedEmbedding(self, request, context):
+        """Landmark/embedding input: a fixed-length float32 vector (e.g. MediaPipe face
+        landmarks) instead of an image, classified by a small MLP. No image decode.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CheckHealth(self, request, context):
+        """Liveness and backlog of one worker, polled by the consistent-hash router (worker/router.py).
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_EmotionServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -94,6 +156,31 @@ def add_EmotionServiceServicer_to_server(servicer, server):
                     request_deserializer=interface__pb2.EmotionRequest.FromString,
                     response_serializer=interface__pb2.EmotionResponse.SerializeToString,
             ),
+            'SendDecryptionKeys': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendDecryptionKeys,
+                    request_deserializer=interface__pb2.KeyBatchRequest.FromString,
+                    response_serializer=interface__pb2.KeyBatchResponse.SerializeToString,
+            ),
+            'StreamDecryptionKeys': grpc.stream_unary_rpc_method_handler(
+                    servicer.StreamDecryptionKeys,
+                    request_deserializer=interface__pb2.KeyRequest.FromString,
+                    response_serializer=interface__pb2.KeyBatchResponse.SerializeToString,
+            ),
+            'SubscribeResults': grpc.unary_stream_rpc_method_handler(
+                    servicer.SubscribeResults,
+                    request_deserializer=interface__pb2.SubscribeRequest.FromString,
+                    response_serializer=interface__pb2.PredictionResult.SerializeToString,
+            ),
+            'SendEncryptedEmbedding': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendEncryptedEmbedding,
+                    request_deserializer=interface__pb2.EmbeddingRequest.FromString,
+                    response_serializer=interface__pb2.StatusResponse.SerializeToString,
+            ),
+            'CheckHealth': grpc.unary_unary_rpc_method_handler(
+                    servicer.CheckHealth,
+                    request_deserializer=interface__pb2.HealthRequest.FromString,
+                    response_serializer=interface__pb2.HealthResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'emotion.EmotionService', rpc_method_handlers)
@@ -185,3 +272,138 @@ class EmotionService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def SendDecryptionKeys(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/emotion.EmotionService/SendDecryptionKeys',
+            interface__pb2.KeyBatchRequest.SerializeToString,
+            interface__pb2.KeyBatchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def StreamDecryptionKeys(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/emotion.EmotionService/StreamDecryptionKeys',
+            interface__pb2.KeyRequest.SerializeToString,
+            interface__pb2.KeyBatchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def SubscribeResults(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/emotion.EmotionService/SubscribeResults',
+            interface__pb2.SubscribeRequest.SerializeToString,
+            interface__pb2.PredictionResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def SendEncryptedEmbedding(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/emotion.EmotionService/SendEncryptedEmbedding',
+            interface__pb2.EmbeddingRequest.SerializeToString,
+            interface__pb2.StatusResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def CheckHealth(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/emotion.EmotionService/CheckHealth',
+            interface__pb2.HealthRequest.SerializeToString,
+            interface__pb2.HealthResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
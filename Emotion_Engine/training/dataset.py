@@ -0,0 +1,171 @@
+"""
+FER-style face dataset preprocessed once into a memory-mapped uint8 array.
+
+prepare() decodes an image folder (one sub-directory per emotion, matched
+case-insensitively against EMOTIONS) into:
+
+    <out>/images.u8     (N, 48, 48) uint8, raw np.memmap
+    <out>/labels.npy    (N,) int64 indices into EMOTIONS
+    <out>/meta.json     shape, class counts, source folder
+
+Images are resized and converted to grayscale exactly like the worker's
+infer_transform, so training sees the same pixels as inference.
+"""
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import Dataset
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_loader import EMOTIONS
+
+IMAGE_SIZE = 48
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def scan_folder(root: str):
+    """Returns [(path, label)] for an image folder, labels in EMOTIONS order."""
+    lookup = {name.lower(): i for i, name in enumerate(EMOTIONS)}
+    samples = []
+    for folder in sorted(os.listdir(root)):
+        label = lookup.get(folder.lower())
+        path = os.path.join(root, folder)
+        if label is None or not os.path.isdir(path):
+            print(f"Skipping folder {folder}: not an emotion in {EMOTIONS}")
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((os.path.join(path, name), label))
+    return samples
+
+
+def _decode(path: str) -> np.ndarray:
+    # Same steps as the worker's model_loader.fill_input: resize in the file's own mode, then grayscale
+    with Image.open(path) as img:
+        img = img.resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR).convert("L")
+        return np.asarray(img, dtype=np.uint8)
+
+
+def prepare(root: str, out_dir: str, workers: int = os.cpu_count() or 1, chunk: int = 256):
+    samples = scan_folder(root)
+    if not samples:
+        raise ValueError(f"No images found under {root}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    images = np.memmap(os.path.join(out_dir, "images.u8"), dtype=np.uint8, mode="w+",
+                       shape=(len(samples), IMAGE_SIZE, IMAGE_SIZE))
+    labels = np.array([label for _, label in samples], dtype=np.int64)
+
+    with Pool(workers) as pool:
+        for i, array in enumerate(pool.imap(_decode, [path for path, _ in samples], chunksize=chunk)):
+            images[i] = array
+            if (i + 1) % 10000 == 0:
+                print(f"Decoded {i + 1}/{len(samples)} images")
+    images.flush()
+
+    np.save(os.path.join(out_dir, "labels.npy"), labels)
+    meta = {
+        "count": len(samples),
+        "image_size": IMAGE_SIZE,
+        "classes": EMOTIONS,
+        "class_counts": np.bincount(labels, minlength=len(EMOTIONS)).tolist(),
+        "source": os.path.abspath(root),
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Wrote {len(samples)} images to {out_dir}")
+    return meta
+
+
+def load_prepared(data_dir: str):
+    """Returns (images memmap (N, 48, 48) uint8, labels (N,) int64, meta)."""
+    with open(os.path.join(data_dir, "meta.json")) as f:
+        meta = json.load(f)
+    images = np.memmap(os.path.join(data_dir, "images.u8"), dtype=np.uint8, mode="r",
+                       shape=(meta["count"], meta["image_size"], meta["image_size"]))
+    labels = np.load(os.path.join(data_dir, "labels.npy"))
+    return images, labels, meta
+
+
+def split_indices(count: int, val_fraction: float = 0.2, seed: int = 0):
+    """Deterministic (train, val) index split; the same seed gives the same held-out set."""
+    order = np.random.default_rng(seed).permutation(count)
+    n_val = int(count * val_fraction)
+    return np.sort(order[n_val:]), np.sort(order[:n_val])
+
+
+class MemmapFaces(Dataset):
+    """
+    Batch-level dataset over the memmap: each item is a whole batch of indices
+    (use with a BatchSampler and batch_size=None), so a worker does one fancy
+    index into the memmap per batch instead of one read per image.
+    """
+
+    def __init__(self, data_dir: str, indices=None):
+        self.data_dir = data_dir
+        self.images, self.labels, self.meta = load_prepared(data_dir)
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, batch):
+        # Sorted reads are sequential on disk; the order inside a batch does not matter
+        rows = np.sort(self.indices[np.asarray(batch)])
+        images = torch.from_numpy(np.ascontiguousarray(self.images[rows]))
+        labels = torch.from_numpy(self.labels[rows])
+        return images, labels
+
+    def __getstate__(self):
+        # Workers reopen the memmap instead of pickling it
+        state = self.__dict__.copy()
+        del state["images"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.images, _, _ = load_prepared(self.data_dir)
+
+
+def to_input(images: torch.Tensor) -> torch.Tensor:
+    """uint8 (B, 48, 48) -> float (B, 1, 48, 48) in [-1, 1], as infer_transform."""
+    return images.unsqueeze(1).float().div_(127.5).sub_(1.0)
+
+
+def augment(x: torch.Tensor, hflip: float = 0.5, vflip: float = 0.0, max_shift: float = 0.1,
+            max_rotate: float = 10.0, max_scale: float = 0.1, generator=None) -> torch.Tensor:
+    """
+    Random flips and a random affine per image, applied to the whole batch at once
+    (one affine_grid + grid_sample call) on whatever device x lives on.
+    """
+    b = x.shape[0]
+
+    def uniform(low, high):
+        return torch.rand(b, device=x.device, generator=generator) * (high - low) + low
+
+    if hflip > 0:
+        flip = uniform(0, 1) < hflip
+        x = torch.where(flip[:, None, None, None], x.flip(-1), x)
+    if vflip > 0:
+        flip = uniform(0, 1) < vflip
+        x = torch.where(flip[:, None, None, None], x.flip(-2), x)
+
+    if max_shift > 0 or max_rotate > 0 or max_scale > 0:
+        angle = uniform(-max_rotate, max_rotate) * (torch.pi / 180)
+        scale = uniform(1 - max_scale, 1 + max_scale)
+        cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+        theta = torch.stack([
+            torch.stack([cos, -sin, uniform(-max_shift, max_shift) * 2], dim=1),
+            torch.stack([sin, cos, uniform(-max_shift, max_shift) * 2], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta.to(x.dtype), list(x.shape), align_corners=False)
+        # Border padding keeps the background gray level instead of black corners
+        x = F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+    return x
@@ -0,0 +1,390 @@
+"""
+Accuracy / latency / memory matrix for the registered model variants.
+
+Every variant runs in its own process (so peak RSS is its own) over the held-out
+split of a prepared dataset (see dataset.py; same seed and fraction as train.py),
+once for accuracy and per-class F1 and then once per batch size and thread count
+for latency. Results go to a JSON file and a Markdown report.
+
+    python evaluate_variants.py --data data/fer --cnn ../worker/models/model_v1.pth \
+        --batch-sizes 1 8 32 --threads 1 4 --output reports/variants
+
+New variants are added with @register; a builder gets the parsed arguments and
+returns a Variant whose predict() maps uint8 (B, 48, 48) faces to probabilities
+over EMOTIONS. A variant registered with a reference (an optimised mode of
+another variant) is also compared against it image by image: top-1 agreement
+and the absolute difference of the probabilities.
+
+    # SigLIP CPU modes against FP32 (see worker/siglip_runtime.py)
+    python evaluate_variants.py --data data/fer --limit 500 --batch-sizes 1 4 \
+        --variants siglip siglip-sdpa siglip-bf16 siglip-int8 siglip-compile \
+                   siglip-onnx siglip-onnx-int8 siglip-int8-160
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataset import load_prepared, split_indices, to_input
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_loader import EMOTIONS, load_cnn
+
+
+class Variant:
+    def __init__(self, predict, artifact_bytes: int, notes: str = ""):
+        self.predict = predict
+        self.artifact_bytes = artifact_bytes
+        self.notes = notes
+
+
+VARIANTS = {}
+
+
+def register(name: str, description: str, reference: str | None = None):
+    def wrap(builder):
+        VARIANTS[name] = (builder, description, reference)
+        return builder
+    return wrap
+
+
+def serialized_size(obj) -> int:
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.tell()
+
+
+def cnn_predictor(model, channels_last: bool = False, bf16: bool = False):
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+    def predict(images: torch.Tensor) -> torch.Tensor:
+        inputs = to_input(images).contiguous(memory_format=memory_format)
+        with torch.no_grad(), (torch.autocast("cpu", dtype=torch.bfloat16) if bf16 else contextlib.nullcontext()):
+            # CNN.forward returns log-probabilities
+            return model(inputs).float().exp()
+
+    return predict
+
+
+@register("cnn-fp32", "48x48 CNN as served today")
+def build_cnn_fp32(args):
+    model = load_cnn(args.cnn)
+    return Variant(cnn_predictor(model), serialized_size(model.state_dict()))
+
+
+@register("cnn-channels-last", "CNN with NHWC activations and weights", reference="cnn-fp32")
+def build_cnn_channels_last(args):
+    model = load_cnn(args.cnn).to(memory_format=torch.channels_last)
+    return Variant(cnn_predictor(model, channels_last=True), serialized_size(model.state_dict()))
+
+
+@register("cnn-bf16", "CNN under bfloat16 autocast (needs AVX512-BF16/AMX to pay off)", reference="cnn-fp32")
+def build_cnn_bf16(args):
+    model = load_cnn(args.cnn)
+    return Variant(cnn_predictor(model, bf16=True), serialized_size(model.state_dict()) // 2,
+                   "artifact size assumes bf16 weights")
+
+
+@register("cnn-int8-dynamic", "CNN with dynamically quantised int8 Linear layers", reference="cnn-fp32")
+def build_cnn_int8_dynamic(args):
+    model = torch.ao.quantization.quantize_dynamic(load_cnn(args.cnn), {nn.Linear}, dtype=torch.qint8)
+    return Variant(cnn_predictor(model), serialized_size(model.state_dict()))
+
+
+@register("cnn-pruned", "Channel-pruned CNN from prune.py (--pruned)", reference="cnn-fp32")
+def build_cnn_pruned(args):
+    if not args.pruned:
+        raise ValueError("no --pruned model given")
+    model = load_cnn(args.pruned)
+    return Variant(cnn_predictor(model), os.path.getsize(args.pruned), f"widths {list(model.widths)}")
+
+
+@register("cnn-early-exit", "CNN with calibrated early-exit heads from train_early_exit.py (--early-exit)",
+          reference="cnn-fp32")
+def build_cnn_early_exit(args):
+    if not args.early_exit:
+        raise ValueError("no --early-exit model given")
+    model = load_cnn(args.early_exit)
+    thresholds = ", ".join(f"{name} {t:.3f}" for name, t in zip(model.exits, model.thresholds.tolist()))
+    return Variant(cnn_predictor(model), os.path.getsize(args.early_exit), f"thresholds {thresholds}")
+
+
+def siglip_variant(args, options) -> Variant:
+    from PIL import Image
+    from cascade import SiglipLabelMap
+    from siglip_runtime import SiglipRunner
+
+    runner = SiglipRunner(args.siglip, options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        runner.load()
+    to_emotions = SiglipLabelMap(runner.labels)
+
+    def predict(images: torch.Tensor) -> torch.Tensor:
+        pil = [Image.fromarray(image).convert("RGB") for image in images.numpy()]
+        probs = runner.predict_proba(pil)
+        return to_emotions(probs)
+
+    if runner.session is not None:
+        size = os.path.getsize(runner.onnx_path)
+    else:
+        size = serialized_size(runner.model.state_dict())
+    # The held-out set only has 48x48 grayscale faces; SigLIP sees them upscaled
+    notes = f"{options.describe()}; 48x48 grayscale faces upscaled to {runner.image_size}px"
+    if options.backend == "onnx":
+        notes += "; ONNX Runtime threads fixed at load"
+    return Variant(predict, size, notes)
+
+
+@register("siglip", "SigLIP2 classifier in FP32 eager mode, as in open-model/SIGLIP.py, mapped onto EMOTIONS")
+def build_siglip(args):
+    from siglip_runtime import SiglipOptions
+    return siglip_variant(args, SiglipOptions(attention="eager"))
+
+
+def register_siglip_mode(name: str, description: str, **options):
+    def build(args):
+        from siglip_runtime import SiglipOptions
+        return siglip_variant(args, SiglipOptions(onnx_dir=args.onnx_dir, **options))
+    register(name, description, reference="siglip")(build)
+
+
+register_siglip_mode("siglip-sdpa", "SigLIP FP32 with scaled-dot-product attention", attention="sdpa")
+register_siglip_mode("siglip-bf16", "SigLIP in bfloat16 (needs AVX512-BF16/AMX to pay off)", precision="bf16")
+register_siglip_mode("siglip-int8", "SigLIP with dynamically quantised int8 Linear layers", precision="int8")
+register_siglip_mode("siglip-compile", "SigLIP FP32 under torch.compile", backend="compile")
+register_siglip_mode("siglip-onnx", "SigLIP exported to ONNX Runtime, FP32", backend="onnx")
+register_siglip_mode("siglip-onnx-int8", "SigLIP in ONNX Runtime with int8 dynamic quantisation",
+                     backend="onnx", precision="int8")
+register_siglip_mode("siglip-int8-160", "SigLIP int8 at 160x160 input (half the patches)",
+                     precision="int8", image_size=160)
+
+
+def f1_scores(labels: np.ndarray, predictions: np.ndarray):
+    confusion = np.zeros((len(EMOTIONS), len(EMOTIONS)), dtype=np.int64)
+    np.add.at(confusion, (labels, predictions), 1)
+    tp = np.diag(confusion).astype(np.float64)
+    precision = tp / np.maximum(confusion.sum(axis=0), 1)
+    recall = tp / np.maximum(confusion.sum(axis=1), 1)
+    f1 = np.where(precision + recall > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
+    # Classes absent from the held-out set are left out of the macro average
+    present = confusion.sum(axis=1) > 0
+    return f1, float(f1[present].mean()) if present.any() else 0.0, confusion
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def evaluate(name: str, args) -> dict:
+    builder, description, reference = VARIANTS[name]
+    images, labels, _ = load_prepared(args.data)
+    if args.split == "val":
+        _, indices = split_indices(len(labels), args.val_fraction, args.seed)
+    else:
+        indices = np.arange(len(labels))
+    if args.limit:
+        indices = indices[:args.limit]
+    faces = torch.from_numpy(np.ascontiguousarray(images[indices]))
+    targets = labels[indices]
+
+    result = {"variant": name, "description": description, "reference": reference, "images": len(indices)}
+    baseline_rss = peak_rss_mb()
+    started = time.perf_counter()
+    variant = builder(args)
+    result.update({"load_seconds": time.perf_counter() - started, "artifact_bytes": variant.artifact_bytes,
+                   "notes": variant.notes})
+
+    torch.set_num_threads(max(args.threads))
+    probabilities = []
+    for start in range(0, len(faces), args.eval_batch_size):
+        probabilities.append(variant.predict(faces[start:start + args.eval_batch_size]).float().numpy())
+    probabilities = np.concatenate(probabilities)
+    predictions = probabilities.argmax(1)
+    f1, macro_f1, confusion = f1_scores(targets, predictions)
+    result.update({
+        "accuracy": float((predictions == targets).mean()),
+        "macro_f1": macro_f1,
+        "per_class_f1": dict(zip(EMOTIONS, f1.round(4).tolist())),
+        "confusion": confusion.tolist(),
+        # Used for the parity columns, not written to the report
+        "probabilities": probabilities,
+    })
+
+    timing_faces = faces[:args.timing_images]
+    runs = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            batches = [timing_faces[i:i + batch_size] for i in range(0, len(timing_faces), batch_size)]
+            batches = [b for b in batches if len(b) == batch_size] or batches[:1]
+            for batch in batches[:args.warmup]:
+                variant.predict(batch)
+            latencies = []
+            for batch in batches:
+                start = time.perf_counter()
+                variant.predict(batch)
+                latencies.append(time.perf_counter() - start)
+            latencies = np.array(latencies)
+            runs.append({
+                "threads": threads,
+                "batch_size": batch_size,
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "images_per_second": float(sum(len(b) for b in batches) / latencies.sum()),
+            })
+    result["runs"] = runs
+    result["baseline_rss_mb"] = baseline_rss
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def _evaluate_in_child(name, args, results):
+    try:
+        results.put(evaluate(name, args))
+    except Exception as e:
+        results.put({"variant": name, "description": VARIANTS[name][1], "error": f"{type(e).__name__}: {e}"})
+
+
+def add_parity(results: list[dict]):
+    """Compares each variant that has a reference with it and drops the per-image probabilities."""
+    by_name = {r["variant"]: r for r in results}
+    for r in results:
+        reference = by_name.get(r.get("reference"))
+        if "probabilities" not in r or reference is None or "probabilities" not in reference:
+            continue
+        ours, theirs = r["probabilities"], reference["probabilities"]
+        diff = np.abs(ours - theirs)
+        r["parity"] = {
+            "reference": reference["variant"],
+            "top1_agreement": float((ours.argmax(1) == theirs.argmax(1)).mean()),
+            "mean_abs_diff": float(diff.mean()),
+            "max_abs_diff": float(diff.max()),
+            "accuracy_delta": r["accuracy"] - reference["accuracy"],
+        }
+    for r in results:
+        r.pop("probabilities", None)
+
+
+def run_isolated(name: str, args) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_evaluate_in_child, args=(name, args, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The child is gone (segfault, OOM kill, ...); a result put just before exiting may still be in the pipe
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            result = {"variant": name, "description": VARIANTS[name][1], "error": f"exit code {process.exitcode}"}
+        break
+    process.join()
+    return result
+
+
+def to_markdown(results: list[dict]) -> str:
+    lines = ["# Model variant evaluation", ""]
+    ok = [r for r in results if "error" not in r]
+    if ok:
+        lines += [f"Held-out images: {ok[0]['images']}. Over baseline is peak RSS minus RSS after imports "
+                  "and data loading, before the model was built.", "",
+                  "| Variant | Accuracy | Macro F1 | Artifact (MB) | Peak RSS (MB) | Over baseline (MB) | Load (s) | Notes |",
+                  "|---|---:|---:|---:|---:|---:|---:|---|"]
+        for r in ok:
+            lines.append(f"| {r['variant']} | {r['accuracy']:.4f} | {r['macro_f1']:.4f} | "
+                         f"{r['artifact_bytes'] / 1e6:.2f} | {r['peak_rss_mb']:.0f} | "
+                         f"{r['peak_rss_mb'] - r['baseline_rss_mb']:.0f} | {r['load_seconds']:.2f} | {r['notes']} |")
+        lines += ["", "## Per-class F1", "",
+                  "| Variant | " + " | ".join(EMOTIONS) + " |",
+                  "|---|" + "---:|" * len(EMOTIONS)]
+        for r in ok:
+            lines.append(f"| {r['variant']} | " + " | ".join(f"{r['per_class_f1'][e]:.3f}" for e in EMOTIONS) + " |")
+        compared = [r for r in ok if "parity" in r]
+        if compared:
+            lines += ["", "## Parity with the reference", "",
+                      "Image by image on the same held-out set; |Δp| is over the 7 EMOTIONS probabilities.", "",
+                      "| Variant | Reference | Top-1 agreement | Mean abs Δp | Max abs Δp | Accuracy Δ |",
+                      "|---|---|---:|---:|---:|---:|"]
+            for r in compared:
+                p = r["parity"]
+                lines.append(f"| {r['variant']} | {p['reference']} | {p['top1_agreement']:.4f} | "
+                             f"{p['mean_abs_diff']:.4f} | {p['max_abs_diff']:.4f} | {p['accuracy_delta']:+.4f} |")
+        lines += ["", "## Latency and throughput", "",
+                  "| Variant | Threads | Batch | p50 (ms) | p99 (ms) | Images/s |",
+                  "|---|---:|---:|---:|---:|---:|"]
+        for r in ok:
+            for run in r["runs"]:
+                lines.append(f"| {r['variant']} | {run['threads']} | {run['batch_size']} | {run['p50_ms']:.2f} | "
+                             f"{run['p99_ms']:.2f} | {run['images_per_second']:.1f} |")
+    failed = [r for r in results if "error" in r]
+    if failed:
+        lines += ["", "## Not evaluated", ""]
+        lines += [f"- {r['variant']}: {r['error']}" for r in failed]
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate model variants on a held-out set")
+    parser.add_argument("--data", required=True, help="Prepared dataset directory (dataset.py)")
+    parser.add_argument("--split", choices=["val", "all"], default="val",
+                        help="'val' = train.py's held-out split, 'all' = a separately prepared test set")
+    parser.add_argument("--val-fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--limit", type=int, help="Evaluate at most this many images")
+    parser.add_argument("--cnn", default="../worker/models/model_v1.pth", help="CNN state_dict")
+    parser.add_argument("--pruned", help="Pruned CNN written by prune.py")
+    parser.add_argument("--early-exit", help="CNN with exit heads written by train_early_exit.py")
+    parser.add_argument("--siglip", default="prithivMLmods/Facial-Emotion-Detection-SigLIP2")
+    parser.add_argument("--onnx-dir", default="onnx_cache", help="Exported ONNX models are cached here")
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), help=f"Any of {list(VARIANTS)}")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--eval-batch-size", type=int, default=64)
+    parser.add_argument("--timing-images", type=int, default=512, help="Images per latency run")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed batches before each latency run")
+    parser.add_argument("--output", default="variant_report", help="Writes <output>.json and <output>.md")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.variants if name not in VARIANTS]
+    if unknown:
+        parser.error(f"Unknown variants {unknown}; registered: {list(VARIANTS)}")
+
+    results = []
+    for name in args.variants:
+        print(f"Evaluating {name}...")
+        result = run_isolated(name, args)
+        if "error" in result:
+            print(f"  failed: {result['error']}")
+        else:
+            print(f"  accuracy {result['accuracy']:.4f}, macro F1 {result['macro_f1']:.4f}, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        results.append(result)
+    add_parity(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output + ".json", "w") as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+    with open(args.output + ".md", "w") as f:
+        f.write(to_markdown(results))
+    print(f"Report written to {args.output}.json and {args.output}.md")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Structured channel pruning for model_def.CNN.
+
+Channels are ranked, the lowest-ranked ones are cut out of the weights (the
+conv/linear layer producing them, the BatchNorm that follows and the input side
+of the next layer), and the result is a smaller dense CNN that is then
+fine-tuned with train.fit. No sparse kernels or special runtime are involved.
+
+    python prune.py --model ../worker/models/model_v1.pth --data data/fer \
+        --keep 0.25 --layers conv3 conv4 conv5 --output ../worker/models/model_v1_pruned.pth
+
+Every layer is followed by ReLU and then BatchNorm, so a channel's BatchNorm
+scale |gamma| measures how much of it reaches the next layer ("bn", the default).
+"l1" ranks by the L1 norm of the producing filters instead; conv1 has no
+BatchNorm of its own and is always ranked by L1.
+
+Per 48x48 image the default model spends about 118M MACs in conv3 (5x5 at
+24x24), 85M each in conv4 and conv5 and 42M in conv2, so conv3 is pruned by
+default along with conv4 and conv5.
+"""
+import argparse
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+from train import add_fit_arguments, export_checkpoint, fit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_def import CNN
+from model_loader import load_cnn
+
+# (producing layer, BatchNorm on its output or None, consuming layer), in widths order
+PRUNABLE = [
+    ("conv1", None, "conv2"),
+    ("conv2", "bn1", "conv3"),
+    ("conv3", "bn2", "conv4"),
+    ("conv4", "bn3", "conv5"),
+    ("conv5", "bn4", "fc1"),
+    ("fc1", "bn5", "fc2"),
+    ("fc2", "bn6", "fc3"),
+]
+LAYERS = [layer for layer, _, _ in PRUNABLE]
+
+# Spatial positions per conv5 channel after the last pool (3x3)
+FLATTEN_POSITIONS = 9
+
+
+def channel_scores(model: CNN, layer: str, norm: str | None, criterion: str) -> torch.Tensor:
+    if criterion == "bn" and norm is not None:
+        return getattr(model, norm).weight.detach().abs()
+    weight = getattr(model, layer).weight.detach()
+    return weight.abs().flatten(1).sum(dim=1)
+
+
+def select_channels(model: CNN, keep: dict, criterion: str) -> dict:
+    """Returns {layer: sorted indices of the channels kept}."""
+    selected = {}
+    for (layer, norm, _), width in zip(PRUNABLE, model.widths):
+        target = keep.get(layer, width)
+        if target >= width:
+            selected[layer] = torch.arange(width)
+            continue
+        scores = channel_scores(model, layer, norm, criterion)
+        selected[layer] = torch.sort(torch.topk(scores, target).indices).values
+    return selected
+
+
+def prune(model: CNN, keep: dict, criterion: str = "bn") -> CNN:
+    """Returns a new CNN keeping keep[layer] output channels of each listed layer."""
+    selected = select_channels(model, keep, criterion)
+    pruned = CNN(widths=[len(selected[layer]) for layer in LAYERS])
+    source, target = model.state_dict(), pruned.state_dict()
+
+    def input_index(consumer: str, producer: str) -> torch.Tensor:
+        index = selected[producer]
+        if consumer == "fc1":
+            # conv5 channel c occupies positions c*9 .. c*9+8 of the flattened features
+            index = (index[:, None] * FLATTEN_POSITIONS + torch.arange(FLATTEN_POSITIONS)).flatten()
+        return index
+
+    with torch.no_grad():
+        for name in target:
+            module, param = name.rsplit(".", 1)
+            tensor = source[name]
+            if module in selected and param in ("weight", "bias"):
+                tensor = tensor[selected[module]]
+            producer = next((layer for layer, _, consumer in PRUNABLE if consumer == module), None)
+            if producer is not None and param == "weight":
+                tensor = tensor[:, input_index(module, producer)]
+            norm_of = next((layer for layer, norm, _ in PRUNABLE if norm == module), None)
+            if norm_of is not None and param in ("weight", "bias", "running_mean", "running_var"):
+                tensor = tensor[selected[norm_of]]
+            target[name].copy_(tensor)
+
+        # A removed channel still fed its BatchNorm shift (beta) to the next layer;
+        # fold that into the next layer's bias (exact except at zero-padded borders)
+        for layer, norm, consumer in PRUNABLE:
+            if norm is None or len(selected[layer]) == model.widths[LAYERS.index(layer)]:
+                continue
+            removed = torch.ones(model.widths[LAYERS.index(layer)], dtype=torch.bool)
+            removed[selected[layer]] = False
+            beta = source[f"{norm}.bias"][removed]
+            weight = source[f"{consumer}.weight"]
+            if consumer == "fc1":
+                weight = weight.view(weight.shape[0], -1, FLATTEN_POSITIONS).sum(dim=2)
+            elif weight.dim() == 4:
+                weight = weight.sum(dim=(2, 3))
+            keep_rows = selected.get(consumer, torch.arange(weight.shape[0]))
+            target[f"{consumer}.bias"] += (weight[:, removed] @ beta)[keep_rows]
+    pruned.load_state_dict(target)
+    pruned.train(model.training)
+    return pruned
+
+
+def count_macs(widths) -> int:
+    """Multiply-accumulates for one 48x48 image."""
+    c1, c2, c3, c4, c5, f1, f2 = widths
+    return (48 * 48 * 1 * c1 * 9 + 48 * 48 * c1 * c2 * 9 + 24 * 24 * c2 * c3 * 25
+            + 12 * 12 * c3 * c4 * 9 + 6 * 6 * c4 * c5 * 9
+            + c5 * FLATTEN_POSITIONS * f1 + f1 * f2 + f2 * 7)
+
+
+def count_parameters(model: nn.Module) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
+def parse_keep(model: CNN, layers, keep: float, widths) -> dict:
+    if widths:
+        if len(widths) != len(LAYERS):
+            raise ValueError(f"--widths needs {len(LAYERS)} values ({', '.join(LAYERS)})")
+        return dict(zip(LAYERS, widths))
+    current = dict(zip(LAYERS, model.widths))
+    # Keep at least 8 channels so every layer stays usable
+    return {layer: max(8, int(round(current[layer] * keep))) for layer in layers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune CNN channels and fine-tune the slimmer model")
+    parser.add_argument("--model", required=True, help="Trained CNN (.pth) to prune")
+    parser.add_argument("--output", required=True, help="Pruned model with its architecture (.pth)")
+    parser.add_argument("--keep", type=float, default=0.25, help="Fraction of channels kept in --layers")
+    parser.add_argument("--layers", nargs="+", default=["conv3", "conv4", "conv5"], choices=LAYERS)
+    parser.add_argument("--widths", type=int, nargs="+", help=f"Explicit widths for {', '.join(LAYERS)}")
+    parser.add_argument("--criterion", choices=["bn", "l1"], default="bn")
+    add_fit_arguments(parser)
+    # Fine-tuning needs far fewer epochs than training from scratch
+    parser.set_defaults(epochs=10, lr=0.0005)
+    args = parser.parse_args()
+
+    model = load_cnn(args.model)
+    keep = parse_keep(model, args.layers, args.keep, args.widths)
+    pruned = prune(model, keep, args.criterion)
+
+    before, after = count_macs(model.widths), count_macs(pruned.widths)
+    print(f"Widths {list(model.widths)} -> {list(pruned.widths)}")
+    print(f"Parameters {count_parameters(model):,} -> {count_parameters(pruned):,}; "
+          f"MACs/image {before / 1e6:.1f}M -> {after / 1e6:.1f}M ({before / after:.1f}x fewer)")
+
+    if args.epochs > 0:
+        fit(args, pruned)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        torch.save(export_checkpoint(pruned), args.output)
+        print(f"Saved pruned model (not fine-tuned) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Training entry point for model_def.CNN (replaces notebooks/cnn.ipynb).
+
+    # once per dataset: decode the image folder into a uint8 memmap
+    python train.py prepare --images ../facialdata --data data/fer
+
+    # train; the best epoch is written as a plain state_dict the worker loads directly
+    python train.py fit --data data/fer --output ../worker/models/model_v1.pth \
+        --epochs 50 --workers 4 --bf16 --channels-last
+
+Optimiser, loss weighting and learning-rate schedule follow the notebook
+(Adam 1e-3, class weights 1/count, ReduceLROnPlateau on validation loss).
+Augmentation runs on whole batches after they leave the DataLoader.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+
+from dataset import MemmapFaces, augment, load_prepared, prepare, split_indices, to_input
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_def import CNN, DEFAULT_WIDTHS
+from model_loader import EMOTIONS
+
+
+def make_loader(dataset, batch_size: int, shuffle: bool, workers: int, pin_memory: bool):
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=workers,
+        pin_memory=pin_memory,
+        persistent_workers=workers > 0,
+        prefetch_factor=4 if workers > 0 else None,
+    )
+
+
+def autocast(device: torch.device, bf16: bool):
+    if not bf16:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
+def run_epoch(model, loader, criterion, device, args, optimizer=None):
+    """One pass over loader; trains if an optimizer is given. Returns (mean loss, accuracy)."""
+    training = optimizer is not None
+    model.train(training)
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    total_loss, correct, total, batches = 0.0, 0, 0, 0
+
+    with torch.set_grad_enabled(training):
+        for images, labels in loader:
+            images = images.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            inputs = to_input(images)
+            if training:
+                inputs = augment(inputs, hflip=args.hflip, vflip=args.vflip, max_shift=args.shift,
+                                 max_rotate=args.rotate, max_scale=args.scale)
+            inputs = inputs.contiguous(memory_format=memory_format)
+
+            with autocast(device, args.bf16):
+                outputs = model(inputs)
+            # CNN.forward returns log-probabilities; the loss is taken in float32
+            loss = criterion(outputs.float(), labels)
+
+            if training:
+                optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+
+            total_loss += loss.item()
+            correct += (outputs.argmax(1) == labels).sum().item()
+            total += labels.size(0)
+            batches += 1
+
+    return total_loss / max(batches, 1), correct / max(total, 1)
+
+
+def export_state_dict(model) -> dict:
+    """fp32, contiguous state_dict loadable by model_loader regardless of training format."""
+    return {k: v.detach().float().contiguous().cpu() if v.is_floating_point() else v.detach().cpu()
+            for k, v in model.state_dict().items()}
+
+
+def export_checkpoint(model):
+    """
+    What model_loader.load_cnn reads: a plain state_dict for the default
+    architecture (as before), {"arch", "state_dict"} for any other width.
+    """
+    if model.widths == DEFAULT_WIDTHS:
+        return export_state_dict(model)
+    return {"arch": model.arch(), "state_dict": export_state_dict(model)}
+
+
+def fit(args, model=None):
+    """Trains model (a fresh CNN if None) and writes the best epoch to args.output."""
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+
+    _, labels, meta = load_prepared(args.data)
+    if meta["classes"] != EMOTIONS:
+        raise ValueError(f"Prepared data has classes {meta['classes']}, expected {EMOTIONS}")
+    train_idx, val_idx = split_indices(len(labels), args.val_fraction, args.seed)
+    pin_memory = device.type == "cuda"
+    train_loader = make_loader(MemmapFaces(args.data, train_idx), args.batch_size, True, args.workers, pin_memory)
+    val_loader = make_loader(MemmapFaces(args.data, val_idx), args.batch_size * 2, False, args.workers, pin_memory)
+    print(f"Training on {len(train_idx)} images, validating on {len(val_idx)} ({device}, "
+          f"bf16={args.bf16}, channels_last={args.channels_last}, workers={args.workers})")
+
+    # Inverse-frequency class weights, as in the notebook
+    counts = np.bincount(labels[train_idx], minlength=len(EMOTIONS)).astype(np.float64)
+    weights = torch.tensor(1.0 / np.maximum(counts, 1), dtype=torch.float32, device=device)
+
+    model = (model if model is not None else CNN()).to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    criterion = nn.NLLLoss(weight=weights)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=3, min_lr=1e-6)
+
+    start_epoch, best_loss, history = 0, float("inf"), []
+    resume_path = os.path.join(args.checkpoint_dir, "last.pt") if args.checkpoint_dir else None
+    if args.resume and resume_path and os.path.exists(resume_path):
+        state = torch.load(resume_path, map_location="cpu")
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        start_epoch, best_loss, history = state["epoch"], state["best_loss"], state["history"]
+        # Otherwise the resumed epoch replays epoch 1's shuffle, augmentation and dropout
+        torch.set_rng_state(state["rng"])
+        print(f"Resumed from {resume_path} at epoch {start_epoch}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    for epoch in range(start_epoch, args.epochs):
+        started = time.perf_counter()
+        train_loss, train_acc = run_epoch(model, train_loader, criterion, device, args, optimizer)
+        val_loss, val_acc = run_epoch(model, val_loader, criterion, device, args)
+        scheduler.step(val_loss)
+        elapsed = time.perf_counter() - started
+
+        history.append({
+            "epoch": epoch + 1, "train_loss": train_loss, "train_acc": train_acc,
+            "val_loss": val_loss, "val_acc": val_acc, "lr": optimizer.param_groups[0]['lr'],
+            "seconds": elapsed, "images_per_second": len(train_idx) / elapsed,
+        })
+        print(f"Epoch {epoch+1:>2}/{args.epochs} | Train Loss: {train_loss:.4f} | LR: {optimizer.param_groups[0]['lr']:.6f} | "
+              f"Train Acc: {train_acc:.4f} | Val Loss: {val_loss:.4f} | Val Acc: {val_acc:.4f} | "
+              f"{len(train_idx) / elapsed:.0f} img/s")
+
+        if val_loss < best_loss:
+            best_loss = val_loss
+            torch.save(export_checkpoint(model), args.output)
+            print(f"Saved best model to {args.output}")
+
+        if resume_path:
+            os.makedirs(args.checkpoint_dir, exist_ok=True)
+            torch.save({
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "epoch": epoch + 1,
+                "best_loss": best_loss,
+                "history": history,
+                "rng": torch.get_rng_state(),
+            }, resume_path + ".tmp")
+            os.replace(resume_path + ".tmp", resume_path)
+
+    with open(os.path.splitext(args.output)[0] + ".json", "w") as f:
+        json.dump({"data": os.path.abspath(args.data), "seed": args.seed, "val_fraction": args.val_fraction,
+                   "best_val_loss": best_loss, "history": history}, f, indent=2)
+    print("Training complete.")
+
+
+def add_fit_arguments(parser):
+    """Options shared by 'fit' and the fine-tuning step of prune.py."""
+    parser.add_argument("--data", required=True, help="Directory written by 'prepare'")
+    parser.add_argument("--checkpoint-dir", help="Resumable per-epoch checkpoints")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--val-fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=2, help="DataLoader worker processes")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--cpu", action="store_true", help="Train on CPU even if CUDA is available")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast")
+    parser.add_argument("--channels-last", action="store_true", help="NHWC memory format")
+    parser.add_argument("--hflip", type=float, default=0.5)
+    parser.add_argument("--vflip", type=float, default=0.5, help="The notebook also flipped vertically")
+    parser.add_argument("--shift", type=float, default=0.1, help="Max translation (fraction of the image)")
+    parser.add_argument("--rotate", type=float, default=10.0, help="Max rotation (degrees)")
+    parser.add_argument("--scale", type=float, default=0.1, help="Max zoom in/out")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the 48x48 emotion CNN")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prep = commands.add_parser("prepare", help="Decode an image folder into a uint8 memmap")
+    prep.add_argument("--images", required=True, help="Folder with one sub-directory per emotion")
+    prep.add_argument("--data", required=True, help="Output directory for the prepared dataset")
+    prep.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    train = commands.add_parser("fit", help="Train on a prepared dataset")
+    train.add_argument("--output", default="../worker/models/model.pth", help="Best state_dict (.pth)")
+    add_fit_arguments(train)
+
+    args = parser.parse_args()
+    if args.command == "prepare":
+        prepare(args.images, args.data, args.workers)
+    else:
+        fit(args)
+
+
+if __name__ == "__main__":
+    main()
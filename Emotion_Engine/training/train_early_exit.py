@@ -0,0 +1,392 @@
+"""
+Early-exit heads for model_def.CNN (model_def.EarlyExitCNN).
+
+Small classifiers after pool2 and pool3 answer the easy faces. In eval mode the
+worker stops at the first head whose top probability reaches that head's
+threshold, and the rest of the batch continues through the remaining stages.
+
+    # heads on top of an already trained CNN (backbone frozen), then calibration
+    python train_early_exit.py fit --init ../worker/models/model_v1.pth --data data/fer \
+        --output ../worker/models/model_v1_exits.pth --epochs 10
+
+    # recalibrate an existing checkpoint for another agreement target
+    python train_early_exit.py calibrate --model ../worker/models/model_v1_exits.pth \
+        --data data/fer --target 0.99
+
+Without --init the backbone and heads are trained jointly from scratch, with
+the head losses weighted by --exit-weight.
+
+train.py's validation split is divided three ways: --selection-fraction picks
+the best training epoch, and of the rest a --calibration-fraction calibrates
+the thresholds and the remainder is held out for the report. Each exit in turn
+gets the smallest threshold at which the samples it would answer (of those
+still left) agree with the full network's prediction at least --target of the
+time. The trade-off report (<output>_exits.json/.md) is computed on the
+held-out part. For each target in --targets it lists the exit rates, accuracy,
+agreement with the full network, MACs per image and measured batched latency.
+model_loader.load_cnn reads the thresholds from the checkpoint.
+
+The default CNN spends about 43M MACs up to pool1, 118M in conv3, 85M each in
+conv4 and conv5, and 1.3M in the fully connected layers. A sample that leaves
+at pool2 skips about half the work, and one that leaves at pool3 about a quarter.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from dataset import MemmapFaces, augment, load_prepared, split_indices, to_input
+from train import add_fit_arguments, autocast, export_state_dict, make_loader
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_def import EXIT_POINTS, EarlyExitCNN
+from model_loader import EMOTIONS, load_cnn
+
+
+def stage_macs(widths) -> list[int]:
+    """Multiply-accumulates per 48x48 image of stage1..stage4 and the classifier."""
+    c1, c2, c3, c4, c5, f1, f2 = widths
+    return [48 * 48 * (1 * c1 * 9 + c1 * c2 * 9), 24 * 24 * c2 * c3 * 25, 12 * 12 * c3 * c4 * 9,
+            6 * 6 * c4 * c5 * 9, c5 * 9 * f1 + f1 * f2 + f2 * 7]
+
+
+def exit_macs(model: EarlyExitCNN) -> list[int]:
+    """MACs spent on a sample answered by each exit; the last entry is the full network."""
+    stages = stage_macs(model.widths)
+    costs, spent = [], 0
+    for name, head in zip(model.exits, model.heads):
+        stage = EXIT_POINTS[name]
+        spent += head.fc1.in_features * head.fc1.out_features + head.fc2.in_features * head.fc2.out_features
+        costs.append(sum(stages[:stage]) + spent)
+    costs.append(sum(stages) + spent)
+    return costs
+
+
+def build_model(args) -> EarlyExitCNN:
+    """EarlyExitCNN with the backbone of --init (if given) and fresh heads."""
+    if not args.init:
+        return EarlyExitCNN(exits=args.exits, head_hidden=args.head_hidden)
+    backbone = load_cnn(args.init)
+    model = EarlyExitCNN(backbone.widths, exits=args.exits, head_hidden=args.head_hidden)
+    missing, unexpected = model.load_state_dict(backbone.state_dict(), strict=False)
+    if unexpected or any(not key.startswith("heads.") and key != "thresholds" for key in missing):
+        raise ValueError(f"{args.init} does not match the CNN backbone")
+    for param in model.parameters():
+        param.requires_grad_(False)
+    for param in model.heads.parameters():
+        param.requires_grad_(True)
+    return model
+
+
+def run_epoch(model, loader, criterion, device, args, optimizer=None):
+    """
+    One pass over loader; trains if an optimizer is given. The loss is the full
+    network's plus --exit-weight times each head's; with a frozen backbone only
+    the head losses count. Returns (mean loss, accuracy of every exit).
+    """
+    training = optimizer is not None
+    frozen = args.init is not None
+    model.train(training and not frozen)
+    if training and frozen:
+        # The frozen backbone keeps its BatchNorm statistics and skips dropout
+        model.heads.train()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    total_loss, batches, total = 0.0, 0, 0
+    correct = [0] * (len(model.exits) + 1)
+
+    with torch.set_grad_enabled(training):
+        for images, labels in loader:
+            images = images.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            inputs = to_input(images)
+            if training:
+                inputs = augment(inputs, hflip=args.hflip, vflip=args.vflip, max_shift=args.shift,
+                                 max_rotate=args.rotate, max_scale=args.scale)
+            inputs = inputs.contiguous(memory_format=memory_format)
+
+            with autocast(device, args.bf16):
+                outputs = model.forward_exits(inputs)
+            losses = [criterion(output.float(), labels) for output in outputs]
+            loss = args.exit_weight * sum(losses[:-1])
+            if not frozen:
+                loss = loss + losses[-1]
+
+            if training:
+                optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+
+            total_loss += loss.item()
+            for i, output in enumerate(outputs):
+                correct[i] += (output.argmax(1) == labels).sum().item()
+            total += labels.size(0)
+            batches += 1
+
+    return total_loss / max(batches, 1), [c / max(total, 1) for c in correct]
+
+
+def collect(model, loader, device, args):
+    """Every exit's log-probabilities (float32, CPU) and the labels for a whole split."""
+    model.eval()
+    outputs, labels = [[] for _ in range(len(model.exits) + 1)], []
+    with torch.no_grad():
+        for images, batch_labels in loader:
+            inputs = to_input(images.to(device))
+            with autocast(device, args.bf16):
+                for i, output in enumerate(model.forward_exits(inputs)):
+                    outputs[i].append(output.float().cpu())
+            labels.append(batch_labels)
+    return [torch.cat(o) for o in outputs], torch.cat(labels)
+
+
+def calibrate(outputs, target: float, min_samples: int) -> list[float]:
+    """
+    Per exit, the smallest confidence threshold at which the samples it would
+    answer agree with the full network at least `target` of the time. Exits are
+    calibrated in order on the samples the earlier ones left. An exit that never
+    reaches the target gets inf (never exits).
+    """
+    final = outputs[-1].argmax(1)
+    remaining = torch.ones(len(final), dtype=torch.bool)
+    thresholds = []
+    for log_probs in outputs[:-1]:
+        confidence, prediction = log_probs[remaining].exp().max(1)
+        agree = (prediction == final[remaining]).float()
+        order = torch.argsort(confidence, descending=True)
+        # Agreement among the k most confident samples, for every k
+        precision = agree[order].cumsum(0) / torch.arange(1, len(order) + 1)
+        passing = (precision >= target).nonzero()
+        passing = passing[passing >= min_samples - 1]
+        if len(passing) == 0:
+            thresholds.append(float("inf"))
+            continue
+        threshold = confidence[order[passing.max()]].item()
+        thresholds.append(threshold)
+        remaining &= ~(log_probs.exp().max(1).values >= threshold)
+    return thresholds
+
+
+def simulate(outputs, labels, thresholds, costs) -> dict:
+    """What forward_early would answer on a collected split with these thresholds."""
+    count = len(labels)
+    exit_at = torch.full((count,), len(outputs) - 1, dtype=torch.long)
+    remaining = torch.ones(count, dtype=torch.bool)
+    for i, (log_probs, threshold) in enumerate(zip(outputs[:-1], thresholds)):
+        done = remaining & (log_probs.exp().max(1).values >= threshold)
+        exit_at[done] = i
+        remaining &= ~done
+    predictions = torch.stack(outputs)[exit_at, torch.arange(count)].argmax(1)
+    rates = torch.bincount(exit_at, minlength=len(outputs)).float() / count
+    return {
+        "exit_rates": rates.tolist(),
+        "accuracy": (predictions == labels).float().mean().item(),
+        "agreement": (predictions == outputs[-1].argmax(1)).float().mean().item(),
+        "mean_macs": float((rates * torch.tensor(costs, dtype=torch.float64)).sum()),
+    }
+
+
+def measure_latency(model, images: torch.Tensor, batch_size: int, thresholds, repeats: int = 3) -> float:
+    """Best mean milliseconds per image of forward_early over images, in batches of batch_size."""
+    model.eval()
+    inputs = to_input(images)
+    best = float("inf")
+    with torch.no_grad():
+        model.forward_early(inputs[:batch_size], thresholds)
+        for _ in range(repeats):
+            started = time.perf_counter()
+            for start in range(0, len(inputs), batch_size):
+                model.forward_early(inputs[start:start + batch_size], thresholds)
+            best = min(best, (time.perf_counter() - started) * 1000 / len(inputs))
+    return best
+
+
+def trade_off(model, calibration, evaluation, images, args) -> dict:
+    """Report rows for the full network and every --targets value (plus --target)."""
+    costs = exit_macs(model)
+    full = [float("inf")] * len(model.exits)
+    names = list(model.exits) + ["final"]
+    rows = []
+    for target in [None] + sorted(set(args.targets) | {args.target}):
+        thresholds = full if target is None else calibrate(calibration[0], target, args.min_samples)
+        row = {"target": target, "thresholds": thresholds,
+               **simulate(evaluation[0], evaluation[1], thresholds, costs)}
+        row["exit_rates"] = dict(zip(names, row["exit_rates"]))
+        row["relative_macs"] = row["mean_macs"] / costs[-1]
+        row["ms_per_image"] = {str(b): measure_latency(model, images, b, torch.tensor(thresholds))
+                               for b in args.batch_sizes}
+        rows.append(row)
+    return {"exits": names, "exit_macs": costs, "calibration_images": len(calibration[1]),
+            "evaluation_images": len(evaluation[1]), "rows": rows}
+
+
+def to_markdown(report: dict) -> str:
+    names = report["exits"]
+    batch_sizes = list(report["rows"][0]["ms_per_image"])
+    lines = [
+        f"Calibrated on {report['calibration_images']} images, evaluated on {report['evaluation_images']}. "
+        "MACs per exit: " + ", ".join(f"{n} {m / 1e6:.1f}M" for n, m in zip(names, report["exit_macs"])) + ".",
+        "",
+        "| target | thresholds | " + " | ".join(f"exit {n}" for n in names) + " | accuracy | agreement | MACs "
+        "| " + " | ".join(f"ms/img @{b}" for b in batch_sizes) + " |",
+        "|" + "---|" * (len(names) + 5 + len(batch_sizes)),
+    ]
+    for row in report["rows"]:
+        target = "full" if row["target"] is None else f"{row['target']:.3f}"
+        thresholds = ", ".join("-" if t == float("inf") else f"{t:.3f}" for t in row["thresholds"])
+        lines.append(
+            f"| {target} | {thresholds} | "
+            + " | ".join(f"{row['exit_rates'][n]:.1%}" for n in names)
+            + f" | {row['accuracy']:.4f} | {row['agreement']:.4f} | {row['mean_macs'] / 1e6:.0f}M "
+            f"({row['relative_macs']:.0%}) | "
+            + " | ".join(f"{row['ms_per_image'][b]:.3f}" for b in batch_sizes) + " |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def calibration_splits(args):
+    """
+    (training, selection, calibration, evaluation) indices; the last three are
+    disjoint parts of train.py's validation split.
+    """
+    _, labels, meta = load_prepared(args.data)
+    if meta["classes"] != EMOTIONS:
+        raise ValueError(f"Prepared data has classes {meta['classes']}, expected {EMOTIONS}")
+    train_idx, val_idx = split_indices(len(labels), args.val_fraction, args.seed)
+    rest, selection = split_indices(len(val_idx), args.selection_fraction, args.seed)
+    evaluation, calibration = split_indices(len(rest), args.calibration_fraction, args.seed)
+    return train_idx, val_idx[selection], val_idx[rest[calibration]], val_idx[rest[evaluation]]
+
+
+def calibrate_and_report(model, args, device):
+    """Sets model.thresholds for --target, saves it to args.output and writes the trade-off report."""
+    _, _, calibration_idx, evaluation_idx = calibration_splits(args)
+    model = model.to(device)
+    calibration = collect(model, make_loader(MemmapFaces(args.data, calibration_idx), 256, False, 0, False),
+                          device, args)
+    evaluation = collect(model, make_loader(MemmapFaces(args.data, evaluation_idx), 256, False, 0, False),
+                         device, args)
+    model.thresholds.copy_(torch.tensor(calibrate(calibration[0], args.target, args.min_samples)))
+    print("Thresholds " + ", ".join(f"{n}={t:.3f}" for n, t in zip(model.exits, model.thresholds.tolist())))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.save({"arch": model.arch(), "state_dict": export_state_dict(model)}, args.output)
+    print(f"Saved {args.output}")
+
+    timing = MemmapFaces(args.data, evaluation_idx[:args.timing_images])
+    images, _ = timing[np.arange(len(timing))]
+    report = trade_off(model.cpu(), calibration, evaluation, images, args)
+    base = os.path.splitext(args.output)[0] + "_exits"
+    with open(base + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(base + ".md", "w") as f:
+        f.write(to_markdown(report))
+    print(to_markdown(report))
+    print(f"Report written to {base}.json and {base}.md")
+
+
+def fit(args):
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+
+    _, labels, _ = load_prepared(args.data)
+    # The best epoch is picked on images that neither calibration nor the report use
+    train_idx, selection_idx, _, _ = calibration_splits(args)
+    pin_memory = device.type == "cuda"
+    train_loader = make_loader(MemmapFaces(args.data, train_idx), args.batch_size, True, args.workers, pin_memory)
+    val_loader = make_loader(MemmapFaces(args.data, selection_idx), args.batch_size * 2, False, args.workers,
+                             pin_memory)
+
+    counts = np.bincount(labels[train_idx], minlength=len(EMOTIONS)).astype(np.float64)
+    weights = torch.tensor(1.0 / np.maximum(counts, 1), dtype=torch.float32, device=device)
+    criterion = nn.NLLLoss(weight=weights)
+
+    model = build_model(args).to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=args.lr)
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=3, min_lr=1e-6)
+    names = list(model.exits) + ["final"]
+    print(f"Training {'heads ' + ', '.join(model.exits) if args.init else 'backbone and heads'} on "
+          f"{len(train_idx)} images, validating on {len(selection_idx)} ({device})")
+
+    best_loss, best_state = float("inf"), None
+    for epoch in range(args.epochs):
+        started = time.perf_counter()
+        train_loss, _ = run_epoch(model, train_loader, criterion, device, args, optimizer)
+        val_loss, val_acc = run_epoch(model, val_loader, criterion, device, args)
+        scheduler.step(val_loss)
+        print(f"Epoch {epoch+1:>2}/{args.epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f} | "
+              + " | ".join(f"{n} {a:.4f}" for n, a in zip(names, val_acc))
+              + f" | {time.perf_counter() - started:.0f}s")
+        if val_loss < best_loss:
+            best_loss = val_loss
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    calibrate_and_report(model.to(memory_format=torch.contiguous_format), args, device)
+
+
+def add_calibration_arguments(parser):
+    parser.add_argument("--target", type=float, default=0.97,
+                        help="Required agreement with the full network of the samples an exit answers")
+    parser.add_argument("--targets", type=float, nargs="+", default=[0.9, 0.95, 0.97, 0.99],
+                        help="Agreement targets compared in the report")
+    parser.add_argument("--min-samples", type=int, default=50,
+                        help="An exit must answer at least this many calibration images to be enabled")
+    parser.add_argument("--selection-fraction", type=float, default=0.2,
+                        help="Share of the validation split used to pick the best epoch")
+    parser.add_argument("--calibration-fraction", type=float, default=0.5,
+                        help="Share of the validation split left after selection used for calibration; "
+                             "the rest is the report's")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32], help="Batch sizes timed in the report")
+    parser.add_argument("--timing-images", type=int, default=512)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and calibrate early-exit heads for the emotion CNN")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("fit", help="Train the exit heads, then calibrate")
+    train.add_argument("--init", help="Trained CNN; its backbone is frozen and only the heads are trained")
+    train.add_argument("--output", default="../worker/models/model_exits.pth")
+    train.add_argument("--exits", nargs="+", default=["pool2", "pool3"], choices=list(EXIT_POINTS))
+    train.add_argument("--head-hidden", type=int, default=128)
+    train.add_argument("--exit-weight", type=float, default=0.5, help="Weight of each head's loss")
+    add_fit_arguments(train)
+    add_calibration_arguments(train)
+
+    recalibrate = commands.add_parser("calibrate", help="Recalibrate the thresholds of an EarlyExitCNN checkpoint")
+    recalibrate.add_argument("--model", required=True)
+    recalibrate.add_argument("--output", help="Defaults to overwriting --model")
+    recalibrate.add_argument("--data", required=True)
+    recalibrate.add_argument("--val-fraction", type=float, default=0.2)
+    recalibrate.add_argument("--seed", type=int, default=0)
+    recalibrate.add_argument("--bf16", action="store_true")
+    add_calibration_arguments(recalibrate)
+
+    args = parser.parse_args()
+    if args.command == "fit":
+        if args.resume or args.checkpoint_dir:
+            parser.error("--resume/--checkpoint-dir are not supported for exit heads")
+        fit(args)
+    else:
+        model = load_cnn(args.model)
+        if not isinstance(model, EarlyExitCNN):
+            parser.error(f"{args.model} has no exit heads; train them with 'fit --init'")
+        args.output = args.output or args.model
+        calibrate_and_report(model, args, torch.device("cpu"))
+
+
+if __name__ == "__main__":
+    main()
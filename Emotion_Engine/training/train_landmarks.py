@@ -0,0 +1,202 @@
+"""
+Training entry point for model_def.EmbeddingMLP, the classifier behind
+SendEncryptedEmbedding.
+
+    # once per dataset: run MediaPipe Face Mesh over an image folder
+    python train_landmarks.py extract --images ../facialdata --output data/landmarks.npz
+
+    # train; writes {"arch", "state_dict"} for the worker's EMBEDDING_MODEL_PATH
+    python train_landmarks.py fit --data data/landmarks.npz --output ../worker/models/landmarks_v1.pth
+
+The .npz holds features (N, D) float32 and labels (N,) int64 indices into
+EMOTIONS, so vectors from another extractor (any fixed-length embedding) can
+be trained on as well; pass --point-dims 0 if they are not x, y, z points.
+The whole dataset fits in memory and an epoch takes seconds on a CPU.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from dataset import scan_folder, split_indices
+from train import export_state_dict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../worker'))
+
+from model_def import EmbeddingMLP
+from model_loader import EMOTIONS
+
+# FER images are 48x48; Face Mesh finds far more faces once they are upscaled
+EXTRACT_SIZE = 192
+
+_face_mesh = None
+
+
+def _landmarks(path: str):
+    """(478 * 3,) float32 x, y, z of the first face found, or None."""
+    global _face_mesh
+    if _face_mesh is None:
+        import mediapipe as mp
+        # refine_landmarks adds the 10 iris points, matching the device's Face Landmarker
+        _face_mesh = mp.solutions.face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1,
+                                                     refine_landmarks=True)
+    from PIL import Image
+    with Image.open(path) as img:
+        rgb = np.asarray(img.convert("RGB").resize((EXTRACT_SIZE, EXTRACT_SIZE), Image.BILINEAR))
+    result = _face_mesh.process(rgb)
+    if not result.multi_face_landmarks:
+        return None
+    points = result.multi_face_landmarks[0].landmark
+    return np.array([(p.x, p.y, p.z) for p in points], dtype=np.float32).reshape(-1)
+
+
+def extract(root: str, output: str, workers: int = os.cpu_count() or 1):
+    samples = scan_folder(root)
+    if not samples:
+        raise ValueError(f"No images found under {root}")
+
+    features, labels, missed = [], [], 0
+    with Pool(workers) as pool:
+        for i, vector in enumerate(pool.imap(_landmarks, [path for path, _ in samples], chunksize=64)):
+            if vector is None:
+                missed += 1
+            else:
+                features.append(vector)
+                labels.append(samples[i][1])
+            if (i + 1) % 5000 == 0:
+                print(f"Processed {i + 1}/{len(samples)} images")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    np.savez(output, features=np.stack(features), labels=np.array(labels, dtype=np.int64),
+             classes=np.array(EMOTIONS))
+    print(f"Wrote {len(features)} landmark vectors to {output} (no face found in {missed} images)")
+
+
+def load_features(path: str):
+    with np.load(path) as data:
+        features, labels = data["features"].astype(np.float32), data["labels"].astype(np.int64)
+        if "classes" in data and list(data["classes"]) != EMOTIONS:
+            raise ValueError(f"{path} has classes {list(data['classes'])}, expected {EMOTIONS}")
+    return features, labels
+
+
+def augment(x: torch.Tensor, point_dims: int, noise: float, rotate: float) -> torch.Tensor:
+    """Jitter on already normalised vectors: in-plane rotation of the points plus Gaussian noise."""
+    if point_dims >= 2 and rotate > 0:
+        points = x.reshape(x.shape[0], -1, point_dims).clone()
+        angle = torch.empty(x.shape[0], device=x.device).uniform_(-rotate, rotate).deg2rad()
+        cos, sin = angle.cos()[:, None], angle.sin()[:, None]
+        px, py = points[..., 0].clone(), points[..., 1].clone()
+        points[..., 0] = cos * px - sin * py
+        points[..., 1] = sin * px + cos * py
+        x = points.reshape(x.shape[0], -1)
+    if noise > 0:
+        x = x + noise * torch.randn_like(x)
+    return x
+
+
+def fit(args):
+    torch.manual_seed(args.seed)
+    features, labels = load_features(args.data)
+    train_idx, val_idx = split_indices(len(labels), args.val_fraction, args.seed)
+
+    model = EmbeddingMLP(input_dim=features.shape[1], hidden=args.hidden, point_dims=args.point_dims,
+                         dropout=args.dropout)
+    x = torch.from_numpy(features)
+    y = torch.from_numpy(labels)
+    with torch.no_grad():
+        # Feature statistics of the (position/scale normalised) training set travel with the weights
+        normalized = model.normalize_points(x[train_idx])
+        model.mean.copy_(normalized.mean(dim=0))
+        model.std.copy_(normalized.std(dim=0).clamp_min(1e-6))
+    print(f"Training on {len(train_idx)} vectors of {features.shape[1]} values, validating on {len(val_idx)}")
+
+    counts = np.bincount(labels[train_idx], minlength=len(EMOTIONS)).astype(np.float64)
+    criterion = nn.NLLLoss(weight=torch.tensor(1.0 / np.maximum(counts, 1), dtype=torch.float32))
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=5, min_lr=1e-6)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    best_loss, history = float("inf"), []
+    for epoch in range(args.epochs):
+        started = time.perf_counter()
+        model.train()
+        order = torch.from_numpy(train_idx)[torch.randperm(len(train_idx))]
+        train_loss, batches = 0.0, 0
+        for start in range(0, len(order), args.batch_size):
+            batch = order[start:start + args.batch_size]
+            if len(batch) < 2:
+                continue  # BatchNorm needs more than one sample
+            # Augment after the per-sample normalisation; rotation leaves it unchanged when forward() redoes it
+            inputs = augment(model.normalize_points(x[batch]), args.point_dims, args.noise, args.rotate)
+            loss = criterion(model(inputs), y[batch])
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()
+            batches += 1
+
+        model.eval()
+        with torch.no_grad():
+            outputs = model(x[val_idx])
+            val_loss = criterion(outputs, y[val_idx]).item()
+            val_acc = (outputs.argmax(1) == y[val_idx]).float().mean().item()
+        scheduler.step(val_loss)
+        elapsed = time.perf_counter() - started
+
+        history.append({"epoch": epoch + 1, "train_loss": train_loss / max(batches, 1), "val_loss": val_loss,
+                        "val_acc": val_acc, "lr": optimizer.param_groups[0]['lr'], "seconds": elapsed})
+        print(f"Epoch {epoch+1:>3}/{args.epochs} | Train Loss: {train_loss / max(batches, 1):.4f} | "
+              f"Val Loss: {val_loss:.4f} | Val Acc: {val_acc:.4f} | {elapsed:.1f}s")
+
+        if val_loss < best_loss:
+            best_loss = val_loss
+            torch.save({"arch": model.arch(), "state_dict": export_state_dict(model)}, args.output)
+
+    with open(os.path.splitext(args.output)[0] + ".json", "w") as f:
+        json.dump({"data": os.path.abspath(args.data), "seed": args.seed, "val_fraction": args.val_fraction,
+                   "best_val_loss": best_loss, "history": history}, f, indent=2)
+    print(f"Saved best model to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the landmark/embedding MLP")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ext = commands.add_parser("extract", help="MediaPipe Face Mesh landmarks for an image folder")
+    ext.add_argument("--images", required=True, help="Folder with one sub-directory per emotion")
+    ext.add_argument("--output", required=True, help="Output .npz")
+    ext.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    train = commands.add_parser("fit", help="Train on an .npz of features and labels")
+    train.add_argument("--data", required=True, help=".npz written by 'extract'")
+    train.add_argument("--output", default="../worker/models/landmarks.pth")
+    train.add_argument("--hidden", type=int, nargs="+", default=[256, 128])
+    train.add_argument("--point-dims", type=int, default=3, help="Values per landmark, 0 for plain embeddings")
+    train.add_argument("--dropout", type=float, default=0.2)
+    train.add_argument("--epochs", type=int, default=100)
+    train.add_argument("--batch-size", type=int, default=256)
+    train.add_argument("--lr", type=float, default=0.001)
+    train.add_argument("--weight-decay", type=float, default=0.0001)
+    train.add_argument("--val-fraction", type=float, default=0.2)
+    train.add_argument("--seed", type=int, default=0)
+    train.add_argument("--noise", type=float, default=0.01, help="Gaussian noise on normalised vectors")
+    train.add_argument("--rotate", type=float, default=10.0, help="Max in-plane rotation (degrees)")
+
+    args = parser.parse_args()
+    if args.command == "extract":
+        extract(args.images, args.output, args.workers)
+    else:
+        fit(args)
+
+
+if __name__ == "__main__":
+    main()
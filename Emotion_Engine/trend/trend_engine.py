@@ -0,0 +1,335 @@
+"""
+Batch Trend Engine: weekly emotion distributions, rolling baselines and anomaly
+scores per student, computed from `user_emotion` exports.
+
+Input files are CSV or Parquet exports with the columns written by
+worker/supabase_client.save_user_emotion: userId, Emotion, TimeStamp.
+
+All aggregation is done on a dense (users, weeks, emotions) count tensor with
+NumPy, so the cost is a handful of array passes regardless of the number of
+students. State is checkpointed to an .npz file; each run only folds in days
+after the last complete day already in the checkpoint, skips export files that
+are unchanged and fully folded in, and rescores only the weeks the new rows can
+affect (the touched weeks plus their baseline window).
+
+The worker writes naive local timestamps, which are bucketed into days as they
+are. Timestamps with an offset (e.g. a timestamptz export) are converted to
+--timezone first.
+
+    python trend_engine.py --input exports/*.parquet --checkpoint trend_state.npz \
+        --output weekly_scores.parquet
+"""
+import argparse
+import datetime
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+# Same order as worker/model_loader.EMOTIONS
+EMOTIONS = [
+"Angry",
+"Disgust",
+"Fear",
+"Happy",
+"Sad",
+"Surprise",
+"Neutral"
+]
+
+NEGATIVE_EMOTIONS = ["Angry", "Disgust", "Fear", "Sad"]
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def week_of(days: np.ndarray) -> np.ndarray:
+    """Monday-aligned week index for days since the epoch (1970-01-01 was a Thursday)."""
+    return (days + 3) // 7
+
+
+def week_start(weeks: np.ndarray) -> np.ndarray:
+    return EPOCH + (weeks * 7 - 3).astype("timedelta64[D]")
+
+
+def local_days(timestamps: pd.Series, timezone: str) -> np.ndarray:
+    """Days since the epoch of ISO timestamps; ones with an offset are converted to timezone first."""
+    parsed = pd.to_datetime(timestamps, format="ISO8601")
+    if parsed.dt.tz is not None:
+        parsed = parsed.dt.tz_convert(timezone).dt.tz_localize(None)
+    return parsed.to_numpy().astype("datetime64[D]").astype(np.int64)
+
+
+def read_exports(paths, after_day: int | None, until_day: int, timezone: str = "UTC", seen: dict | None = None):
+    """
+    Loads exports and returns (user codes, unique uids, emotion codes, days since
+    epoch) for rows with after_day < day <= until_day. Unknown emotion labels are
+    dropped; user codes index into the unique uids.
+
+    seen maps each path read by earlier runs to (size, mtime_ns, last day in the
+    file) and is updated in place. A file that has not changed since and has no
+    rows after after_day is skipped. Rows are filtered per file, before the
+    files are concatenated.
+    """
+    frames = []
+    for path in paths:
+        stat = os.stat(path)
+        previous = seen.get(path) if seen is not None else None
+        if (previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns)
+                and after_day is not None and previous[2] <= after_day):
+            continue
+        if path.endswith(".parquet"):
+            frame = pd.read_parquet(path, columns=["userId", "Emotion", "TimeStamp"])
+        else:
+            frame = pd.read_csv(path, usecols=["userId", "Emotion", "TimeStamp"])
+
+        days = local_days(frame["TimeStamp"], timezone)
+        codes = pd.Categorical(frame["Emotion"], categories=EMOTIONS).codes.astype(np.int64)
+        if seen is not None:
+            seen[path] = (stat.st_size, stat.st_mtime_ns, int(days.max()) if len(days) else -1)
+
+        keep = (codes >= 0) & (days <= until_day)
+        if after_day is not None:
+            keep &= days > after_day
+        frames.append(pd.DataFrame({"userId": frame["userId"].to_numpy()[keep], "code": codes[keep], "day": days[keep]}))
+
+    data = pd.concat(frames, ignore_index=True) if frames else None
+    if data is None or data.empty:
+        empty = np.array([], dtype=np.int64)
+        return empty, np.array([], dtype=str), empty, empty
+    user_codes, uids = pd.factorize(data["userId"])
+    return user_codes, np.asarray(uids, dtype=str), data["code"].to_numpy(), data["day"].to_numpy()
+
+
+class TrendState:
+    """
+    Dense weekly count tensor for all users seen so far.
+
+    Weeks before final_week can no longer receive rows. history holds, per user,
+    the (count, sum, sum of squares) of their valid divergences in those weeks,
+    which is all anomaly_z needs from them. files is read_exports' seen map.
+    """
+
+    def __init__(self, users=None, first_week=0, counts=None, last_day=None, final_week=None, history=None,
+                 files=None):
+        self.users = users if users is not None else np.array([], dtype=str)
+        self.first_week = first_week
+        self.counts = counts if counts is not None else np.zeros((0, 0, len(EMOTIONS)), dtype=np.int64)
+        self.last_day = last_day
+        self.final_week = final_week if final_week is not None else first_week
+        self.history = history if history is not None else np.zeros((len(self.users), 3), dtype=np.float64)
+        self.files = files if files is not None else {}
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path, allow_pickle=False) as state:
+            last_day = int(state["last_day"])
+            # Checkpoints written before incremental scoring are rescored in full once
+            if "final_week" not in state:
+                return cls(state["users"], int(state["first_week"]), state["counts"],
+                           last_day if last_day >= 0 else None)
+            files = {path: (int(size), int(mtime), int(day)) for path, size, mtime, day in zip(
+                state["files"], state["file_sizes"], state["file_mtimes"], state["file_last_days"])}
+            return cls(state["users"], int(state["first_week"]), state["counts"], last_day if last_day >= 0 else None,
+                       int(state["final_week"]), state["history"], files)
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            users=self.users,
+            first_week=self.first_week,
+            counts=self.counts,
+            last_day=-1 if self.last_day is None else self.last_day,
+            final_week=self.final_week,
+            history=self.history,
+            files=np.array(list(self.files), dtype=str),
+            file_sizes=np.array([f[0] for f in self.files.values()], dtype=np.int64),
+            file_mtimes=np.array([f[1] for f in self.files.values()], dtype=np.int64),
+            file_last_days=np.array([f[2] for f in self.files.values()], dtype=np.int64),
+        )
+
+    def add(self, user_codes: np.ndarray, uids: np.ndarray, codes: np.ndarray, days: np.ndarray):
+        """Folds new records into the tensor, growing it for new users and weeks."""
+        if len(user_codes) == 0:
+            return
+        weeks = week_of(days)
+
+        users = np.union1d(self.users, uids)
+        first_week = min(int(weeks.min()), self.first_week) if self.counts.shape[1] else int(weeks.min())
+        last_week = max(int(weeks.max()), self.first_week + self.counts.shape[1] - 1)
+        n_weeks = last_week - first_week + 1
+
+        counts = np.zeros((len(users), n_weeks, len(EMOTIONS)), dtype=np.int64)
+        history = np.zeros((len(users), 3), dtype=np.float64)
+        rows = np.searchsorted(users, self.users)
+        history[rows] = self.history
+        if self.counts.size:
+            offset = self.first_week - first_week
+            counts[rows, offset:offset + self.counts.shape[1]] = self.counts
+        else:
+            self.final_week = first_week
+
+        user_index = np.searchsorted(users, uids)[user_codes]
+        flat = (user_index * n_weeks + (weeks - first_week)) * len(EMOTIONS) + codes
+        counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+
+        self.users, self.first_week, self.counts, self.history = users, first_week, counts, history
+
+    def finalize(self, scores: dict, scored_from: int, final_week: int):
+        """Folds the divergences of weeks scored_from <= week < final_week into history."""
+        done = scores["divergence"][:, :max(final_week - scored_from, 0)]
+        valid = ~np.isnan(done)
+        observed = np.where(valid, done, 0.0)
+        self.history += np.stack([valid.sum(axis=1), observed.sum(axis=1), (observed ** 2).sum(axis=1)], axis=1)
+        self.final_week = max(self.final_week, final_week)
+
+
+def score(counts: np.ndarray, baseline_weeks: int = 4, min_frames: int = 20, eps: float = 1e-9,
+          from_week: int = 0, history: np.ndarray | None = None):
+    """
+    Vectorised weekly scoring over a (users, weeks, emotions) count tensor.
+
+    Only weeks from_week onwards (a week index into counts) are scored; history
+    is each user's (count, sum, sum of squares) of valid divergences before
+    from_week, zeros if None. Returns a dict of (users, scored weeks[, emotions])
+    arrays:
+      frames        frames observed in the week
+      distribution  emotion shares in the week
+      baseline      frame-weighted emotion shares over the previous baseline_weeks
+      divergence    Jensen-Shannon divergence between week and baseline (bits)
+      negative_delta  change in negative-affect share versus the baseline
+      anomaly_z     divergence z-scored against the user's own earlier weeks
+    """
+    # The scored weeks plus the baseline window before them
+    start_week = max(from_week - baseline_weeks, 0)
+    counts = counts[:, start_week:].astype(np.float64)
+    frames = counts.sum(axis=2)
+    distribution = counts / np.maximum(frames, 1)[..., None]
+
+    # Trailing window sums via a cumulative sum along the week axis
+    cumulative = np.cumsum(counts, axis=1)
+    padded = np.concatenate([np.zeros_like(cumulative[:, :1]), cumulative], axis=1)
+    weeks = np.arange(counts.shape[1])
+    end = weeks                          # exclusive: weeks before the current one
+    start = np.maximum(weeks - baseline_weeks, 0)
+    baseline_counts = padded[:, end] - padded[:, start]
+    baseline_frames = baseline_counts.sum(axis=2)
+    baseline = baseline_counts / np.maximum(baseline_frames, 1)[..., None]
+
+    mixture = 0.5 * (distribution + baseline)
+
+    def kl(p, q):
+        return np.where(p > 0, p * np.log2((p + eps) / (q + eps)), 0.0).sum(axis=2)
+
+    divergence = 0.5 * kl(distribution, mixture) + 0.5 * kl(baseline, mixture)
+    valid = (frames >= min_frames) & (baseline_frames >= min_frames)
+    divergence = np.where(valid, divergence, np.nan)
+
+    negative = [EMOTIONS.index(e) for e in NEGATIVE_EMOTIONS]
+    negative_delta = distribution[..., negative].sum(axis=2) - baseline[..., negative].sum(axis=2)
+    negative_delta = np.where(valid, negative_delta, np.nan)
+
+    skip = from_week - start_week
+    frames, distribution, baseline = frames[:, skip:], distribution[:, skip:], baseline[:, skip:]
+    valid, divergence, negative_delta = valid[:, skip:], divergence[:, skip:], negative_delta[:, skip:]
+    if history is None:
+        history = np.zeros((counts.shape[0], 3))
+
+    # Expanding mean/std of the user's earlier divergences (current week excluded)
+    observed = np.where(valid, divergence, 0.0)
+    n = history[:, :1] + np.cumsum(valid, axis=1) - valid
+    s1 = history[:, 1:2] + np.cumsum(observed, axis=1) - observed
+    s2 = history[:, 2:] + np.cumsum(observed ** 2, axis=1) - observed ** 2
+    mean = s1 / np.maximum(n, 1)
+    std = np.sqrt(np.maximum(s2 / np.maximum(n, 1) - mean ** 2, 0.0))
+    anomaly_z = np.where(valid & (n >= 3), (divergence - mean) / np.maximum(std, 1e-3), np.nan)
+
+    return {
+        "frames": frames,
+        "distribution": distribution,
+        "baseline": baseline,
+        "divergence": divergence,
+        "negative_delta": negative_delta,
+        "anomaly_z": anomaly_z,
+    }
+
+
+def to_frame(state: TrendState, scores: dict, scored_from: int, from_week: int, z_threshold: float) -> pd.DataFrame:
+    """
+    Flattens scores for weeks >= from_week into one row per (user, week) with data.
+    Both are absolute week numbers; scores start at week scored_from.
+    """
+    offset = max(from_week - scored_from, 0)
+    frames = scores["frames"][:, offset:]
+    user_idx, week_idx = np.nonzero(frames > 0)
+    weeks = week_idx + offset
+
+    table = {
+        "userId": state.users[user_idx],
+        "WeekStart": week_start(weeks + scored_from),
+        "Frames": frames[user_idx, week_idx].astype(np.int64),
+    }
+    distribution = scores["distribution"][user_idx, weeks]
+    for i, emotion in enumerate(EMOTIONS):
+        table[emotion] = distribution[:, i]
+    table["Divergence"] = scores["divergence"][user_idx, weeks]
+    table["NegativeDelta"] = scores["negative_delta"][user_idx, weeks]
+    table["AnomalyZ"] = scores["anomaly_z"][user_idx, weeks]
+    table["Anomalous"] = np.nan_to_num(table["AnomalyZ"], nan=0.0) >= z_threshold
+    return pd.DataFrame(table)
+
+
+def run(args):
+    paths = sorted(p for pattern in args.input for p in glob.glob(pattern))
+    state = TrendState.load(args.checkpoint) if args.checkpoint else TrendState()
+
+    # Only complete days are folded in so the next run can start strictly after them
+    until = np.datetime64(args.until or (datetime.date.today() - datetime.timedelta(days=1)).isoformat(), "D")
+    until_day = int((until - EPOCH).astype(np.int64))
+
+    user_codes, uids, codes, days = read_exports(paths, state.last_day, until_day, args.timezone, state.files)
+    print(f"Read {len(user_codes)} new records from {len(paths)} files")
+    if len(user_codes) == 0:
+        print("Nothing new to score")
+        if args.checkpoint:
+            state.save(args.checkpoint)
+        return None
+
+    state.add(user_codes, uids, codes, days)
+    state.last_day = until_day if state.last_day is None else max(state.last_day, until_day)
+
+    # Weeks before final_week are unchanged since they were scored; the week holding
+    # the next day to be read is the first that can still change
+    scored_from = min(state.final_week, int(week_of(days).min()))
+    scores = score(state.counts, args.baseline_weeks, args.min_frames,
+                   from_week=scored_from - state.first_week, history=state.history)
+    state.finalize(scores, scored_from, int(week_of(np.int64(state.last_day + 1))))
+    result = to_frame(state, scores, scored_from, int(week_of(days).min()), args.z_threshold)
+    print(f"Scored {len(result)} user-weeks for {len(state.users)} users; "
+          f"{int(result['Anomalous'].sum())} flagged")
+
+    if args.output:
+        if args.output.endswith(".parquet"):
+            result.to_parquet(args.output, index=False)
+        else:
+            result.to_csv(args.output, index=False)
+        print(f"Scores written to {args.output}")
+    if args.checkpoint:
+        state.save(args.checkpoint)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Weekly emotion trends and anomaly scores")
+    parser.add_argument("--input", nargs="+", required=True, help="CSV/Parquet exports (globs allowed)")
+    parser.add_argument("--checkpoint", help="State file (.npz) for incremental runs")
+    parser.add_argument("--output", help="Scores for the weeks touched by this run (.csv or .parquet)")
+    parser.add_argument("--until", help="Last day to include (YYYY-MM-DD, default yesterday)")
+    parser.add_argument("--timezone", default="UTC",
+                        help="Timezone whose days timestamps with an offset are bucketed into")
+    parser.add_argument("--baseline-weeks", type=int, default=4)
+    parser.add_argument("--min-frames", type=int, default=20, help="Frames needed in a week and its baseline")
+    parser.add_argument("--z-threshold", type=float, default=2.5)
+    run(parser.parse_args())
@@ -0,0 +1,233 @@
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from model_loader import EMOTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class DailyEmotionAggregator:
+    """
+    Keeps per-user, per-day emotion counts and confidence sums in memory and
+    periodically sends this worker's totals for each (user, day) to Supabase.
+
+    Behind router.py several workers can count frames for the same uid on the
+    same day (a replica after a failover, a new owner after a rebalance), so
+    each sends its totals tagged with worker_id (WORKER_ID) and the database
+    merges them into the one user_emotion_daily row for that day (see
+    schemas/user_emotion_daily.sql). worker_id must stay the same across
+    restarts of a node, since the checkpoint carries its totals forward; a
+    single worker can leave it empty.
+
+    Rows carry absolute day totals, so re-sending a row is idempotent. add()
+    only updates memory; the keys it touched are written to a local WAL-mode
+    SQLite checkpoint in one transaction on a writer thread, checkpoint_interval
+    seconds later or as soon as checkpoint_batch keys are waiting. The request
+    queue acks a frame only once saved() resolves after its add(), so
+    a crash loses no counted frame (its request is replayed instead) and a
+    restart continues the day's counts instead of overwriting them. A row is
+    marked flushed only if its totals still equal the snapshot Supabase
+    accepted. Days older than the current one are dropped from memory once
+    flushed.
+    """
+
+    def __init__(self, checkpoint_path: str = "aggregates.db", flush_interval: float = 60.0, worker_id: str = ""):
+        self.checkpoint_path = checkpoint_path
+        self.worker_id = worker_id
+        self.flush_interval = flush_interval
+        self.totals: dict[tuple[str, str], dict] = {}
+        self.dirty: set[tuple[str, str]] = set()
+        self.running = False
+        # Keys changed since the last checkpoint, and the future their write resolves
+        self.checkpoint_interval = 0.5
+        self.checkpoint_batch = 256
+        self.unsaved: set[tuple[str, str]] = set()
+        self.checkpointed: asyncio.Future | None = None
+        self.batch_full = asyncio.Event()
+        # All SQLite access after startup runs on this thread, in submission order
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aggregate-writer")
+        self.conn = sqlite3.connect(checkpoint_path, isolation_level=None, check_same_thread=False)
+        self._init_db()
+        self._load_checkpoint()
+
+    def _init_db(self):
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("""
+                CREATE TABLE IF NOT EXISTS daily_emotions (
+                    uid TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    counts TEXT NOT NULL,
+                    confidence_sums TEXT NOT NULL,
+                    flushed INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (uid, day)
+                )
+            """)
+
+    def _load_checkpoint(self):
+        today = datetime.date.today().isoformat()
+        # Today's totals keep accumulating; older days are only reloaded if unflushed
+        cursor = self.conn.execute(
+            "SELECT uid, day, counts, confidence_sums, flushed FROM daily_emotions "
+            "WHERE day >= ? OR flushed = 0",
+            (today,),
+        )
+        for uid, day, counts, confidence_sums, flushed in cursor.fetchall():
+            self.totals[(uid, day)] = {
+                "counts": json.loads(counts),
+                "confidence_sums": json.loads(confidence_sums),
+            }
+            if not flushed:
+                self.dirty.add((uid, day))
+
+    def add(self, uid: str, class_name: str, confidence: float, timestamp: datetime.datetime):
+        key = (uid, timestamp.date().isoformat())
+        entry = self.totals.get(key)
+        if entry is None:
+            entry = self.totals[key] = {
+                "counts": [0] * len(EMOTIONS),
+                "confidence_sums": [0.0] * len(EMOTIONS),
+            }
+        index = EMOTIONS.index(class_name)
+        entry["counts"][index] += 1
+        entry["confidence_sums"][index] += float(confidence)
+        self.dirty.add(key)
+        self.unsaved.add(key)
+        self._pending()
+        if len(self.unsaved) >= self.checkpoint_batch:
+            self.batch_full.set()
+
+    def saved(self) -> asyncio.Future:
+        """A future that resolves once every frame added so far is checkpointed."""
+        if self.checkpointed is None:
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(None)
+            return done
+        return self.checkpointed
+
+    def _pending(self) -> asyncio.Future:
+        """The future of the next checkpoint, scheduling one if none is pending."""
+        if self.checkpointed is None:
+            self.checkpointed = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._checkpoint_soon())
+        return self.checkpointed
+
+    async def _checkpoint_soon(self):
+        try:
+            await asyncio.wait_for(self.batch_full.wait(), self.checkpoint_interval)
+        except asyncio.TimeoutError:
+            pass
+        await self.checkpoint()
+
+    async def checkpoint(self):
+        """Writes the totals of every key changed since the last checkpoint in one transaction."""
+        if self.checkpointed is None:
+            return
+        checkpointed, self.checkpointed = self.checkpointed, None
+        self.batch_full.clear()
+        # A retried key may have been flushed and dropped at day rollover meanwhile
+        keys = [key for key in self.unsaved if key in self.totals]
+        self.unsaved.clear()
+        rows = [(uid, day, json.dumps(self.totals[(uid, day)]["counts"]),
+                 json.dumps(self.totals[(uid, day)]["confidence_sums"])) for uid, day in keys]
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.writer, self._write_checkpoint, rows)
+        except Exception as e:
+            # The acks wait for a later checkpoint that includes these keys
+            logger.warning("Failed to checkpoint daily emotions, will retry: %s", e)
+            self.unsaved.update(keys)
+            self._pending().add_done_callback(lambda _: checkpointed.set_result(None))
+        else:
+            checkpointed.set_result(None)
+
+    def _write_checkpoint(self, rows: list[tuple]):
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO daily_emotions (uid, day, counts, confidence_sums, flushed)
+                VALUES (?, ?, ?, ?, 0)
+            """, rows)
+
+    def _row(self, uid: str, day: str, entry: dict) -> dict:
+        # Frames and DominantEmotion are recomputed from every worker's totals on merge
+        return {
+            "userId": uid,
+            "Day": day,
+            "Worker": self.worker_id,
+            "Counts": dict(zip(EMOTIONS, entry["counts"])),
+            "ConfidenceSums": {k: round(v, 4) for k, v in zip(EMOTIONS, entry["confidence_sums"])},
+        }
+
+    def _mark_flushed(self, snapshot: dict, today: str):
+        """
+        Marks rows flushed unless add() changed their totals while the upsert was in
+        flight, and drops flushed rows of earlier days. Runs on the writer thread.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "UPDATE daily_emotions SET flushed = 1 "
+                "WHERE uid = ? AND day = ? AND counts = ? AND confidence_sums = ?",
+                [(uid, day, json.dumps(entry["counts"]), json.dumps(entry["confidence_sums"]))
+                 for (uid, day), entry in snapshot.items()],
+            )
+            self.conn.execute("DELETE FROM daily_emotions WHERE day < ? AND flushed = 1", (today,))
+
+    async def flush(self) -> bool:
+        if not self.dirty:
+            return True
+
+        from supabase_client import save_daily_emotions
+
+        # Checkpoint first, so the rows about to be marked flushed hold the totals sent
+        await self.checkpoint()
+        keys = list(self.dirty)
+        self.dirty.clear()
+        # Totals as sent; add() keeps changing self.totals during the await
+        snapshot = {key: {"counts": list(self.totals[key]["counts"]),
+                          "confidence_sums": list(self.totals[key]["confidence_sums"])} for key in keys}
+        rows = [self._row(uid, day, snapshot[(uid, day)]) for uid, day in keys]
+
+        try:
+            saved = await save_daily_emotions(rows)
+        except Exception as e:
+            logger.warning("Failed to flush daily emotions: %s", e)
+            saved = False
+
+        if not saved:
+            # Retry on the next flush; new frames for these keys are merged in
+            self.dirty.update(keys)
+            snapshot = {}
+
+        # Day rollover: earlier days are final once they reached Supabase
+        today = datetime.date.today().isoformat()
+        for key in list(self.totals):
+            if key[1] < today and key not in self.dirty and key not in self.unsaved:
+                del self.totals[key]
+        await asyncio.get_running_loop().run_in_executor(self.writer, self._mark_flushed, snapshot, today)
+
+        if saved:
+            logger.info("Flushed %d daily emotion rows", len(rows))
+        else:
+            logger.warning("Kept %d daily emotion rows for retry", len(rows))
+        return saved
+
+    async def run(self):
+        self.running = True
+        while self.running:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        """Writes the last checkpoint and flush, then stops the writer thread."""
+        await self.flush()
+        await self.checkpoint()
+        # Lets the acks waiting on saved() run
+        await asyncio.sleep(0)
+        self.writer.shutdown(wait=True)
+        self.conn.close()
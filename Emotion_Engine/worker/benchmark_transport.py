@@ -0,0 +1,185 @@
+"""
+Measures SendEncryptedImage throughput under different transport settings.
+
+Each scenario starts EmotionService in a separate process with the given
+TransportConfig (the queue is replaced by one that accepts immediately, so only
+the transport is measured) and drives it from a client process with a number of
+concurrent in-flight calls over one channel. Payloads are random bytes, like the
+AES ciphertext the backend sends. The "grpc-defaults" scenario skips
+TransportConfig and only raises the server's receive limit, so the payloads are
+accepted at all.
+
+    python benchmark_transport.py --payload-kib 32 256 1024 --concurrency 16 --seconds 5
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import grpc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../proto'))
+
+import interface_pb2
+import interface_pb2_grpc
+
+from transport import COMPRESSION, TransportConfig, channel_options
+
+
+class _AcceptingQueue:
+    """Stands in for RequestQueue so the benchmark measures the transport only."""
+
+    async def enqueue(self, uid, encrypted_image):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future, False
+
+
+def _serve(config: TransportConfig, grpc_defaults: bool, ready):
+    from service import EmotionService
+    from transport import add_ports, create_server
+
+    async def run():
+        if grpc_defaults:
+            server = grpc.aio.server(options=[("grpc.max_receive_message_length", config.max_receive_bytes)])
+        else:
+            server = create_server(config)
+        interface_pb2_grpc.add_EmotionServiceServicer_to_server(EmotionService(_AcceptingQueue(), None), server)
+        add_ports(server, config)
+        await server.start()
+        ready.set()
+        await server.wait_for_termination()
+
+    asyncio.run(run())
+
+
+async def _drive(target, config, grpc_defaults, compression, payload_size, concurrency, seconds):
+    payload = os.urandom(payload_size)
+    latencies = []
+    refused = 0
+    # First failure other than a refused stream, per status code
+    errors: dict[str, str] = {}
+    options = () if grpc_defaults else channel_options(config)
+    async with grpc.aio.insecure_channel(target, options=options) as channel:
+        stub = interface_pb2_grpc.EmotionServiceStub(channel)
+        request = interface_pb2.ImageRequest(uid="bench", encrypted_image=payload)
+        try:
+            # Connection setup is not part of the measurement
+            await stub.SendEncryptedImage(request, compression=COMPRESSION[compression])
+        except grpc.aio.AioRpcError as e:
+            errors[e.code().name] = e.details()
+            seconds = 0
+        deadline = time.perf_counter() + seconds
+
+        async def caller():
+            nonlocal refused
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    await stub.SendEncryptedImage(request, compression=COMPRESSION[compression])
+                except grpc.aio.AioRpcError as e:
+                    # Streams over max_concurrent_streams are refused (RST_STREAM) rather than queued
+                    if e.code() != grpc.StatusCode.UNAVAILABLE:
+                        # Anything else (e.g. a payload over the limit) fails every call the same way
+                        errors.setdefault(e.code().name, e.details())
+                        return
+                    refused += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(caller() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "refused": refused,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "mib_per_s": len(latencies) * payload_size / elapsed / (1024 * 1024) if elapsed > 0 else 0.0,
+        "p50_ms": None,
+        "p99_ms": None,
+    }
+    if latencies:
+        result["p50_ms"] = latencies[len(latencies) // 2] * 1000
+        result["p99_ms"] = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+    return result
+
+
+def run_scenario(name, config, grpc_defaults, compression, payload_size, concurrency, seconds):
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Event()
+    server = ctx.Process(target=_serve, args=(config, grpc_defaults, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError(f"Server for scenario {name} did not start")
+        target = f"unix:{config.uds_path}" if config.uds_path else config.address
+        result = asyncio.run(_drive(target, config, grpc_defaults, compression, payload_size, concurrency, seconds))
+    finally:
+        server.terminate()
+        server.join()
+    result.update({"scenario": name, "payload_kib": payload_size // 1024, "concurrency": concurrency})
+    return result
+
+
+def scenarios(port: int, socket_dir: str, max_payload: int):
+    """(name, server config, whether to use plain gRPC defaults instead, client request compression)."""
+    address = f"127.0.0.1:{port}"
+    room = max(max_payload * 2, 16 * 1024 * 1024)
+    return [
+        # Only address and max_receive_bytes of the config are used
+        ("grpc-defaults", TransportConfig(address=address, max_receive_bytes=room), True, "none"),
+        ("tuned", TransportConfig(address=address, max_receive_bytes=room), False, "none"),
+        ("tuned+gzip", TransportConfig(address=address, max_receive_bytes=room), False, "gzip"),
+        ("tuned+deflate", TransportConfig(address=address, max_receive_bytes=room), False, "deflate"),
+        ("tuned+streams=8", TransportConfig(address=address, max_receive_bytes=room, max_concurrent_streams=8),
+         False, "none"),
+        ("tuned+uds", TransportConfig(address=None, uds_path=os.path.join(socket_dir, "emotion.sock"),
+                                      max_receive_bytes=room), False, "none"),
+    ]
+
+
+def _ms(value) -> str:
+    return f"{value:>7.2f} ms" if value is not None else "    n/a   "
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EmotionService transport benchmark")
+    parser.add_argument("--payload-kib", type=int, nargs="+", default=[32, 256, 1024])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=50151)
+    parser.add_argument("--only", nargs="+", help="Scenario names to run")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as socket_dir:
+        for name, config, grpc_defaults, compression in scenarios(args.port, socket_dir, max(args.payload_kib) * 1024):
+            if args.only and name not in args.only:
+                continue
+            for kib in args.payload_kib:
+                for concurrency in args.concurrency:
+                    result = run_scenario(name, config, grpc_defaults, compression, kib * 1024, concurrency,
+                                          args.seconds)
+                    results.append(result)
+                    print(f"{name:<16} {kib:>6} KiB  x{concurrency:<3} "
+                          f"{result['rps']:>9.1f} req/s  {result['mib_per_s']:>8.1f} MiB/s  "
+                          f"p50 {_ms(result['p50_ms'])}  p99 {_ms(result['p99_ms'])}  refused {result['refused']}")
+                    for code, details in result["errors"].items():
+                        print(f"{'':<16} error {code}: {details}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import threading
+import torch
+
+
+class BytearrayPool:
+    """
+    Reusable bytearrays in power-of-two size classes, used as decrypt output
+    buffers so each request does not allocate (and free) a fresh plaintext copy.
+    """
+
+    def __init__(self, min_size: int = 64 * 1024, max_size: int = 32 * 1024 * 1024, per_class: int = 4):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.per_class = per_class
+        self.free: dict[int, list[bytearray]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _size_class(self, size: int) -> int:
+        capacity = self.min_size
+        while capacity < size:
+            capacity *= 2
+        return capacity
+
+    def acquire(self, size: int) -> bytearray:
+        """Returns a bytearray of at least size bytes (possibly larger)."""
+        capacity = self._size_class(size)
+        if capacity > self.max_size:
+            self.misses += 1
+            return bytearray(size)
+        with self.lock:
+            free = self.free.get(capacity)
+            if free:
+                self.hits += 1
+                return free.pop()
+        self.misses += 1
+        return bytearray(capacity)
+
+    def release(self, buf: bytearray):
+        capacity = len(buf)
+        if capacity != self._size_class(capacity) or capacity > self.max_size:
+            return
+        with self.lock:
+            free = self.free.setdefault(capacity, [])
+            if len(free) < self.per_class:
+                free.append(buf)
+
+    def pooled_bytes(self) -> int:
+        with self.lock:
+            return sum(size * len(bufs) for size, bufs in self.free.items())
+
+
+class TensorPool:
+    """
+    Fixed-size reusable float32 input tensors, (batch_size, 1, 48, 48) by default.
+    On CUDA the tensors are pinned so host-to-device copies can be asynchronous.
+    """
+
+    def __init__(self, batch_size: int = 8, shape=(1, 48, 48), size: int = 2, pin_memory: bool = False):
+        self.batch_size = batch_size
+        self.shape = (batch_size, *shape)
+        self.size = size
+        self.pin_memory = pin_memory
+        self.free = [self._allocate() for _ in range(size)]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _allocate(self) -> torch.Tensor:
+        return torch.empty(self.shape, dtype=torch.float32, pin_memory=self.pin_memory)
+
+    def acquire(self) -> torch.Tensor:
+        with self.lock:
+            if self.free:
+                self.hits += 1
+                return self.free.pop()
+        self.misses += 1
+        return self._allocate()
+
+    def release(self, tensor: torch.Tensor):
+        with self.lock:
+            if len(self.free) < self.size:
+                self.free.append(tensor)
+
+    @property
+    def tensor_bytes(self) -> int:
+        n = 4
+        for dim in self.shape:
+            n *= dim
+        return n
+
+
+class MemoryAccounting:
+    """Current and peak bytes held by in-flight requests."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, n: int):
+        with self.lock:
+            self.current += n
+            if self.current > self.peak:
+                self.peak = self.current
+
+    def release(self, n: int):
+        with self.lock:
+            self.current -= n
+
+    def track(self):
+        return _RequestMemory(self)
+
+
+class _RequestMemory:
+    """Accumulates the bytes one request holds and releases them all on exit."""
+
+    def __init__(self, accounting: MemoryAccounting):
+        self.accounting = accounting
+        self.held = 0
+
+    def add(self, n: int):
+        self.held += n
+        self.accounting.reserve(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.accounting.release(self.held)
+        self.held = 0
+        return False
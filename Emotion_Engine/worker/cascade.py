@@ -0,0 +1,167 @@
+import asyncio
+import io
+import logging
+import torch
+from PIL import Image
+
+from model_loader import EmotionRecognitionModel, EMOTIONS
+from siglip_runtime import SiglipOptions, SiglipRunner
+
+logger = logging.getLogger(__name__)
+
+SIGLIP_MODEL_NAME = "prithivMLmods/Facial-Emotion-Detection-SigLIP2"
+
+# SigLIP labels without an EMOTIONS counterpart; their probability mass is dropped
+UNMAPPED_SIGLIP_LABELS = {"ahegao"}
+
+
+class SiglipLabelMap:
+    """
+    Maps probabilities over a SigLIP checkpoint's labels (SiglipRunner.labels,
+    i.e. the model's id2label) onto the CNN's EMOTIONS order. Labels are matched
+    by name, case-insensitively; a label that is neither in EMOTIONS nor in
+    UNMAPPED_SIGLIP_LABELS raises ValueError instead of being routed to the
+    wrong class. EMOTIONS the checkpoint cannot predict (Disgust and Fear for
+    the default model) are listed in cnn_only.
+    """
+
+    def __init__(self, labels: dict[int, str]):
+        lookup = {name.lower(): i for i, name in enumerate(EMOTIONS)}
+        source, target, unknown = [], [], []
+        for index in sorted(labels):
+            name = labels[index].strip().lower()
+            if name in lookup:
+                source.append(index)
+                target.append(lookup[name])
+            elif name not in UNMAPPED_SIGLIP_LABELS:
+                unknown.append(labels[index])
+        if unknown:
+            raise ValueError(f"SigLIP labels {unknown} have no counterpart in {EMOTIONS}")
+        if len(set(target)) != len(target):
+            raise ValueError(f"SigLIP labels {labels} map more than one label onto the same emotion")
+        self.num_labels = len(labels)
+        self.source = torch.tensor(source, dtype=torch.long)
+        self.target = torch.tensor(target, dtype=torch.long)
+        self.cnn_only = torch.tensor([i for i in range(len(EMOTIONS)) if i not in target], dtype=torch.long)
+
+    def __call__(self, probs: torch.Tensor) -> torch.Tensor:
+        """(..., num_labels) SigLIP probabilities -> (..., len(EMOTIONS)), renormalised."""
+        if probs.shape[-1] != self.num_labels:
+            raise ValueError(f"Expected {self.num_labels} SigLIP probabilities, got {probs.shape[-1]}")
+        mapped = torch.zeros(*probs.shape[:-1], len(EMOTIONS), dtype=probs.dtype)
+        mapped[..., self.target] = probs[..., self.source]
+        total = mapped.sum(dim=-1, keepdim=True)
+        return torch.where(total > 0, mapped / total.clamp_min(torch.finfo(probs.dtype).tiny), mapped)
+
+
+def escalation_mask(probs: torch.Tensor, min_confidence: float, min_margin: float,
+                    cnn_only: torch.Tensor) -> torch.Tensor:
+    """
+    For (N, len(EMOTIONS)) CNN probabilities, which rows go to SigLIP: top probability
+    below min_confidence or top-2 margin below min_margin, unless the top class is one
+    SigLIP cannot predict (cnn_only, see SiglipLabelMap).
+    """
+    top2 = torch.topk(probs, 2, dim=1)
+    unsure = (top2.values[:, 0] < min_confidence) | (top2.values[:, 0] - top2.values[:, 1] < min_margin)
+    return unsure & ~torch.isin(top2.indices[:, 0], cnn_only)
+
+
+class SiglipEmotionModel:
+    """
+    SigLIP image classifier with the same async interface as EmotionRecognitionModel.
+    options selects the CPU inference mode (see siglip_runtime); SIGLIP_* env vars by default.
+    """
+
+    def __init__(self, model_name: str = SIGLIP_MODEL_NAME, options: SiglipOptions | None = None):
+        self.model_name = model_name
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.options = options or SiglipOptions.from_env()
+        self.runner = None
+        self.model = None
+        self.label_map = None
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+
+        def _load():
+            runner = SiglipRunner(self.model_name, self.options, self.device)
+            runner.load()
+            return runner, SiglipLabelMap(runner.labels)
+
+        self.runner, self.label_map = await loop.run_in_executor(None, _load)
+        self.model = self.runner.model
+        logger.info("SigLIP loaded", extra={"mode": self.options.describe()})
+
+    async def predict_proba(self, image: Image.Image) -> torch.Tensor:
+        """Class probabilities mapped onto EMOTIONS."""
+        if self.runner is None:
+            raise RuntimeError("Model not loaded")
+
+        loop = asyncio.get_running_loop()
+
+        def _predict_proba():
+            return self.label_map(self.runner.predict_proba([image.convert("RGB")])[0])
+
+        return await loop.run_in_executor(None, _predict_proba)
+
+
+class CascadeEmotionModel:
+    """
+    Runs the 48x48 CNN first and escalates to SigLIP only when the CNN is unsure,
+    i.e. its top probability is below min_confidence or its top-2 margin below min_margin.
+    Classes SigLIP has no label for (Disgust and Fear) are never escalated.
+    Drop-in replacement for EmotionRecognitionModel in RequestQueue.
+    """
+
+    def __init__(self, cnn: EmotionRecognitionModel, siglip: SiglipEmotionModel,
+                 min_confidence: float = 0.6, min_margin: float = 0.2):
+        self.cnn = cnn
+        self.siglip = siglip
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.version = cnn.version
+        self.requests = 0
+        self.escalations = 0
+
+    async def load(self):
+        await self.cnn.load()
+        try:
+            await self.siglip.load()
+        except Exception as e:
+            # The cascade degrades to CNN-only rather than refusing to start
+            logger.error("Failed to load SigLIP model, cascade disabled: %s", e)
+
+    def should_escalate(self, probs: torch.Tensor) -> bool:
+        return bool(escalation_mask(probs[None], self.min_confidence, self.min_margin,
+                                    self.siglip.label_map.cnn_only)[0])
+
+    async def predict_proba_with_source(self, data):
+        """Returns (probabilities over EMOTIONS, "cnn" | "siglip")."""
+        self.requests += 1
+        probs = await self.cnn.predict_proba(data)
+        if self.siglip.model is None or not self.should_escalate(probs):
+            return probs, "cnn"
+
+        if isinstance(data, (bytes, bytearray)):
+            data = Image.open(io.BytesIO(data))
+        elif isinstance(data, str):
+            data = Image.open(data)
+
+        self.escalations += 1
+        return await self.siglip.predict_proba(data), "siglip"
+
+    async def predict_proba(self, data) -> torch.Tensor:
+        probs, _ = await self.predict_proba_with_source(data)
+        return probs
+
+    async def predict(self, data, showClassName: bool = False):
+        probs = await self.predict_proba(data)
+        class_id = int(probs.argmax().item())
+        return self.toClassName(class_id) if showClassName is True else class_id
+
+    def toClassName(self, class_id: int) -> str:
+        return EMOTIONS[class_id]
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalations / self.requests if self.requests else 0.0
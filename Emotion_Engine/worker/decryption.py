@@ -1,69 +1,178 @@
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
 import base64
 import io
 from PIL import Image
 import binascii
+import logging
+import numpy as np
 
-def decrypt_image(encrypted_data: bytes, key: str) -> Image.Image:
+logger = logging.getLogger(__name__)
+
+def _unpad(data: memoryview) -> memoryview:
+    """PKCS7 unpad (16-byte blocks) without copying."""
+    if len(data) == 0 or len(data) % 16:
+        raise ValueError("Invalid padding bytes.")
+    pad = data[-1]
+    if pad < 1 or pad > 16 or any(b != pad for b in data[-pad:]):
+        raise ValueError("Invalid padding bytes.")
+    return data[:-pad]
+
+_JSON_WHITESPACE = b" \t\r\n"
+
+def _extract_image_b64(data: memoryview):
     """
-    Decrypts the encrypted image data using AES-CBC.
-    Expects encrypted_data to be IV (16 bytes) + Ciphertext.
-    Expects key to be a hex string (32 bytes / 64 hex chars).
+    Returns the base64 "image" field of a JSON payload as a memoryview into data,
+    or None if the payload does not have the simple {"image": "..."} shape.
+
+    Only a "image" key counts: it must follow "{" or "," and be followed by ":",
+    so the same bytes inside a string value are skipped.
+
+    >>> _extract_image_b64(memoryview(bytearray(b'{"kind":"image","ts":"a","image":"QUJD"}'))).tobytes()
+    b'QUJD'
     """
+    raw = data.obj
+    size = len(data)
+    first = 0
+    while first < size and raw[first] in _JSON_WHITESPACE:
+        first += 1
+    if first == size or raw[first] != ord("{"):
+        return None
+
+    start = raw.find(b'"image"', first, size)
+    while start >= 0:
+        before = start - 1
+        while raw[before] in _JSON_WHITESPACE:
+            before -= 1
+        colon = start + 7
+        while colon < size and raw[colon] in _JSON_WHITESPACE:
+            colon += 1
+        if raw[before] in b"{," and colon < size and raw[colon] == ord(":"):
+            break
+        start = raw.find(b'"image"', start + 7, size)
+    if start < 0:
+        return None
+
+    quote = raw.find(b'"', colon + 1, size)
+    if quote < 0 or raw[colon + 1:quote].strip():
+        return None
+    end = raw.find(b'"', quote + 1, size)
+    if end < 0:
+        return None
+    value = data[quote + 1:end]
+    # The image might be raw base64 or data URI
+    comma = raw.find(b',', quote + 1, end)
+    if comma >= 0:
+        value = data[comma + 1:end]
+    # Escaped strings need the full JSON parser
+    if raw.find(b'\\', quote + 1, end) >= 0:
+        return None
+    return value
+
+def _key_bytes(key: str) -> bytes:
+    # Convert hex key to bytes
     try:
-        # Convert hex key to bytes
-        try:
-            key_bytes = binascii.unhexlify(key)
-        except binascii.Error:
-            # Fallback if key is somehow raw bytes or other format, but we expect hex from backend
-            if len(key) == 32:
-                key_bytes = key.encode('utf-8') # Unlikely but safe fallback
-            else:
-                raise ValueError("Invalid key format. Expected 32-byte hex string.")
+        key_bytes = binascii.unhexlify(key)
+    except binascii.Error:
+        # Fallback if key is somehow raw bytes or other format, but we expect hex from backend
+        if len(key) == 32:
+            key_bytes = key.encode('utf-8') # Unlikely but safe fallback
+        else:
+            raise ValueError("Invalid key format. Expected 32-byte hex string.")
 
-        if len(key_bytes) != 32:
-             raise ValueError(f"Invalid key length: {len(key_bytes)} bytes. Expected 32 bytes.")
+    if len(key_bytes) != 32:
+         raise ValueError(f"Invalid key length: {len(key_bytes)} bytes. Expected 32 bytes.")
+    return key_bytes
 
-        # Extract IV and Ciphertext
-        iv = encrypted_data[:16]
-        ciphertext = encrypted_data[16:]
+def _decrypt_into(encrypted_data: bytes, key: str, pool=None, memory=None):
+    """Returns (buffer, unpadded plaintext view into it); the caller releases the buffer."""
+    key_bytes = _key_bytes(key)
 
-        # Decrypt
-        cipher = Cipher(algorithms.AES(key_bytes), modes.CBC(iv), backend=default_backend())
-        decryptor = cipher.decryptor()
-        padded_data = decryptor.update(ciphertext) + decryptor.finalize()
+    # Extract IV and Ciphertext
+    iv = encrypted_data[:16]
+    ciphertext = memoryview(encrypted_data)[16:]
 
+    # Decrypt
+    cipher = Cipher(algorithms.AES(key_bytes), modes.CBC(iv), backend=default_backend())
+    decryptor = cipher.decryptor()
+    # update_into needs room for one extra block; CBC leaves nothing for finalize
+    buf = pool.acquire(len(ciphertext) + 15) if pool is not None else bytearray(len(ciphertext) + 15)
+    if memory is not None:
+        memory.add(len(encrypted_data) + len(buf))
+    try:
+        n = decryptor.update_into(ciphertext, buf)
+        decryptor.finalize()
         # Unpad
-        unpadder = padding.PKCS7(128).unpadder()
-        data = unpadder.update(padded_data) + unpadder.finalize()
-        
+        return buf, _unpad(memoryview(buf)[:n])
+    except Exception:
+        if pool is not None:
+            pool.release(buf)
+        raise
+
+def decrypt_embedding(encrypted_data: bytes, key: str, dim: int, pool=None, memory=None) -> np.ndarray:
+    """
+    Decrypts an embedding sent with SendEncryptedEmbedding: IV + AES-CBC
+    ciphertext like images, but the plaintext is just dim little-endian float32
+    values (no JSON, no base64, nothing to decode).
+    """
+    buf = None
+    try:
+        buf, data = _decrypt_into(encrypted_data, key, pool, memory)
+        if len(data) != dim * 4:
+            raise ValueError(f"Expected {dim} float32 values ({dim * 4} bytes), got {len(data)} bytes.")
+        # Copied out because the buffer goes back to the pool
+        vector = np.frombuffer(data, dtype="<f4").astype(np.float32)
+        if not np.isfinite(vector).all():
+            raise ValueError("Embedding contains NaN or infinite values.")
+        return vector
+    finally:
+        if buf is not None and pool is not None:
+            pool.release(buf)
+
+def decrypt_image(encrypted_data: bytes, key: str, pool=None, memory=None) -> Image.Image:
+    """
+    Decrypts the encrypted image data using AES-CBC.
+    Expects encrypted_data to be IV (16 bytes) + Ciphertext.
+    Expects key to be a hex string (32 bytes / 64 hex chars).
+
+    With a BytearrayPool the plaintext is decrypted into a pooled buffer and the
+    base64 image is decoded straight out of it. memory (a per-request tracker from
+    MemoryAccounting) is charged for the buffers held.
+    """
+    buf = None
+    try:
+        buf, data = _decrypt_into(encrypted_data, key, pool, memory)
+
         # Parse JSON payload
-        import json
-        try:
-            json_str = data.decode('utf-8')
-            payload = json.loads(json_str)
+        image_b64 = _extract_image_b64(data)
+        if image_b64 is not None:
+            image_bytes = binascii.a2b_base64(image_b64)
+        else:
+            import json
+            try:
+                payload = json.loads(bytes(data).decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                 # Fallback if not JSON
+                logger.debug("Failed to decode as JSON, treating as raw image bytes.", extra={"per_request": True})
+                payload = None
             # Check if it's the expected payload format
-            if 'image' in payload:
+            if isinstance(payload, dict) and 'image' in payload:
                 image_b64 = payload['image']
-                # The image might be raw base64 or data URI
                 if ',' in image_b64:
                     image_b64 = image_b64.split(',')[1]
                 image_bytes = base64.b64decode(image_b64)
-                image = Image.open(io.BytesIO(image_bytes))
-                return image
             else:
-                # Fallback for backward compatibility or if raw image was sent
-                print("Warning: 'image' field not found in payload, attempting to treat as raw image bytes.")
-                image = Image.open(io.BytesIO(data))
-                return image
-        except (json.JSONDecodeError, UnicodeDecodeError):
-             # Fallback if not JSON
-            print("Warning: Failed to decode as JSON, treating as raw image bytes.")
-            image = Image.open(io.BytesIO(data))
-            return image
-    except Exception as e:
-        print(f"Decryption failed: {e}")
-        raise e
+                if payload is not None:
+                    # Fallback for backward compatibility or if raw image was sent
+                    logger.warning("'image' field not found in payload, attempting to treat as raw image bytes.",
+                                   extra={"per_request": True})
+                image_bytes = bytes(data)
 
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        if memory is not None:
+            memory.add(len(image_bytes) + image.width * image.height * len(image.getbands()))
+        return image
+    finally:
+        if buf is not None and pool is not None:
+            pool.release(buf)
@@ -0,0 +1,112 @@
+"""
+Evaluates the CNN -> SigLIP cascade on a labelled image folder.
+
+The folder is laid out like the training data (one sub-directory per emotion,
+names matched case-insensitively against EMOTIONS). Both models are run once per
+image, so several thresholds can be compared without re-running inference.
+
+    python evaluate_cascade.py --data ../facialdata --model models/model_v1.pth \
+        --confidence 0.5 0.6 0.7 --margin 0.1 0.2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+
+import torch
+from PIL import Image
+
+from cascade import SiglipEmotionModel, SIGLIP_MODEL_NAME, escalation_mask
+from model_loader import EmotionRecognitionModel, EMOTIONS
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_samples(root: str):
+    lookup = {name.lower(): i for i, name in enumerate(EMOTIONS)}
+    samples = []
+    for folder in sorted(os.listdir(root)):
+        label = lookup.get(folder.lower())
+        path = os.path.join(root, folder)
+        if label is None or not os.path.isdir(path):
+            print(f"Skipping folder {folder}: not an emotion in {EMOTIONS}")
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((os.path.join(path, name), label))
+    return samples
+
+
+def accuracy(pred: torch.Tensor, labels: torch.Tensor) -> float:
+    return (pred == labels).float().mean().item() if len(labels) else 0.0
+
+
+async def evaluate(args):
+    cnn = EmotionRecognitionModel(path=args.model)
+    siglip = SiglipEmotionModel(args.siglip_model)
+    await cnn.load()
+    await siglip.load()
+
+    samples = load_samples(args.data)
+    if args.limit:
+        samples = samples[:args.limit]
+    print(f"Evaluating {len(samples)} images")
+
+    cnn_probs, siglip_probs, labels = [], [], []
+    for path, label in samples:
+        image = Image.open(path).convert("RGB")
+        cnn_probs.append(await cnn.predict_proba(image))
+        siglip_probs.append(await siglip.predict_proba(image))
+        labels.append(label)
+
+    cnn_probs = torch.stack(cnn_probs)
+    siglip_probs = torch.stack(siglip_probs)
+    labels = torch.tensor(labels)
+
+    cnn_pred = cnn_probs.argmax(dim=1)
+    siglip_pred = siglip_probs.argmax(dim=1)
+
+    report = {
+        "samples": len(labels),
+        "cnn_accuracy": accuracy(cnn_pred, labels),
+        "siglip_accuracy": accuracy(siglip_pred, labels),
+        "cascade": [],
+    }
+
+    for min_confidence, min_margin in itertools.product(args.confidence, args.margin):
+        # Same rule as CascadeEmotionModel.should_escalate, over the whole set
+        escalate = escalation_mask(cnn_probs, min_confidence, min_margin, siglip.label_map.cnn_only)
+        pred = torch.where(escalate, siglip_pred, cnn_pred)
+        report["cascade"].append({
+            "min_confidence": min_confidence,
+            "min_margin": min_margin,
+            "escalation_rate": escalate.float().mean().item(),
+            "accuracy": accuracy(pred, labels),
+            "cnn_accuracy_kept": accuracy(cnn_pred[~escalate], labels[~escalate]),
+            "siglip_accuracy_escalated": accuracy(siglip_pred[escalate], labels[escalate]),
+        })
+
+    print(f"CNN only:    accuracy {report['cnn_accuracy']:.4f}")
+    print(f"SigLIP only: accuracy {report['siglip_accuracy']:.4f}")
+    for row in report["cascade"]:
+        print(f"Cascade conf>={row['min_confidence']:.2f} margin>={row['min_margin']:.2f}: "
+              f"accuracy {row['accuracy']:.4f}, escalation rate {row['escalation_rate']:.2%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the CNN -> SigLIP cascade")
+    parser.add_argument("--data", required=True, help="Folder with one sub-directory per emotion")
+    parser.add_argument("--model", default="models/model_v1.pth", help="CNN state dict")
+    parser.add_argument("--siglip-model", default=SIGLIP_MODEL_NAME)
+    parser.add_argument("--confidence", type=float, nargs="+", default=[0.6])
+    parser.add_argument("--margin", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--limit", type=int, default=0, help="Evaluate at most N images")
+    parser.add_argument("--output", help="Write the report as JSON")
+    asyncio.run(evaluate(parser.parse_args()))
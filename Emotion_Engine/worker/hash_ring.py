@@ -0,0 +1,44 @@
+import bisect
+import hashlib
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of uids onto nodes. Every node is placed at vnodes points
+    on a 64-bit ring, and a uid belongs to the first node clockwise from its
+    hash. Adding or removing a node only moves the uids of the ring segments
+    that node gains or loses, about 1/N of them.
+    """
+
+    def __init__(self, nodes=(), vnodes: int = 128):
+        self.vnodes = vnodes
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def preference(self, uid: str, count: int = 1) -> list[str]:
+        """The first count distinct nodes clockwise from uid: its owner, then its replicas."""
+        if not self.hashes:
+            return []
+        count = min(count, len(self.nodes))
+        start = bisect.bisect(self.hashes, _hash(uid))
+        nodes = []
+        for i in range(len(self.hashes)):
+            node = self.owners[(start + i) % len(self.hashes)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+    def owner(self, uid: str) -> str | None:
+        nodes = self.preference(uid)
+        return nodes[0] if nodes else None
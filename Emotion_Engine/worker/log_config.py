@@ -0,0 +1,186 @@
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def redact_uid(uid: str, salt: str = "") -> str:
+    """Stable, non-reversible stand-in for a uid so log lines can still be correlated."""
+    return "u_" + hashlib.blake2b(f"{salt}{uid}".encode("utf-8"), digest_size=6).hexdigest()
+
+
+class RedactionFilter(logging.Filter):
+    """Replaces the uid passed via extra={"uid": ...} with its redacted form."""
+
+    def __init__(self, salt: str = ""):
+        super().__init__()
+        self.salt = salt
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        uid = getattr(record, "uid", None)
+        if uid is not None:
+            record.uid = redact_uid(uid, self.salt)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 in N of the per-request records (extra={"per_request": True}) for
+    each level; other records always pass. Deterministic, so no RNG on the hot path.
+    """
+
+    def __init__(self, rates: dict[int, float]):
+        super().__init__()
+        self.every = {level: max(1, round(1 / rate)) if rate > 0 else 0 for level, rate in rates.items()}
+        self.counters = {level: 0 for level in rates}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "per_request", False):
+            return True
+        every = self.every.get(record.levelno)
+        if every is None:
+            return True
+        if every == 0:
+            return False
+        self.counters[record.levelno] += 1
+        return (self.counters[record.levelno] - 1) % every == 0
+
+
+def _extras(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items()
+            if key not in _RECORD_FIELDS and key != "per_request"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(_extras(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Message followed by the extra fields as key=value, for the rich debug console."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        extras = " ".join(f"{key}={value}" for key, value in _extras(record).items())
+        return f"{message} [dim]{extras}[/dim]" if extras else message
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without formatting them first and drops
+    them (counting the drops) instead of blocking the event loop when the queue is full.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Block until there is room: the queue may be full when stopping under load
+        self.queue.put(self._sentinel)
+
+
+_listener: QueueListener | None = None
+_handler: _NonBlockingQueueHandler | None = None
+
+
+def setup_logging(level: str = "INFO", debug: bool = False, sample_rates: dict[str, float] | None = None,
+                  redact: bool = True, salt: str = "", queue_size: int = 10000):
+    """
+    Routes the root logger through a bounded in-memory queue to a background
+    thread that writes JSON lines to stdout. In debug mode records are rendered
+    with rich on the console instead, and nothing is sampled.
+    """
+    global _listener, _handler
+    stop_logging()
+
+    # Skip collecting fields the formatters never print (see "Optimization" in the logging docs)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    if debug:
+        from rich.logging import RichHandler
+        output = RichHandler(rich_tracebacks=True, show_path=False, markup=True)
+        output.setFormatter(ConsoleFormatter())
+    else:
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+
+    # Redaction hashes the uid, so it runs on the listener thread after sampling
+    if redact:
+        output.addFilter(RedactionFilter(salt))
+
+    handler = _NonBlockingQueueHandler(queue.Queue(queue_size))
+    if sample_rates and not debug:
+        handler.addFilter(SamplingFilter({logging.getLevelName(k.upper()): v for k, v in sample_rates.items()}))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    _handler = handler
+    root.setLevel(logging.DEBUG if debug else level.upper())
+
+    _listener = _Listener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return handler
+
+
+def setup_logging_from_env():
+    """
+    LOG_LEVEL (INFO), LOG_DEBUG=1 for rich console output, LOG_SAMPLE_INFO /
+    LOG_SAMPLE_DEBUG (fraction of per-request records kept, default 0.01),
+    LOG_REDACT_UIDS=0 to log raw uids, LOG_UID_SALT.
+    """
+    return setup_logging(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        debug=os.environ.get("LOG_DEBUG", "0") == "1",
+        sample_rates={
+            "DEBUG": float(os.environ.get("LOG_SAMPLE_DEBUG", 0.01)),
+            "INFO": float(os.environ.get("LOG_SAMPLE_INFO", 0.01)),
+        },
+        redact=os.environ.get("LOG_REDACT_UIDS", "1") != "0",
+        salt=os.environ.get("LOG_UID_SALT", ""),
+    )
+
+
+def dropped_records() -> int:
+    """Records discarded because the log queue was full."""
+    return _handler.dropped if _handler is not None else 0
+
+
+def stop_logging():
+    """Flushes whatever is still queued; safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
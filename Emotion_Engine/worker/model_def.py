@@ -1,66 +1,86 @@
-import torch.nn as nn, torch.nn.functional as F
+import torch, torch.nn as nn, torch.nn.functional as F
+
+
+# Output widths of conv1..conv5, fc1, fc2 in the original architecture
+DEFAULT_WIDTHS = (32, 64, 128, 512, 512, 256, 512)
+
+# MediaPipe Face Landmarker output: 478 landmarks (468 face mesh + 10 iris) x (x, y, z)
+LANDMARK_DIM = 478 * 3
 
 
 class CNN(nn.Module):
-    def __init__(self):
+    def __init__(self, widths=DEFAULT_WIDTHS):
         super(CNN, self).__init__()
+        # Narrower widths give the structurally pruned variants (see training/prune.py)
+        self.widths = tuple(int(w) for w in widths)
+        c1, c2, c3, c4, c5, f1, f2 = self.widths
         
-        self.conv1 = nn.Conv2d(1, 32, kernel_size=3, padding=1)  # input_shape=(1,48,48)
-        self.conv2 = nn.Conv2d(32, 64, kernel_size=3, padding=1)
-        self.bn1 = nn.BatchNorm2d(64)
+        self.conv1 = nn.Conv2d(1, c1, kernel_size=3, padding=1)  # input_shape=(1,48,48)
+        self.conv2 = nn.Conv2d(c1, c2, kernel_size=3, padding=1)
+        self.bn1 = nn.BatchNorm2d(c2)
         self.pool1 = nn.MaxPool2d(2, 2)
         self.dropout1 = nn.Dropout(0.25)
         
-        self.conv3 = nn.Conv2d(64, 128, kernel_size=5, padding=2)  # padding=2 for 'same' with kernel=5
-        self.bn2 = nn.BatchNorm2d(128)
+        self.conv3 = nn.Conv2d(c2, c3, kernel_size=5, padding=2)  # padding=2 for 'same' with kernel=5
+        self.bn2 = nn.BatchNorm2d(c3)
         self.pool2 = nn.MaxPool2d(2, 2)
         self.dropout2 = nn.Dropout(0.25)
         
-        self.conv4 = nn.Conv2d(128, 512, kernel_size=3, padding=1)
-        self.bn3 = nn.BatchNorm2d(512)
+        self.conv4 = nn.Conv2d(c3, c4, kernel_size=3, padding=1)
+        self.bn3 = nn.BatchNorm2d(c4)
         self.pool3 = nn.MaxPool2d(2, 2)
         self.dropout3 = nn.Dropout(0.25)
         
-        self.conv5 = nn.Conv2d(512, 512, kernel_size=3, padding=1)
-        self.bn4 = nn.BatchNorm2d(512)
+        self.conv5 = nn.Conv2d(c4, c5, kernel_size=3, padding=1)
+        self.bn4 = nn.BatchNorm2d(c5)
         self.pool4 = nn.MaxPool2d(2, 2)
         self.dropout4 = nn.Dropout(0.25)
         
-        self.flatten_dim = 512 * 3 * 3  # After 4 maxpools on 48x48 input: 48->24->12->6->3
+        self.flatten_dim = c5 * 3 * 3  # After 4 maxpools on 48x48 input: 48->24->12->6->3
         
-        self.fc1 = nn.Linear(self.flatten_dim, 256)
-        self.bn5 = nn.BatchNorm1d(256)
+        self.fc1 = nn.Linear(self.flatten_dim, f1)
+        self.bn5 = nn.BatchNorm1d(f1)
         self.dropout5 = nn.Dropout(0.25)
         
-        self.fc2 = nn.Linear(256, 512)
-        self.bn6 = nn.BatchNorm1d(512)
+        self.fc2 = nn.Linear(f1, f2)
+        self.bn6 = nn.BatchNorm1d(f2)
         self.dropout6 = nn.Dropout(0.25)
         
-        self.fc3 = nn.Linear(512, 7)
+        self.fc3 = nn.Linear(f2, 7)
+
+    def arch(self) -> dict:
+        """Constructor arguments, stored next to the weights of non-default models."""
+        return {"widths": list(self.widths)}
         
-    def forward(self, x):
+    # Stages end at pool1..pool4; EarlyExitCNN attaches its heads between them
+    def stage1(self, x):
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
         x = self.bn1(x)
         x = self.pool1(x)
-        x = self.dropout1(x)
-        
+        return self.dropout1(x)
+
+    def stage2(self, x):
         x = F.relu(self.conv3(x))
         x = self.bn2(x)
         x = self.pool2(x)
-        x = self.dropout2(x)
-        
+        return self.dropout2(x)
+
+    def stage3(self, x):
         x = F.relu(self.conv4(x))
         x = self.bn3(x)
         x = self.pool3(x)
-        x = self.dropout3(x)
-        
+        return self.dropout3(x)
+
+    def stage4(self, x):
         x = F.relu(self.conv5(x))
         x = self.bn4(x)
         x = self.pool4(x)
-        x = self.dropout4(x)
-        
-        x = x.view(-1, self.flatten_dim)
+        return self.dropout4(x)
+
+    def classifier(self, x):
+        """Flattened conv5 features -> logits."""
+        x = x.reshape(-1, self.flatten_dim)  # reshape: input may be channels_last
         
         x = F.relu(self.fc1(x))
         x = self.bn5(x)
@@ -70,5 +90,196 @@ class CNN(nn.Module):
         x = self.bn6(x)
         x = self.dropout6(x)
         
-        x = self.fc3(x)
-        return F.log_softmax(x, dim=1) 
\ No newline at end of file
+        return self.fc3(x)
+
+    def forward(self, x):
+        x = self.stage4(self.stage3(self.stage2(self.stage1(x))))
+        return F.log_softmax(self.classifier(x), dim=1) 
+
+
+# Exit points of EarlyExitCNN -> the stage the head follows; stage n outputs widths[n] channels
+EXIT_POINTS = {"pool1": 1, "pool2": 2, "pool3": 3}
+
+
+class ExitHead(nn.Module):
+    """Small classifier on an intermediate feature map: average pool, Linear, ReLU, BatchNorm, Linear."""
+
+    def __init__(self, channels, hidden=128, pool=3, dropout=0.25):
+        super(ExitHead, self).__init__()
+        self.pool = nn.AdaptiveAvgPool2d(pool)
+        self.fc1 = nn.Linear(channels * pool * pool, hidden)
+        self.bn = nn.BatchNorm1d(hidden)
+        self.dropout = nn.Dropout(dropout)
+        self.fc2 = nn.Linear(hidden, 7)
+
+    def forward(self, x):
+        x = self.pool(x).flatten(1)
+        x = F.relu(self.fc1(x))
+        x = self.bn(x)
+        x = self.dropout(x)
+        return self.fc2(x)
+
+
+class EarlyExitCNN(CNN):
+    """
+    CNN with auxiliary classifier heads after intermediate stages. In eval mode
+    forward() hands a sample back at the first head whose top probability reaches
+    that head's threshold. The rest of the batch is compacted and goes on to the
+    next stage, so batched inference only pays for the samples that are still
+    unsure. The thresholds are a buffer saved with the weights (calibrated by
+    training/train_early_exit.py). Infinite thresholds, the initial value, make
+    the model behave exactly like CNN.
+
+    In train mode forward() is the full CNN. forward_exits() returns every head's
+    log-probabilities for training and calibration.
+    """
+
+    def __init__(self, widths=DEFAULT_WIDTHS, exits=("pool2", "pool3"), head_hidden=128):
+        super(EarlyExitCNN, self).__init__(widths)
+        unknown = [name for name in exits if name not in EXIT_POINTS]
+        if unknown or not exits:
+            raise ValueError(f"exits must be a non-empty subset of {list(EXIT_POINTS)}, got {list(exits)}")
+        self.exits = tuple(sorted(exits, key=EXIT_POINTS.get))
+        self.head_hidden = int(head_hidden)
+        self.heads = nn.ModuleList(
+            ExitHead(self.widths[EXIT_POINTS[name]], self.head_hidden) for name in self.exits
+        )
+        self.register_buffer("thresholds", torch.full((len(self.exits),), float("inf")))
+        # Samples answered per exit (the last entry is the full network), counted in eval mode
+        self.exit_counts = [0] * (len(self.exits) + 1)
+
+    def arch(self) -> dict:
+        return {"widths": list(self.widths), "exits": list(self.exits), "head_hidden": self.head_hidden}
+
+    def _stages(self):
+        """(stage, index of the head after it or None) in order."""
+        heads = {EXIT_POINTS[name]: i for i, name in enumerate(self.exits)}
+        return [(stage, heads.get(n)) for n, stage in
+                enumerate((self.stage1, self.stage2, self.stage3, self.stage4), start=1)]
+
+    def forward_exits(self, x):
+        """Log-probabilities of every head and then of the full network, for the whole batch."""
+        outputs = []
+        for stage, head in self._stages():
+            x = stage(x)
+            if head is not None:
+                outputs.append(F.log_softmax(self.heads[head](x), dim=1))
+        outputs.append(F.log_softmax(self.classifier(x), dim=1))
+        return outputs
+
+    def forward_early(self, x, thresholds=None):
+        """(log-probabilities, index of the exit that answered each sample); len(exits) is the full network."""
+        thresholds = self.thresholds if thresholds is None else thresholds
+        # Compared in log space, so the heads' softmax is only needed for the samples that leave
+        log_thresholds = torch.as_tensor(thresholds, dtype=torch.float32).log().tolist()
+        out = torch.empty(x.shape[0], 7, device=x.device)
+        exit_at = torch.full((x.shape[0],), len(self.exits), dtype=torch.long, device=x.device)
+        remaining = torch.arange(x.shape[0], device=x.device)
+
+        for stage, head in self._stages():
+            x = stage(x)
+            if head is None:
+                continue
+            log_probs = F.log_softmax(self.heads[head](x), dim=1)
+            done = log_probs.max(dim=1).values >= log_thresholds[head]
+            if not done.any():
+                continue
+            out[remaining[done]] = log_probs[done].to(out.dtype)
+            exit_at[remaining[done]] = head
+            if done.all():
+                return out, exit_at
+            # Only the samples that are still unsure go through the next stages
+            keep = ~done
+            remaining = remaining[keep]
+            x = x[keep]
+
+        out[remaining] = F.log_softmax(self.classifier(x), dim=1).to(out.dtype)
+        return out, exit_at
+
+    def forward(self, x):
+        if self.training:
+            return super(EarlyExitCNN, self).forward(x)
+        out, exit_at = self.forward_early(x)
+        for i, count in enumerate(torch.bincount(exit_at, minlength=len(self.exit_counts)).tolist()):
+            self.exit_counts[i] += count
+        return out
+
+    def exit_rates(self) -> dict:
+        """Share of samples answered by each exit since the model was loaded."""
+        total = sum(self.exit_counts)
+        names = list(self.exits) + ["final"]
+        return {name: count / total if total else 0.0 for name, count in zip(names, self.exit_counts)}
+
+
+class EmbeddingMLP(nn.Module):
+    """
+    Classifier for the landmark/embedding input path: a fixed-length float32
+    vector in, log-probabilities over the 7 emotions out, like CNN.
+
+    With point_dims > 0 the vector is read as points (x, y, z landmarks) that are
+    centred and scaled per sample first, so where the face is in the frame and
+    how large it is do not matter. mean/std hold the feature statistics of the
+    training set and are saved with the weights.
+    """
+
+    def __init__(self, input_dim=LANDMARK_DIM, hidden=(256, 128), point_dims=3, dropout=0.2):
+        super(EmbeddingMLP, self).__init__()
+        self.input_dim = int(input_dim)
+        self.hidden = tuple(int(h) for h in hidden)
+        self.point_dims = int(point_dims)
+        if self.point_dims and self.input_dim % self.point_dims:
+            raise ValueError(f"input_dim {input_dim} is not a multiple of point_dims {point_dims}")
+
+        self.register_buffer("mean", torch.zeros(self.input_dim))
+        self.register_buffer("std", torch.ones(self.input_dim))
+
+        layers, width = [], self.input_dim
+        for h in self.hidden:
+            layers += [nn.Linear(width, h), nn.BatchNorm1d(h), nn.ReLU(), nn.Dropout(dropout)]
+            width = h
+        layers.append(nn.Linear(width, 7))
+        self.layers = nn.Sequential(*layers)
+
+    def arch(self) -> dict:
+        return {"input_dim": self.input_dim, "hidden": list(self.hidden), "point_dims": self.point_dims}
+
+    def normalize_points(self, x):
+        if not self.point_dims:
+            return x
+        points = x.reshape(x.shape[0], -1, self.point_dims)
+        points = points - points.mean(dim=1, keepdim=True)
+        # RMS distance from the centre in the image plane
+        scale = points[..., :2].pow(2).sum(dim=-1).mean(dim=1).sqrt().clamp_min(1e-6)
+        return (points / scale[:, None, None]).reshape(x.shape[0], -1)
+
+    def fused(self) -> nn.Sequential:
+        """
+        Inference-only copy of the eval-mode layers that returns logits: the
+        standardisation and every BatchNorm are folded into the Linear layers and
+        Dropout is gone. Inputs still go through normalize_points first.
+        """
+        modules = [m for m in self.layers if not isinstance(m, nn.Dropout)]
+        fused = []
+        with torch.no_grad():
+            for i, module in enumerate(modules):
+                if not isinstance(module, nn.Linear):
+                    continue
+                weight, bias = module.weight, module.bias
+                if not fused:
+                    # (x - mean) / std, then W x + b
+                    weight, bias = weight / self.std, bias - weight @ (self.mean / self.std)
+                norm = modules[i + 1] if i + 1 < len(modules) else None
+                if isinstance(norm, nn.BatchNorm1d):
+                    gamma = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+                    weight, bias = weight * gamma[:, None], (bias - norm.running_mean) * gamma + norm.bias
+                linear = nn.Linear(weight.shape[1], weight.shape[0])
+                linear.weight.copy_(weight)
+                linear.bias.copy_(bias)
+                fused.append(linear)
+                if i + 2 < len(modules):
+                    fused.append(nn.ReLU())
+        return nn.Sequential(*fused).eval()
+
+    def forward(self, x):
+        x = (self.normalize_points(x) - self.mean) / self.std
+        return F.log_softmax(self.layers(x), dim=1)
@@ -3,9 +3,12 @@ from collections.abc import Callable
 import io
 import torch
 import asyncio
+import numpy as np
 import torchvision.transforms as transforms
 from PIL import Image
 
+from buffer_pool import TensorPool
+
 infer_transform: Callable[[Image.Image], torch.Tensor] = transforms.Compose([
     transforms.Resize((48, 48)),
     transforms.Grayscale(num_output_channels=1),
@@ -23,57 +26,106 @@ EMOTIONS = [
 "Neutral"
 ]
 
+INPUT_SIZE = (48, 48)
+
+def fill_input(slot: torch.Tensor, img: Image.Image):
+    """
+    Writes the infer_transform result for img into a (1, 48, 48) slot in place:
+    resize, grayscale, then scale [0, 255] to [-1, 1].
+    """
+    img = img.resize(INPUT_SIZE, Image.BILINEAR).convert("L")
+    slot[0].copy_(torch.from_numpy(np.array(img)))
+    slot.div_(127.5).sub_(1.0)
+
+def load_cnn(path, device="cpu"):
+    """
+    Builds model_def.CNN in eval mode on device. Accepts a plain state_dict (the
+    default architecture) or {"arch": {...}, "state_dict": ...} for other widths.
+    An arch with "exits" builds model_def.EarlyExitCNN with its calibrated thresholds.
+    """
+    from model_def import CNN, EarlyExitCNN
+    state = torch.load(path, map_location="cpu")
+    if "state_dict" in state and "arch" in state:
+        model = (EarlyExitCNN if "exits" in state["arch"] else CNN)(**state["arch"])
+        state = state["state_dict"]
+    else:
+        model = CNN()
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    return model
+
+def load_mlp(path, device="cpu"):
+    """Builds model_def.EmbeddingMLP in eval mode from {"arch": {...}, "state_dict": ...}."""
+    from model_def import EmbeddingMLP
+    state = torch.load(path, map_location="cpu")
+    model = EmbeddingMLP(**state["arch"])
+    model.load_state_dict(state["state_dict"])
+    model.to(device)
+    model.eval()
+    return model
+
 class EmotionRecognitionModel:
-    def __init__(self, path, version:str=""):
+    def __init__(self, path, version:str="", batch_size:int=8):
         self.path = path
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.version = version
         self.model = None
+        self.tensor_pool = TensorPool(batch_size=batch_size, pin_memory=self.device.type == "cuda")
 
     async def load(self):
         loop = asyncio.get_running_loop()
 
         def _load():
-            from model_def import CNN
-            model = CNN()
-            state = torch.load(self.path, map_location="cpu")
-            model.load_state_dict(state)
-            model.to(self.device)
-            model.eval()
-            return model
+            return load_cnn(self.path, self.device)
 
         self.model = await loop.run_in_executor(None, _load)
 
 
 
-    async def predict(self, data, showClassName:bool=False):
-        if self.model is None:
-            raise RuntimeError("Model not loaded")
-        
+    def _to_image(self, data) -> Image.Image:
         if isinstance(data, Image.Image):
-            img = data
+            return data
 
         elif isinstance(data, (bytes, bytearray)):
-            img = Image.open(io.BytesIO(data))
+            return Image.open(io.BytesIO(data))
 
         elif isinstance(data, str):
-            img = Image.open(data)
+            return Image.open(data)
 
         else:
             raise TypeError("data must be PIL.Image, bytes, or filepath string")
 
+    def _predict_proba_batch(self, images) -> torch.Tensor:
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
 
-        tensor: torch.Tensor = infer_transform(img)
-        tensor = tensor.unsqueeze(0).to(self.device)
+        # Inputs are written into a pooled (B, 1, 48, 48) tensor instead of a fresh one per image
+        batch = self.tensor_pool.acquire()
+        try:
+            outputs = []
+            for start in range(0, len(images), self.tensor_pool.batch_size):
+                chunk = images[start:start + self.tensor_pool.batch_size]
+                for i, img in enumerate(chunk):
+                    fill_input(batch[i], img)
+                inputs = batch[:len(chunk)].to(self.device, non_blocking=True)
+                with torch.no_grad():
+                    # CNN.forward returns log-probabilities
+                    outputs.append(self.model(inputs).exp().cpu())
+            return torch.cat(outputs)
+        finally:
+            self.tensor_pool.release(batch)
+
+    async def predict(self, data, showClassName:bool=False):
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+
+        img = self._to_image(data)
 
         loop = asyncio.get_running_loop()
 
         def _predict():
-            with torch.no_grad():
-                if self.model is None:
-                    raise RuntimeError("Model not loaded")
-                output = self.model(tensor)
-                return output.argmax(dim=1).item()
+            return self._predict_proba_batch([img])[0].argmax().item()
 
         if showClassName is True:
             class_id = await loop.run_in_executor(None, _predict)
@@ -81,6 +133,76 @@ class EmotionRecognitionModel:
         else:
             return await loop.run_in_executor(None, _predict)
 
+    async def predict_proba(self, data) -> torch.Tensor:
+        """Class probabilities over EMOTIONS for a single image."""
+        probs = await self.predict_proba_batch([self._to_image(data)])
+        return probs[0]
+
+    async def predict_proba_batch(self, images) -> torch.Tensor:
+        """Class probabilities over EMOTIONS, shape (len(images), 7)."""
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._predict_proba_batch, list(images))
+
     def toClassName(self, class_id: int) -> str:
         return EMOTIONS[class_id]
 
+
+class EmbeddingModel:
+    """
+    Serves model_def.EmbeddingMLP for the landmark/embedding input path, with
+    the same predict_proba / predict_proba_batch / toClassName interface as
+    EmotionRecognitionModel. Inputs are float32 vectors of input_dim values
+    (decryption.decrypt_embedding). A forward pass takes microseconds, less than
+    handing it to the executor would, so it runs on the event loop.
+    """
+
+    source = "mlp"
+
+    def __init__(self, path, version: str = "", batch_size: int = 64):
+        self.path = path
+        self.version = version
+        self.batch_size = batch_size
+        self.model = None
+        self.layers = None
+        self.input_dim = None
+        self.tensor_pool = None
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+        self.model = await loop.run_in_executor(None, load_mlp, self.path)
+        # Standardisation and BatchNorm folded into the Linear layers: about half the per-call time
+        self.layers = self.model.fused()
+        self.input_dim = self.model.input_dim
+        self.tensor_pool = TensorPool(batch_size=self.batch_size, shape=(self.input_dim,))
+
+    def _predict_proba_batch(self, vectors) -> torch.Tensor:
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+
+        batch = self.tensor_pool.acquire()
+        try:
+            outputs = []
+            for start in range(0, len(vectors), self.batch_size):
+                chunk = vectors[start:start + self.batch_size]
+                for i, vector in enumerate(chunk):
+                    batch[i].copy_(torch.from_numpy(np.asarray(vector, dtype=np.float32)))
+                with torch.inference_mode():
+                    logits = self.layers(self.model.normalize_points(batch[:len(chunk)]))
+                    outputs.append(torch.softmax(logits, dim=1))
+            return torch.cat(outputs)
+        finally:
+            self.tensor_pool.release(batch)
+
+    async def predict_proba(self, vector) -> torch.Tensor:
+        """Class probabilities over EMOTIONS for a single vector."""
+        return self._predict_proba_batch([vector])[0]
+
+    async def predict_proba_batch(self, vectors) -> torch.Tensor:
+        """Class probabilities over EMOTIONS, shape (len(vectors), 7)."""
+        return self._predict_proba_batch(list(vectors))
+
+    def toClassName(self, class_id: int) -> str:
+        return EMOTIONS[class_id]
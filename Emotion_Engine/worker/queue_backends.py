@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryQueue:
+    """In-memory FIFO with the same put/get/ack interface as DurableQueue."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def put(self, uid: str, payload: bytes, digest: bytes):
+        await self.queue.put((None, uid, payload, digest))
+        return None
+
+    async def get(self):
+        """Returns (entry_id, uid, payload, digest)."""
+        return await self.queue.get()
+
+    def ack(self, entry_id):
+        self.queue.task_done()
+
+    def pending_digests(self):
+        return []
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    def close(self):
+        pass
+
+
+class RateLimited(Exception):
+    """Raised by FairQueue.put when a uid has used up its token bucket."""
+
+
+class FairQueue:
+    """
+    In-memory queue that shares the worker fairly between uids.
+
+    Each uid has its own sub-queue and the worker serves them by deficit round
+    robin, so a client streaming frames at camera rate gets the same share as
+    one sending a frame now and then instead of everything queued behind it.
+    Every frame costs the same (images are resized before inference), so the
+    deficit counts frames; weights gives a uid a larger share per round.
+
+    rate/burst put a token bucket on each uid (frames per second, 0 for no
+    limit); put() raises RateLimited once it is empty. keep_newest > 0
+    coalesces a uid's backlog to its newest frames: older pending ones are
+    discarded and reported through on_discard(digest). Nothing is persisted.
+    """
+
+    def __init__(self, rate: float = 0.0, burst: int = 10, keep_newest: int = 0,
+                 weights: dict[str, int] | None = None, quantum: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.keep_newest = keep_newest
+        self.weights = weights or {}
+        self.quantum = quantum
+        self.pending: dict[str, deque] = {}
+        # uids with pending frames, in round robin order
+        self.active: deque[str] = deque()
+        self.deficit: dict[str, int] = {}
+        # uid -> (tokens, time of last refill)
+        self.buckets: dict[str, tuple[float, float]] = {}
+        self.size = 0
+        self.nonempty = asyncio.Event()
+        self.on_discard = None
+        self.rate_limited = 0
+        self.coalesced = 0
+
+    def _take_token(self, uid: str) -> bool:
+        now = time.monotonic()
+        tokens, last = self.buckets.get(uid, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[uid] = (tokens, now)
+            return False
+        self.buckets[uid] = (tokens - 1, now)
+        # Full buckets of idle uids carry no state worth keeping
+        if len(self.buckets) > 4 * max(len(self.pending), 256):
+            self._prune_buckets(now)
+        return True
+
+    def _prune_buckets(self, now: float):
+        self.buckets = {
+            uid: (tokens, last) for uid, (tokens, last) in self.buckets.items()
+            if uid in self.pending or tokens + (now - last) * self.rate < self.burst
+        }
+
+    async def put(self, uid: str, payload: bytes, digest: bytes):
+        if self.rate > 0 and not self._take_token(uid):
+            self.rate_limited += 1
+            raise RateLimited(f"More than {self.rate:g} requests/s (burst {self.burst})")
+
+        queue = self.pending.get(uid)
+        if queue is None:
+            queue = self.pending[uid] = deque()
+            self.active.append(uid)
+            self.deficit[uid] = 0
+        queue.append((None, uid, payload, digest))
+        self.size += 1
+
+        if self.keep_newest:
+            while len(queue) > self.keep_newest:
+                _, _, _, stale = queue.popleft()
+                self.size -= 1
+                self.coalesced += 1
+                if self.on_discard is not None:
+                    self.on_discard(stale)
+
+        self.nonempty.set()
+        return None
+
+    def _next(self):
+        uid = self.active[0]
+        if self.deficit[uid] < 1:
+            # A new round for this uid
+            self.deficit[uid] += self.quantum * self.weights.get(uid, 1)
+        queue = self.pending[uid]
+        entry = queue.popleft()
+        self.size -= 1
+        self.deficit[uid] -= 1
+        if not queue:
+            # An idle uid does not bank credit for later
+            self.active.popleft()
+            del self.pending[uid], self.deficit[uid]
+        elif self.deficit[uid] < 1:
+            self.active.rotate(-1)
+        return entry
+
+    async def get(self):
+        """Returns (entry_id, uid, payload, digest)."""
+        while not self.active:
+            self.nonempty.clear()
+            await self.nonempty.wait()
+        return self._next()
+
+    def ack(self, entry_id):
+        pass
+
+    def pending_digests(self):
+        return []
+
+    def qsize(self) -> int:
+        return self.size
+
+    def depth(self, uid: str) -> int:
+        queue = self.pending.get(uid)
+        return len(queue) if queue is not None else 0
+
+    def depths(self) -> dict[str, int]:
+        """Pending frames per uid, for uids that have any."""
+        return {uid: len(queue) for uid, queue in self.pending.items()}
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.pending),
+            "pending": self.size,
+            "max_depth": max((len(queue) for queue in self.pending.values()), default=0),
+            "rate_limited": self.rate_limited,
+            "coalesced": self.coalesced,
+        }
+
+    def close(self):
+        pass
+
+
+class DurableQueue:
+    """
+    Request queue persisted in a WAL-mode SQLite file.
+
+    Every request is written before put() returns and deleted only when ack() is
+    called after its result was stored, so anything queued or in flight at a crash
+    is replayed on the next start. Inserts are group-committed on a writer thread
+    with its own connection: puts that arrive while a commit is in progress are
+    written together in the next transaction, and the event loop never waits on
+    the disk for them. Payloads of the oldest requests are kept in a hot window in
+    memory up to hot_bytes; once it is full new requests live only on disk and are
+    read back (through SQLite's memory map) as the window drains.
+    """
+
+    def __init__(self, db_path: str = "queue.db", hot_bytes: int = 64 * 1024 * 1024,
+                 mmap_bytes: int = 256 * 1024 * 1024, compact_every: int = 1000):
+        self.db_path = db_path
+        self.hot_bytes = hot_bytes
+        self.compact_every = compact_every
+        self.hot = deque()
+        self.hot_size = 0
+        self.disk_backlog = 0
+        self.last_loaded_id = 0
+        self.acks_since_compaction = 0
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._init_db(mmap_bytes)
+        self._replay()
+        # Only used on the writer thread
+        self.writer_conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.writer_conn.execute("PRAGMA synchronous = NORMAL")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queue-writer")
+        self.inserts: list[tuple[str, bytes, bytes, asyncio.Future]] = []
+        self.inserting = False
+        # Highest id counted in hot/disk_backlog; _refill must not read past it
+        self.last_put_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM pending_requests").fetchone()[0]
+
+    def _init_db(self, mmap_bytes: int):
+        cursor = self.conn.cursor()
+        # auto_vacuum only takes effect on a new database file
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute(f"PRAGMA mmap_size = {int(mmap_bytes)}")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pending_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                digest BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _replay(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM pending_requests").fetchone()[0]
+        if count:
+            logger.info("Replaying %d unacknowledged requests from %s", count, self.db_path)
+        self.disk_backlog = count
+        self.available = asyncio.Semaphore(count)
+
+    def pending_digests(self):
+        rows = self.conn.execute(
+            "SELECT digest FROM pending_requests WHERE digest IS NOT NULL ORDER BY id"
+        )
+        return [row[0] for row in rows]
+
+    def _insert_rows(self, rows) -> list[int]:
+        """Writer thread: one transaction for a batch of puts; returns their ids in order."""
+        ids = []
+        with self.writer_conn:
+            for uid, payload, digest in rows:
+                cursor = self.writer_conn.execute(
+                    "INSERT INTO pending_requests (uid, payload, digest) VALUES (?, ?, ?)",
+                    (uid, payload, digest),
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    async def _write_inserts(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.inserts:
+                batch, self.inserts = self.inserts, []
+                try:
+                    ids = await loop.run_in_executor(
+                        self.writer, self._insert_rows, [(uid, payload, digest) for uid, payload, digest, _ in batch]
+                    )
+                except Exception as e:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                # Queued here rather than in put(), so a cancelled put() still leaves its row accounted for
+                for entry_id, (uid, payload, digest, future) in zip(ids, batch):
+                    self._enqueued(entry_id, uid, payload, digest)
+                    if not future.done():
+                        future.set_result(entry_id)
+        finally:
+            self.inserting = False
+
+    def _enqueued(self, entry_id: int, uid: str, payload: bytes, digest: bytes):
+        self.last_put_id = entry_id
+        # Keep FIFO order: once anything has spilled, newer requests spill too
+        if self.disk_backlog == 0 and self.hot_size + len(payload) <= self.hot_bytes:
+            self.hot.append((entry_id, uid, payload, digest))
+            self.hot_size += len(payload)
+            self.last_loaded_id = entry_id
+        else:
+            self.disk_backlog += 1
+        self.available.release()
+
+    async def put(self, uid: str, payload: bytes, digest: bytes):
+        future = asyncio.get_running_loop().create_future()
+        self.inserts.append((uid, payload, digest, future))
+        if not self.inserting:
+            self.inserting = True
+            self.insert_task = asyncio.create_task(self._write_inserts())
+        # Returns once the row is committed
+        return await asyncio.shield(future)
+
+    def _refill(self):
+        rows = self.conn.execute(
+            "SELECT id, uid, payload, digest FROM pending_requests WHERE id > ? AND id <= ? ORDER BY id",
+            (self.last_loaded_id, self.last_put_id),
+        )
+        for entry_id, uid, payload, digest in rows:
+            if self.hot and self.hot_size + len(payload) > self.hot_bytes:
+                break
+            self.hot.append((entry_id, uid, bytes(payload), digest))
+            self.hot_size += len(payload)
+            self.last_loaded_id = entry_id
+            self.disk_backlog -= 1
+
+    async def get(self):
+        """Returns (entry_id, uid, payload, digest)."""
+        await self.available.acquire()
+        if not self.hot:
+            self._refill()
+        entry = self.hot.popleft()
+        self.hot_size -= len(entry[2])
+        return entry
+
+    def ack(self, entry_id):
+        """Forget a request once its result has been written."""
+        self.conn.execute("DELETE FROM pending_requests WHERE id = ?", (entry_id,))
+        self.acks_since_compaction += 1
+        if self.acks_since_compaction >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Fold the WAL back into the database and release freed pages."""
+        self.acks_since_compaction = 0
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("PRAGMA incremental_vacuum")
+
+    def qsize(self) -> int:
+        return len(self.hot) + self.disk_backlog
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.writer_conn.close()
+        self.compact()
+        self.conn.close()
@@ -1,64 +1,280 @@
 import asyncio
-from rich.console import Console
-from rich.panel import Panel
+import logging
+import time
 from storage import KeyStorage
 from decryption import decrypt_image
-from model_loader import EmotionRecognitionModel
+from model_loader import EmotionRecognitionModel, EMOTIONS
+from result_cache import ResultCache
+from buffer_pool import BytearrayPool, MemoryAccounting
+from queue_backends import MemoryQueue
+from log_config import dropped_records
 # from .external_client import send_result # Circular import risk? No, external_client is separate.
 import datetime
 
+logger = logging.getLogger(__name__)
+
+
+class ResultNotSaved(Exception):
+    """A classified frame whose user_emotion row could not be written; only the write is retried."""
+
+    def __init__(self, class_name: str, confidence: float, timestamp: datetime.datetime):
+        super().__init__("user_emotion row was not written")
+        self.class_name = class_name
+        self.confidence = confidence
+        self.timestamp = timestamp
+
+
 class RequestQueue:
-    def __init__(self, model: EmotionRecognitionModel, storage: KeyStorage):
-        self.console = Console()
-        self.queue = asyncio.Queue()
+    def __init__(self, model: EmotionRecognitionModel, storage: KeyStorage, cache_size: int = 10000,
+                 backend=None, aggregator=None, save_raw: bool = True, broker=None, decrypt=None):
+        # MemoryQueue, DurableQueue or FairQueue
+        self.queue = backend or MemoryQueue()
+        if hasattr(self.queue, "on_discard"):
+            self.queue.on_discard = self._discarded
         self.model = model
         self.storage = storage
+        # decrypt(encrypted, key, pool=, memory=) -> model input; images (decrypt_image) if None
+        self.decrypt = decrypt
+        self.cache = ResultCache(cache_size)
+        # Reused decrypt buffers and bytes held by in-flight requests
+        self.buffers = BytearrayPool()
+        self.memory = MemoryAccounting()
+        # DailyEmotionAggregator; raw per-frame rows are only written if save_raw
+        self.aggregator = aggregator
+        self.save_raw = save_raw
+        # ResultBroker feeding SubscribeResults streams
+        self.broker = broker
+        # Wall-clock enqueue time per digest, for the queue_ms/total_ms timings
+        self.enqueued_at: dict[bytes, float] = {}
+        self.processed = 0
+        self.stats_interval = 100
         self.running = False
+        # Requests that failed transiently are retried in the background with exponential
+        # backoff (retry_backoff, 2x, 4x, ... capped at max_backoff) up to max_attempts tries;
+        # their queue entries stay unacknowledged until then
+        self.max_attempts = 5
+        self.retry_backoff = 1.0
+        self.max_backoff = 60.0
+        self.retrying: set[asyncio.Task] = set()
+        self.given_up = 0
+        # The worker's pending queue.get(), cancelled by stop() while it waits
+        self.getting: asyncio.Future | None = None
 
     async def enqueue(self, uid: str, encrypted_image: bytes):
-        await self.queue.put((uid, encrypted_image))
+        """
+        Queues an image unless the same (uid, encrypted_image) was already processed
+        or is in flight. Returns (future resolving to the class name or None, duplicate).
+        Raises RateLimited if a FairQueue backend refused the image.
+        """
+        digest = ResultCache.digest(uid, encrypted_image)
+        future, duplicate = self.cache.lookup(digest)
+        if not duplicate:
+            self.enqueued_at[digest] = time.time()
+            try:
+                await self.queue.put(uid, encrypted_image, digest)
+            except Exception:
+                self._discarded(digest)
+                raise
+        return future, duplicate
+
+    def _discarded(self, digest: bytes):
+        """A queued image that will never be processed (refused or coalesced away)."""
+        self.enqueued_at.pop(digest, None)
+        self.cache.fail(digest)
 
     async def start_worker(self):
         self.running = True
-        print("Worker started")
+        # Requests replayed from a durable queue coalesce with their retries
+        for digest in self.queue.pending_digests():
+            self.cache.lookup(digest)
+        logger.info("Worker started")
         while self.running:
+            self.getting = asyncio.ensure_future(self.queue.get())
             try:
-                uid, encrypted_image = await self.queue.get()
-                await self.process_request(uid, encrypted_image)
-                self.queue.task_done()
-            except Exception as e:
-                print(f"Worker error: {e}")
+                entry_id, uid, encrypted_image, digest = await self.getting
+            except asyncio.CancelledError:
+                if self.running:
+                    raise
+                break
+            # Unknown for requests replayed from a previous run
+            enqueued_at = self.enqueued_at.pop(digest, None)
+            done, class_name, unsaved = await self._attempt(uid, encrypted_image, enqueued_at)
+            if done:
+                self._finish(entry_id, digest, class_name)
+            else:
+                # Retried off the worker loop so other users' frames are not held up
+                task = asyncio.create_task(self._retry(entry_id, uid, encrypted_image, digest, enqueued_at, unsaved))
+                self.retrying.add(task)
+                task.add_done_callback(self.retrying.discard)
+
+            self.processed += 1
+            if self.processed % self.stats_interval == 0:
+                logger.info("Queue stats", extra={
+                    "cache": self.cache.stats(), "memory": self.memory_stats(), "log_dropped": dropped_records(),
+                    "subscriptions": self.broker.stats() if self.broker is not None else None,
+                    "scheduler": self.queue.stats() if hasattr(self.queue, "stats") else None,
+                    "retrying": len(self.retrying), "given_up": self.given_up,
+                })
+                if hasattr(self.queue, "depths"):
+                    self.log_deepest()
+
+    async def _attempt(self, uid: str, encrypted_image: bytes, enqueued_at: float | None,
+                       unsaved: ResultNotSaved | None = None):
+        """
+        One try at a request, or only at writing its result if it was already
+        classified (unsaved). Returns (done, class name or None if given up, unsaved);
+        done is False if it failed transiently and should be retried.
+        """
+        try:
+            if unsaved is not None:
+                return True, await self._save_result(uid, unsaved.class_name, unsaved.confidence,
+                                                     unsaved.timestamp), None
+            return True, await self.process_request(uid, encrypted_image, enqueued_at), None
+        except ResultNotSaved as e:
+            logger.warning("Result not written, will retry", extra={"uid": uid})
+            return False, None, e
+        except Exception:
+            logger.exception("Worker error, will retry", extra={"uid": uid})
+            return False, None, unsaved
+
+    async def _retry(self, entry_id, uid: str, encrypted_image: bytes, digest: bytes, enqueued_at: float | None,
+                     unsaved: ResultNotSaved | None):
+        for attempt in range(1, self.max_attempts):
+            await asyncio.sleep(min(self.retry_backoff * 2 ** (attempt - 1), self.max_backoff))
+            done, class_name, unsaved = await self._attempt(uid, encrypted_image, enqueued_at, unsaved)
+            if done:
+                self._finish(entry_id, digest, class_name)
+                return
+        logger.error("Giving up on request after %d attempts", self.max_attempts, extra={"uid": uid})
+        self._finish(entry_id, digest, None)
+
+    def _finish(self, entry_id, digest: bytes, class_name: str | None):
+        """
+        Acknowledges a request whose result was written, or which was given up on
+        for good (unknown key, undecryptable payload, out of retries). A counted
+        frame is acked only once the aggregator has checkpointed it, so a crash
+        before that replays the request instead of losing the count.
+        """
+        if class_name is not None and self.aggregator is not None:
+            self.aggregator.saved().add_done_callback(lambda _: self.queue.ack(entry_id))
+        else:
+            self.queue.ack(entry_id)
+        if class_name is None:
+            self.given_up += 1
+            self.cache.fail(digest)
+        else:
+            self.cache.complete(digest, class_name)
+
+    def stop(self):
+        """Ends start_worker after the request in progress, or right away if it is idle."""
+        self.running = False
+        if self.getting is not None:
+            self.getting.cancel()
+
+    def cancel_retries(self):
+        """
+        Stops pending retries at shutdown. Their entries stay unacknowledged, so a
+        DurableQueue replays them on the next start.
+        """
+        for task in self.retrying:
+            task.cancel()
+
+    def log_deepest(self, count: int = 5):
+        """Logs the uids with the longest backlogs (through the uid redaction like any other uid)."""
+        depths = self.queue.depths()
+        for uid in sorted(depths, key=depths.get, reverse=True)[:count]:
+            logger.info("User queue depth", extra={"uid": uid, "depth": depths[uid]})
+
+    def memory_stats(self) -> dict:
+        stats = {
+            "in_flight_bytes": self.memory.current,
+            "peak_bytes": self.memory.peak,
+            "pooled_bytes": self.buffers.pooled_bytes(),
+            "buffer_hits": self.buffers.hits,
+            "buffer_misses": self.buffers.misses,
+        }
+        tensor_pool = getattr(self.model, "tensor_pool", None) or getattr(getattr(self.model, "cnn", None), "tensor_pool", None)
+        if tensor_pool is not None:
+            stats["tensor_hits"] = tensor_pool.hits
+            stats["tensor_misses"] = tensor_pool.misses
+        return stats
+
+    async def process_request(self, uid: str, encrypted_image: bytes, enqueued_at: float | None = None):
+        with self.memory.track() as held:
+            return await self._process_request(uid, encrypted_image, held, enqueued_at)
+
+    async def _process_request(self, uid: str, encrypted_image: bytes, held, enqueued_at: float | None):
+        logger.debug("Processing request", extra={"uid": uid, "per_request": True})
+        started_at = time.time()
+        started = time.perf_counter()
 
-    async def process_request(self, uid: str, encrypted_image: bytes):
-        print(f"Processing request for {uid}")
-        
         # 1. Get Key
         key = self.storage.get_key(uid)
         if not key:
-            print(f"Key not found for {uid}")
-            return
+            logger.warning("Key not found, giving up on request", extra={"uid": uid})
+            return None
 
         # 2. Decrypt
         try:
-            image = decrypt_image(encrypted_image, key)
+            if self.decrypt is not None:
+                image = self.decrypt(encrypted_image, key, pool=self.buffers, memory=held)
+            else:
+                image = decrypt_image(encrypted_image, key, pool=self.buffers, memory=held)
         except Exception as e:
-            print(f"Decryption failed for {uid}: {e}")
-            return
+            logger.warning("Decryption failed, giving up on request: %s", e, extra={"uid": uid})
+            return None
+        decrypted = time.perf_counter()
 
-        # 3. Predict
-        try:
-            # model.predict is async
-            # model.predict is async
-            class_name = await self.model.predict(image, showClassName=True)
-            self.console.print(Panel(f"[bold green]EMOTION DETECTED: {class_name}[/bold green]", title=f"Prediction for {uid}", expand=False))
-        except Exception as e:
-            print(f"Prediction failed for {uid}: {e}")
-            return
+        # 3. Predict (a failure, e.g. the model not loaded yet, is raised and retried)
+        # model.predict_proba is async; the cascade also reports which model answered
+        if hasattr(self.model, "predict_proba_with_source"):
+            probs, source = await self.model.predict_proba_with_source(image)
+        else:
+            probs, source = await self.model.predict_proba(image), getattr(self.model, "source", "cnn")
+        class_id = int(probs.argmax().item())
+        class_name = self.model.toClassName(class_id)
+        confidence = float(probs[class_id])
+        logger.info("Emotion detected: %s", class_name, extra={
+            "uid": uid, "emotion": class_name, "confidence": round(confidence, 4), "per_request": True,
+        })
+        predicted = time.perf_counter()
 
         # 4. Send Result
-        try:
-            from supabase_client import save_user_emotion
-            timestamp = datetime.datetime.now().isoformat()
-            await save_user_emotion(uid, class_name, timestamp)
-        except Exception as e:
-            print(f"Failed to send result for {uid}: {e}")
+        if self.broker is not None:
+            finished_at = time.time()
+            self.broker.publish(uid, {
+                "uid": uid,
+                "class_name": class_name,
+                "probabilities": dict(zip(EMOTIONS, probs.tolist())),
+                "model_version": getattr(self.model, "version", ""),
+                "source": source,
+                "timestamp_ms": int(finished_at * 1000),
+                "queue_ms": (started_at - enqueued_at) * 1000 if enqueued_at else 0.0,
+                "decrypt_ms": (decrypted - started) * 1000,
+                "inference_ms": (predicted - decrypted) * 1000,
+                "total_ms": (finished_at - (enqueued_at or started_at)) * 1000,
+            })
+
+        return await self._save_result(uid, class_name, confidence, datetime.datetime.now())
+
+    async def _save_result(self, uid: str, class_name: str, confidence: float, timestamp: datetime.datetime):
+        """
+        Writes the raw row (if save_raw) and counts the frame in the daily aggregates.
+        Raises ResultNotSaved if the row was not written: the gRPC caller was already
+        answered, so the worker retries the write itself and counts the frame only once
+        it succeeds.
+        """
+        if self.save_raw:
+            try:
+                from supabase_client import save_user_emotion
+                saved = await save_user_emotion(uid, class_name, timestamp.isoformat())
+            except Exception as e:
+                logger.warning("Failed to send result: %s", e, extra={"uid": uid})
+                saved = False
+            if not saved:
+                raise ResultNotSaved(class_name, confidence, timestamp)
+
+        if self.aggregator is not None:
+            self.aggregator.add(uid, class_name, confidence, timestamp)
+
+        return class_name
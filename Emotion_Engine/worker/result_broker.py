@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One subscriber's bounded buffer; a None item means it was dropped for being slow."""
+
+    def __init__(self, uids: frozenset[str], buffer_size: int):
+        self.uids = uids
+        self.queue: asyncio.Queue = asyncio.Queue(buffer_size)
+        self.dropped = False
+        self.delivered = 0
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class ResultBroker:
+    """
+    Fans completed predictions out to SubscribeResults streams.
+
+    Subscribers either filter on a set of uids or receive everything. Each has a
+    bounded buffer; publish() never waits, and a subscriber whose buffer is full
+    is dropped (its stream is ended) instead of slowing down the worker or the
+    other subscribers. encode turns a result into what the streams send (the
+    protobuf message) once per result rather than once per subscriber.
+    """
+
+    def __init__(self, encode: Callable = lambda result: result, default_buffer: int = 256,
+                 max_buffer: int = 4096):
+        self.encode = encode
+        self.default_buffer = default_buffer
+        self.max_buffer = max_buffer
+        self.by_uid: dict[str, set[Subscription]] = {}
+        self.everything: set[Subscription] = set()
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    def subscribe(self, uids=(), buffer_size: int = 0) -> Subscription:
+        size = min(buffer_size or self.default_buffer, self.max_buffer)
+        subscription = Subscription(frozenset(uids), size)
+        if subscription.uids:
+            for uid in subscription.uids:
+                self.by_uid.setdefault(uid, set()).add(subscription)
+        else:
+            self.everything.add(subscription)
+        logger.info("Result subscriber added", extra={"filter_uids": len(subscription.uids), "buffer": size})
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription.uids:
+            for uid in subscription.uids:
+                subscribers = self.by_uid.get(uid)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.by_uid[uid]
+        else:
+            self.everything.discard(subscription)
+
+    def _drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        subscription.dropped = True
+        self.dropped_subscribers += 1
+        # Make room for the end-of-stream marker; the stream is ended anyway
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+        logger.warning("Dropped slow result subscriber", extra={"delivered": subscription.delivered})
+
+    def publish(self, uid: str, result: dict):
+        subscribers = self.by_uid.get(uid)
+        if not subscribers and not self.everything:
+            return
+        self.published += 1
+        result["sequence"] = self.published
+        message = self.encode(result)
+        for subscription in list(self.everything) + list(subscribers or ()):
+            try:
+                subscription.queue.put_nowait(message)
+                subscription.delivered += 1
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.everything) + len({s for subs in self.by_uid.values() for s in subs}),
+            "published": self.published,
+            "dropped_subscribers": self.dropped_subscribers,
+        }
@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Bounded cache of recent results keyed by a digest of (uid, encrypted_image).
+    Requests whose digest is still being processed share the pending future
+    instead of being decrypted and classified again.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.results: OrderedDict[bytes, object] = OrderedDict()
+        self.pending: dict[bytes, asyncio.Future] = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(uid: str, payload: bytes) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(uid.encode("utf-8"))
+        h.update(b"\0")
+        h.update(payload)
+        return h.digest()
+
+    def lookup(self, digest: bytes):
+        """
+        Returns (future, duplicate). For a new digest a fresh pending future is
+        registered and duplicate is False; the caller must then process it and call
+        complete() or fail().
+        """
+        if digest in self.results:
+            self.hits += 1
+            self.results.move_to_end(digest)
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(self.results[digest])
+            return future, True
+
+        if digest in self.pending:
+            self.coalesced += 1
+            return self.pending[digest], True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[digest] = future
+        return future, False
+
+    def complete(self, digest: bytes, result):
+        self.results[digest] = result
+        self.results.move_to_end(digest)
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+        future = self.pending.pop(digest, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def fail(self, digest: bytes):
+        # Failures are not cached so that a retry is processed again
+        future = self.pending.pop(digest, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.coalesced + self.misses
+        return {
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.coalesced) / total if total else 0.0,
+            "cached": len(self.results),
+            "pending": len(self.pending),
+        }
@@ -0,0 +1,489 @@
+"""
+EmotionService front end that spreads uids over several workers.
+
+Every worker keeps its keys in its own keys.db, so SendDecryptionKey and the
+later SendEncryptedImage for a uid must reach the same worker. The router
+implements EmotionService and forwards each call by consistent hashing on the
+uid (hash_ring.HashRing):
+
+- Keys go to the uid's first ROUTER_KEY_REPLICAS workers (owner plus
+  replicas). Images and embeddings go to the first healthy one, so a failed
+  owner is skipped without waiting for a rebalance.
+- Workers are polled with CheckHealth. A failed forward counts as a failed
+  probe. After ROUTER_HEALTH_FALL failures a worker leaves the ring, and after
+  ROUTER_HEALTH_RISE successes it rejoins.
+- On every membership change the keys whose preference list gained a worker
+  are pushed to it from the router's own key store (ROUTER_KEY_DB_PATH). The
+  new ring is only used for images once that push is done.
+- A key that could not reach one of its workers (unhealthy but still in the
+  ring, or a failed forward) is remembered for that worker. The worker gets
+  no images for that uid until a health check has re-sent the key.
+- Each worker is reached through ROUTER_CHANNELS_PER_BACKEND channels
+  (separate HTTP/2 connections), used round-robin.
+- SubscribeResults merges the streams of all workers. It ends with
+  UNAVAILABLE when membership changes, so subscribers resubscribe and pick up
+  new workers.
+
+    ROUTER_BACKENDS=localhost:50061,localhost:50062 GRPC_PORT=50051 python router.py
+
+run_cluster.py starts a router with several local workers.
+"""
+import asyncio
+import logging
+import os
+import sys
+
+import grpc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../proto'))
+
+import interface_pb2
+import interface_pb2_grpc
+
+from hash_ring import HashRing
+from log_config import setup_logging_from_env, stop_logging
+from storage import KeyStorage
+from transport import TransportConfig, add_ports, channel_options, create_server
+
+logger = logging.getLogger(__name__)
+
+# Codes for which the request most likely never reached the worker, so trying a replica is safe
+RETRYABLE = {grpc.StatusCode.UNAVAILABLE}
+
+# Keys per SendDecryptionKeys call when re-provisioning
+REPROVISION_BATCH = 500
+
+
+class Backend:
+    """One worker: a small pool of channels and its health state."""
+
+    def __init__(self, address: str, channels: int = 2, options=()):
+        self.address = address
+        self.channels = [grpc.aio.insecure_channel(address, options=options) for _ in range(max(1, channels))]
+        self.stubs = [interface_pb2_grpc.EmotionServiceStub(channel) for channel in self.channels]
+        self.next_stub = 0
+        # Out of the ring until the first successful health check
+        self.healthy = False
+        self.successes = 0
+        self.failures = 0
+        self.queued = 0
+        self.processed = 0
+        self.forwarded = 0
+        self.errors = 0
+        # uid -> latest key this worker missed; it gets no traffic for those uids until resynced
+        self.stale_keys: dict[str, str] = {}
+        # Orders key pushes to this worker, so a resync cannot overwrite a newer key
+        self.key_lock = asyncio.Lock()
+
+    def stub(self) -> interface_pb2_grpc.EmotionServiceStub:
+        stub = self.stubs[self.next_stub]
+        self.next_stub = (self.next_stub + 1) % len(self.stubs)
+        return stub
+
+    def record(self, ok: bool, rise: int, fall: int) -> bool:
+        """Counts a probe result; returns True if the backend changed between healthy and not."""
+        if ok:
+            self.successes += 1
+            self.failures = 0
+            if not self.healthy and self.successes >= rise:
+                self.healthy = True
+                return True
+        else:
+            self.failures += 1
+            self.successes = 0
+            if self.healthy and self.failures >= fall:
+                self.healthy = False
+                return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "queued": self.queued,
+            "forwarded": self.forwarded,
+            "errors": self.errors,
+            "stale_keys": len(self.stale_keys),
+        }
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+
+
+class ClusterRouter:
+    """Ring membership, health checks and key re-provisioning for RouterService."""
+
+    def __init__(self, addresses, storage: KeyStorage, replicas: int = 2, vnodes: int = 128,
+                 channels_per_backend: int = 2, health_interval: float = 2.0, health_timeout: float = 1.0,
+                 rise: int = 2, fall: int = 2, call_timeout: float = 10.0, options=()):
+        if not addresses:
+            raise ValueError("ClusterRouter needs at least one backend address")
+        self.backends = {address: Backend(address, channels_per_backend, options) for address in addresses}
+        self.storage = storage
+        self.replicas = max(1, replicas)
+        self.vnodes = vnodes
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.rise = rise
+        self.fall = fall
+        self.call_timeout = call_timeout
+        self.ring = HashRing((), vnodes)
+        # The ring being provisioned; keys are written to both rings until it takes over
+        self.next_ring: HashRing | None = None
+        self.membership_changed = asyncio.Event()
+        self.rebalance_lock = asyncio.Lock()
+        self.rebalance_task: asyncio.Task | None = None
+        self.rebalances = 0
+        self.keys_reprovisioned = 0
+        self.running = False
+
+    def healthy(self, nodes) -> list[Backend]:
+        return [self.backends[node] for node in nodes if self.backends[node].healthy]
+
+    def route(self, uid: str) -> list[Backend]:
+        """Healthy workers that hold uid's current key, owner first."""
+        return [backend for backend in self.healthy(self.ring.preference(uid, self.replicas))
+                if uid not in backend.stale_keys]
+
+    def key_targets(self, uid: str) -> list[str]:
+        targets = self.ring.preference(uid, self.replicas)
+        if self.next_ring is not None:
+            targets += [node for node in self.next_ring.preference(uid, self.replicas) if node not in targets]
+        return targets
+
+    def failed(self, backend: Backend):
+        """Passive health check: a forward that failed with a retryable code."""
+        backend.errors += 1
+        if backend.record(False, self.rise, self.fall):
+            logger.warning("Worker marked unhealthy after failed calls", extra={"backend": backend.address})
+            self.schedule_rebalance()
+
+    def schedule_rebalance(self):
+        if self.rebalance_task is None or self.rebalance_task.done():
+            self.rebalance_task = asyncio.create_task(self.rebalance())
+
+    async def _probe(self, backend: Backend) -> bool:
+        try:
+            response = await backend.stub().CheckHealth(interface_pb2.HealthRequest(), timeout=self.health_timeout)
+            ok = response.serving
+            backend.queued = response.queued
+            backend.processed = response.processed
+        except grpc.aio.AioRpcError:
+            ok = False
+        changed = backend.record(ok, self.rise, self.fall)
+        if changed:
+            logger.info("Worker %s", "healthy" if backend.healthy else "unhealthy", extra={"backend": backend.address})
+        return changed
+
+    async def check_health(self):
+        changed = await asyncio.gather(*(self._probe(backend) for backend in self.backends.values()))
+        if any(changed):
+            await self.rebalance()
+        await self.resync_keys()
+
+    async def resync_keys(self):
+        """Re-sends healthy workers the keys they missed."""
+        await asyncio.gather(*(
+            self._push_keys(backend, list(backend.stale_keys.items()))
+            for backend in self.backends.values() if backend.healthy and backend.stale_keys
+        ))
+
+    async def run_health_checks(self):
+        self.running = True
+        checks = 0
+        while self.running:
+            await self.check_health()
+            checks += 1
+            if checks % 30 == 0:
+                logger.info("Router stats", extra=self.stats())
+            await asyncio.sleep(self.health_interval)
+
+    async def start(self):
+        """Probes until the first ring can be formed (rise successes per worker) or gives up."""
+        for _ in range(self.rise):
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends.values()))
+        await self.rebalance()
+        if not len(self.ring):
+            logger.warning("No healthy workers yet; calls fail with UNAVAILABLE until one passes its health checks")
+
+    def _moved_keys(self, old: HashRing, new: HashRing) -> dict[str, list[tuple[str, str]]]:
+        """Keys per worker that the new ring assigns to it but the old ring did not."""
+        moved: dict[str, list[tuple[str, str]]] = {}
+        for uid, key in self.storage.all_keys():
+            previous = old.preference(uid, self.replicas)
+            for node in new.preference(uid, self.replicas):
+                if node not in previous:
+                    moved.setdefault(node, []).append((uid, key))
+        return moved
+
+    async def _push_keys(self, backend: Backend, items) -> int:
+        stored = 0
+        async with backend.key_lock:
+            for start in range(0, len(items), REPROVISION_BATCH):
+                batch = items[start:start + REPROVISION_BATCH]
+                request = interface_pb2.KeyBatchRequest(
+                    keys=[interface_pb2.KeyRequest(uid=uid, key=key) for uid, key in batch]
+                )
+                try:
+                    response = await backend.stub().SendDecryptionKeys(request, timeout=self.call_timeout)
+                except grpc.aio.AioRpcError as e:
+                    logger.error("Key re-provisioning failed: %s", e.details(), extra={"backend": backend.address})
+                    break
+                sent = dict(batch)
+                for status in response.statuses:
+                    if status.success:
+                        stored += 1
+                        # Unless a newer key went stale since this one was read
+                        if backend.stale_keys.get(status.uid) == sent[status.uid]:
+                            del backend.stale_keys[status.uid]
+        return stored
+
+    async def rebalance(self):
+        """Rebuilds the ring from the healthy workers, moving keys to their new owners first."""
+        async with self.rebalance_lock:
+            nodes = frozenset(address for address, backend in self.backends.items() if backend.healthy)
+            if nodes == self.ring.nodes:
+                return
+            old, new = self.ring, HashRing(nodes, self.vnodes)
+            self.next_ring = new
+            moved = 0
+            try:
+                # A router (re)start keeps what the workers already have
+                if len(old):
+                    loop = asyncio.get_running_loop()
+                    batches = await loop.run_in_executor(None, self._moved_keys, old, new)
+                    stored = await asyncio.gather(*(
+                        self._push_keys(self.backends[node], items) for node, items in batches.items()
+                    ))
+                    moved = sum(stored)
+            finally:
+                self.ring = new
+                self.next_ring = None
+            self.rebalances += 1
+            self.keys_reprovisioned += moved
+            # Ends the current SubscribeResults streams so subscribers pick up the new workers
+            self.membership_changed.set()
+            self.membership_changed = asyncio.Event()
+            logger.info("Cluster membership changed", extra={
+                "workers": sorted(nodes), "keys_reprovisioned": moved, "rebalances": self.rebalances,
+            })
+
+    def stats(self) -> dict:
+        return {
+            "ring": sorted(self.ring.nodes),
+            "rebalances": self.rebalances,
+            "keys_reprovisioned": self.keys_reprovisioned,
+            "backends": {address: backend.stats() for address, backend in self.backends.items()},
+        }
+
+    async def close(self):
+        self.running = False
+        if self.rebalance_task is not None:
+            self.rebalance_task.cancel()
+        for backend in self.backends.values():
+            await backend.close()
+
+
+class RouterService(interface_pb2_grpc.EmotionServiceServicer):
+    def __init__(self, cluster: ClusterRouter, subscriber_buffer: int = 256):
+        self.cluster = cluster
+        self.subscriber_buffer = subscriber_buffer
+
+    async def _forward(self, uid: str, method: str, request, context):
+        backends = self.cluster.route(uid)
+        if not backends:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "No healthy worker for this uid")
+        error = None
+        for backend in backends:
+            try:
+                response = await getattr(backend.stub(), method)(request, timeout=self.cluster.call_timeout)
+                backend.forwarded += 1
+                return response
+            except grpc.aio.AioRpcError as e:
+                if e.code() not in RETRYABLE:
+                    await context.abort(e.code(), e.details())
+                # The next worker in the preference list holds a replica of the key
+                logger.warning("Forward failed: %s", e.details(), extra={"uid": uid, "backend": backend.address})
+                self.cluster.failed(backend)
+                error = e
+        await context.abort(error.code(), error.details())
+
+    async def _save_keys(self, keys) -> list[tuple[str, bool, str]]:
+        """
+        Stores keys locally (for re-provisioning), then on every healthy worker of each
+        uid's preference list. Workers it could not reach are resynced by the health checks.
+        """
+        loop = asyncio.get_running_loop()
+        statuses = await loop.run_in_executor(None, self.cluster.storage.save_keys, keys)
+
+        per_backend: dict[str, list[tuple[str, str]]] = {}
+        targets: dict[str, int] = {}
+        for (uid, key), (_, ok, _) in zip(keys, statuses):
+            if not ok:
+                continue
+            targets[uid] = 0
+            for node in self.cluster.key_targets(uid):
+                if self.cluster.backends[node].healthy:
+                    targets[uid] += 1
+                    per_backend.setdefault(node, []).append((uid, key))
+                else:
+                    # Still in the ring, so it must not serve uid with its old key once healthy
+                    self.cluster.backends[node].stale_keys[uid] = key
+
+        async def send(node, items):
+            request = interface_pb2.KeyBatchRequest(
+                keys=[interface_pb2.KeyRequest(uid=uid, key=key) for uid, key in items]
+            )
+            backend = self.cluster.backends[node]
+            async with backend.key_lock:
+                try:
+                    response = await backend.stub().SendDecryptionKeys(request, timeout=self.cluster.call_timeout)
+                except grpc.aio.AioRpcError as e:
+                    logger.warning("Key forward failed: %s", e.details(), extra={"backend": node})
+                    if e.code() in RETRYABLE:
+                        self.cluster.failed(backend)
+                    response = None
+            stored = {status.uid for status in response.statuses if status.success} if response else set()
+            for uid, key in items:
+                if uid in stored:
+                    backend.stale_keys.pop(uid, None)
+                else:
+                    backend.stale_keys[uid] = key
+            if response is not None:
+                backend.forwarded += 1
+            return list(stored)
+
+        stored: dict[str, int] = {}
+        for uids in await asyncio.gather(*(send(node, items) for node, items in per_backend.items())):
+            for uid in uids:
+                stored[uid] = stored.get(uid, 0) + 1
+
+        result = []
+        for uid, ok, message in statuses:
+            if ok and not targets.get(uid):
+                ok, message = False, "No healthy worker for this uid"
+            elif ok and stored.get(uid, 0) < targets[uid]:
+                ok, message = False, f"Key saved on {stored.get(uid, 0)} of {targets[uid]} workers"
+            result.append((uid, ok, message))
+        return result
+
+    def _batch_response(self, statuses) -> interface_pb2.KeyBatchResponse:
+        return interface_pb2.KeyBatchResponse(
+            success=all(ok for _, ok, _ in statuses),
+            statuses=[interface_pb2.KeyStatus(uid=uid, success=ok, message=message) for uid, ok, message in statuses],
+        )
+
+    async def SendDecryptionKey(self, request, context):
+        logger.info("Received key", extra={"uid": request.uid})
+        [(_, success, message)] = await self._save_keys([(request.uid, request.key)])
+        return interface_pb2.StatusResponse(success=success, message=message)
+
+    async def SendDecryptionKeys(self, request, context):
+        logger.info("Received batch of %d keys", len(request.keys))
+        return self._batch_response(await self._save_keys([(k.uid, k.key) for k in request.keys]))
+
+    async def StreamDecryptionKeys(self, request_iterator, context):
+        keys = [(k.uid, k.key) async for k in request_iterator]
+        logger.info("Received stream of %d keys", len(keys))
+        return self._batch_response(await self._save_keys(keys))
+
+    async def SendEncryptedImage(self, request, context):
+        # Forwarded as is; the reply is a few bytes
+        context.set_compression(grpc.Compression.NoCompression)
+        return await self._forward(request.uid, "SendEncryptedImage", request, context)
+
+    async def SendEncryptedEmbedding(self, request, context):
+        context.set_compression(grpc.Compression.NoCompression)
+        return await self._forward(request.uid, "SendEncryptedEmbedding", request, context)
+
+    async def Predict(self, request, context):
+        return await self._forward(request.uid, "Predict", request, context)
+
+    async def CheckHealth(self, request, context):
+        backends = self.cluster.healthy(self.cluster.ring.nodes)
+        return interface_pb2.HealthResponse(
+            serving=bool(backends),
+            queued=sum(backend.queued for backend in backends),
+            processed=sum(backend.processed for backend in backends),
+        )
+
+    async def SubscribeResults(self, request, context):
+        """Merges the result streams of the current workers until one fails or membership changes."""
+        merged: asyncio.Queue = asyncio.Queue(request.buffer_size or self.subscriber_buffer)
+        changed = self.cluster.membership_changed
+
+        async def pump(backend):
+            try:
+                # Slow subscribers block here, and the worker ends the stream once its buffer is full
+                async for result in backend.stub().SubscribeResults(request):
+                    await merged.put(result)
+                await merged.put(grpc.StatusCode.UNAVAILABLE)
+            except grpc.aio.AioRpcError as e:
+                await merged.put(e.code())
+
+        async def watch():
+            await changed.wait()
+            await merged.put(None)
+
+        tasks = [asyncio.create_task(pump(backend)) for backend in self.cluster.healthy(self.cluster.ring.nodes)]
+        if not tasks:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "No healthy workers")
+        tasks.append(asyncio.create_task(watch()))
+        try:
+            while True:
+                item = await merged.get()
+                if item is None:
+                    await context.abort(grpc.StatusCode.UNAVAILABLE, "Cluster membership changed; resubscribe")
+                if isinstance(item, grpc.StatusCode):
+                    await context.abort(item, "Worker result stream ended; resubscribe")
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def serve():
+    """
+    ROUTER_BACKENDS (comma-separated worker addresses), ROUTER_KEY_DB_PATH, ROUTER_KEY_REPLICAS,
+    ROUTER_VNODES, ROUTER_CHANNELS_PER_BACKEND, ROUTER_HEALTH_INTERVAL / _TIMEOUT / _RISE / _FALL,
+    ROUTER_CALL_TIMEOUT; the router itself listens according to the GRPC_* variables (transport.py).
+    """
+    setup_logging_from_env()
+
+    addresses = [a.strip() for a in os.environ.get("ROUTER_BACKENDS", "").split(",") if a.strip()]
+    transport = TransportConfig.from_env()
+    cluster = ClusterRouter(
+        addresses,
+        KeyStorage(os.environ.get("ROUTER_KEY_DB_PATH", "router_keys.db")),
+        replicas=int(os.environ.get("ROUTER_KEY_REPLICAS", 2)),
+        vnodes=int(os.environ.get("ROUTER_VNODES", 128)),
+        channels_per_backend=int(os.environ.get("ROUTER_CHANNELS_PER_BACKEND", 2)),
+        health_interval=float(os.environ.get("ROUTER_HEALTH_INTERVAL", 2.0)),
+        health_timeout=float(os.environ.get("ROUTER_HEALTH_TIMEOUT", 1.0)),
+        rise=int(os.environ.get("ROUTER_HEALTH_RISE", 2)),
+        fall=int(os.environ.get("ROUTER_HEALTH_FALL", 2)),
+        call_timeout=float(os.environ.get("ROUTER_CALL_TIMEOUT", 10.0)),
+        # The workers use the same GRPC_* limits as the router
+        options=channel_options(transport),
+    )
+    await cluster.start()
+    health_task = asyncio.create_task(cluster.run_health_checks())
+
+    server = create_server(transport)
+    interface_pb2_grpc.add_EmotionServiceServicer_to_server(
+        RouterService(cluster, subscriber_buffer=int(os.environ.get("SUBSCRIBER_BUFFER", 256))), server
+    )
+    add_ports(server, transport)
+    logger.info("Router %s; workers %s", transport.describe(), ", ".join(addresses))
+
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        health_task.cancel()
+        await cluster.close()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,88 @@
+"""
+Starts a router (router.py) in front of several workers (service.py) on this
+machine. Each worker gets its own port and its own keys.db, queue and
+aggregates under --data-dir/worker-N.
+
+    python run_cluster.py --workers 3 --port 50051 --model models/model_v1.pth
+
+Point the backend's GRPC_SERVER_URL at the router port. Stopping a worker (its
+pid is printed) makes the router move that worker's uids, and their keys, to
+the others within a few health checks. Other settings (LOG_*, QUEUE_*,
+ROUTER_*, ...) are passed through from the environment.
+
+Because a uid can be served by more than one worker over a day, each worker
+gets WORKER_ID=worker-N and sends its own totals, which the database merges
+into the user's single user_emotion_daily row for the day; apply
+schemas/user_emotion_daily.sql to Supabase first.
+Relative default paths are resolved against this directory.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start(script: str, env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)], cwd=HERE, env={**os.environ, **env})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local EmotionService cluster behind the consistent-hash router")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--port", type=int, default=50051, help="Router port")
+    parser.add_argument("--worker-port", type=int, default=50061, help="Port of the first worker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--model", default=os.path.join(HERE, "models/model_v1.pth"),
+                        help="CNN checkpoint for every worker")
+    parser.add_argument("--data-dir", default=os.path.join(HERE, "cluster"))
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    workers, addresses = [], []
+    for i in range(args.workers):
+        address = f"{args.host}:{args.worker_port + i}"
+        node_dir = os.path.join(data_dir, f"worker-{i}")
+        os.makedirs(node_dir, exist_ok=True)
+        workers.append(start("service.py", {
+            "GRPC_ADDRESS": address,
+            "WORKER_ID": f"worker-{i}",
+            "MODEL_PATH": os.path.abspath(args.model),
+            "KEY_DB_PATH": os.path.join(node_dir, "keys.db"),
+            "QUEUE_DB_PATH": os.path.join(node_dir, "queue.db"),
+            "EMBEDDING_QUEUE_DB_PATH": os.path.join(node_dir, "queue_embeddings.db"),
+            "AGGREGATES_DB_PATH": os.path.join(node_dir, "aggregates.db"),
+        }))
+        addresses.append(address)
+        print(f"worker-{i} pid {workers[-1].pid} on {address}")
+
+    router = start("router.py", {
+        "GRPC_ADDRESS": f"{args.host}:{args.port}",
+        "ROUTER_BACKENDS": ",".join(addresses),
+        "ROUTER_KEY_DB_PATH": os.path.join(data_dir, "router_keys.db"),
+    })
+    print(f"router pid {router.pid} on {args.host}:{args.port}")
+
+    processes = [router, *workers]
+    try:
+        while router.poll() is None:
+            time.sleep(1)
+        print("Router exited")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
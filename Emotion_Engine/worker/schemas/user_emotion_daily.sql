@@ -0,0 +1,78 @@
+-- Daily emotion aggregates written by the worker (aggregation.py), one row per user and day.
+-- Run in the Supabase SQL editor; safe to re-run on a table created by an earlier worker.
+
+CREATE TABLE IF NOT EXISTS user_emotion_daily (
+    "userId" TEXT NOT NULL,
+    "Day" DATE NOT NULL,
+    "Frames" INTEGER NOT NULL DEFAULT 0,
+    "DominantEmotion" TEXT,
+    "Counts" JSONB NOT NULL DEFAULT '{}',
+    "ConfidenceSums" JSONB NOT NULL DEFAULT '{}',
+    UNIQUE ("userId", "Day")
+);
+
+-- Each worker's absolute totals for the day, keyed by its WORKER_ID. Several workers can count
+-- the same user on one day behind router.py; Frames, Counts, ConfidenceSums and DominantEmotion
+-- are the sum over this map, so readers keep reading one row.
+ALTER TABLE user_emotion_daily ADD COLUMN IF NOT EXISTS "Workers" JSONB NOT NULL DEFAULT '{}';
+
+-- Rows written before the column existed came from a single worker with an empty WORKER_ID
+UPDATE user_emotion_daily
+SET "Workers" = jsonb_build_object('', jsonb_build_object('Counts', "Counts", 'ConfidenceSums', "ConfidenceSums"))
+WHERE "Workers" = '{}' AND "Frames" > 0;
+
+-- Merges [{userId, Day, Worker, Counts, ConfidenceSums}, ...] into the day rows and recomputes
+-- their totals. A worker's entry is replaced, not added to, so re-sending a row is harmless.
+CREATE OR REPLACE FUNCTION merge_user_emotion_daily(day_rows JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    r JSONB;
+    day_row user_emotion_daily%ROWTYPE;
+    workers JSONB;
+    counts JSONB;
+    sums JSONB;
+BEGIN
+    FOR r IN SELECT * FROM jsonb_array_elements(day_rows) LOOP
+        day_row := jsonb_populate_record(NULL::user_emotion_daily, r);
+
+        INSERT INTO user_emotion_daily ("userId", "Day")
+        VALUES (day_row."userId", day_row."Day")
+        ON CONFLICT ("userId", "Day") DO NOTHING;
+
+        SELECT d."Workers" INTO workers
+        FROM user_emotion_daily d
+        WHERE d."userId" = day_row."userId" AND d."Day" = day_row."Day"
+        FOR UPDATE;
+
+        workers := workers || jsonb_build_object(
+            r->>'Worker', jsonb_build_object('Counts', r->'Counts', 'ConfidenceSums', r->'ConfidenceSums')
+        );
+
+        SELECT jsonb_object_agg(e.key, e.total) INTO counts
+        FROM (
+            SELECT c.key, sum(c.value::INTEGER) AS total
+            FROM jsonb_each(workers) w, jsonb_each_text(w.value->'Counts') c
+            GROUP BY c.key
+        ) e;
+
+        SELECT jsonb_object_agg(e.key, round(e.total, 4)) INTO sums
+        FROM (
+            SELECT s.key, sum(s.value::NUMERIC) AS total
+            FROM jsonb_each(workers) w, jsonb_each_text(w.value->'ConfidenceSums') s
+            GROUP BY s.key
+        ) e;
+
+        UPDATE user_emotion_daily d
+        SET "Workers" = workers,
+            "Counts" = counts,
+            "ConfidenceSums" = sums,
+            "Frames" = (SELECT coalesce(sum(value::INTEGER), 0) FROM jsonb_each_text(counts)),
+            "DominantEmotion" = (SELECT key FROM jsonb_each_text(counts) ORDER BY value::INTEGER DESC, key LIMIT 1)
+        WHERE d."userId" = day_row."userId" AND d."Day" = day_row."Day";
+    END LOOP;
+
+    RETURN jsonb_array_length(day_rows);
+END;
+$$;
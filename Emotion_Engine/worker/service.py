@@ -1,6 +1,8 @@
 import grpc
 from concurrent import futures
 import asyncio
+import functools
+import logging
 import sys
 import os
 
@@ -12,33 +14,115 @@ import interface_pb2_grpc
 
 from storage import KeyStorage
 from request_queue import RequestQueue
-from model_loader import EmotionRecognitionModel
+from model_loader import EmbeddingModel, EmotionRecognitionModel
+from queue_backends import DurableQueue, FairQueue, MemoryQueue, RateLimited
+from aggregation import DailyEmotionAggregator
+from transport import TransportConfig, create_server, add_ports
+from log_config import setup_logging_from_env, stop_logging
+from result_broker import ResultBroker
+from decryption import decrypt_embedding
+
+logger = logging.getLogger(__name__)
+
+def encode_result(result: dict) -> interface_pb2.PredictionResult:
+    return interface_pb2.PredictionResult(**result)
 
 class EmotionService(interface_pb2_grpc.EmotionServiceServicer):
-    def __init__(self, queue: RequestQueue, storage: KeyStorage):
+    def __init__(self, queue: RequestQueue, storage: KeyStorage, broker: ResultBroker | None = None,
+                 embedding_queue: RequestQueue | None = None):
         self.queue = queue
         self.storage = storage
+        self.broker = broker
+        self.embedding_queue = embedding_queue
 
     async def SendDecryptionKey(self, request, context):
         uid = request.uid
         key = request.key
-        print(f"Received key for {uid}")
-        success = self.storage.save_key(uid, key)
+        logger.info("Received key", extra={"uid": uid})
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(None, self.storage.save_key, uid, key)
         return interface_pb2.StatusResponse(
             success=success,
             message="Key saved successfully" if success else "Failed to save key"
         )
 
-    async def SendEncryptedImage(self, request, context):
-        uid = request.uid
-        encrypted_image = request.encrypted_image
-        print(f"Received encrypted image for {uid}")
+    async def _save_keys(self, keys):
+        # SQLite work runs off the event loop so image ingestion is not stalled
+        loop = asyncio.get_running_loop()
+        statuses = await loop.run_in_executor(None, self.storage.save_keys, keys)
+        return interface_pb2.KeyBatchResponse(
+            success=all(ok for _, ok, _ in statuses),
+            statuses=[
+                interface_pb2.KeyStatus(uid=uid, success=ok, message=message)
+                for uid, ok, message in statuses
+            ],
+        )
+
+    async def SendDecryptionKeys(self, request, context):
+        logger.info("Received batch of %d keys", len(request.keys))
+        return await self._save_keys([(k.uid, k.key) for k in request.keys])
+
+    async def StreamDecryptionKeys(self, request_iterator, context):
+        keys = [(k.uid, k.key) async for k in request_iterator]
+        logger.info("Received stream of %d keys", len(keys))
+        return await self._save_keys(keys)
+
+    async def _submit(self, queue: RequestQueue, uid: str, payload: bytes, kind: str, context):
+        # The reply is a few bytes; compressing it only costs CPU
+        context.set_compression(grpc.Compression.NoCompression)
         
-        await self.queue.enqueue(uid, encrypted_image)
+        try:
+            future, duplicate = await queue.enqueue(uid, payload)
+        except RateLimited as e:
+            logger.debug("Rate limited", extra={"uid": uid, "per_request": True})
+            return interface_pb2.StatusResponse(success=False, message=f"Rate limited: {e}")
         
+        if duplicate:
+            # Retried request: nothing is decrypted or classified again
+            return interface_pb2.StatusResponse(
+                success=True,
+                message=f"Duplicate {kind} already processed" if future.done() else f"Duplicate {kind} already queued"
+            )
+
         return interface_pb2.StatusResponse(
             success=True,
-            message="Image queued for processing"
+            message=f"{kind.capitalize()} queued for processing"
+        )
+
+    async def SendEncryptedImage(self, request, context):
+        logger.debug("Received encrypted image", extra={"uid": request.uid, "per_request": True})
+        return await self._submit(self.queue, request.uid, request.encrypted_image, "image", context)
+
+    async def SendEncryptedEmbedding(self, request, context):
+        if self.embedding_queue is None:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, "Embedding input is not enabled")
+        logger.debug("Received encrypted embedding", extra={"uid": request.uid, "per_request": True})
+        return await self._submit(self.embedding_queue, request.uid, request.encrypted_embedding, "embedding", context)
+
+    async def SubscribeResults(self, request, context):
+        if self.broker is None:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, "Result subscriptions are not enabled")
+        subscription = self.broker.subscribe(request.uids, request.buffer_size)
+        try:
+            while True:
+                result = await subscription.get()
+                if result is None:
+                    await context.abort(
+                        grpc.StatusCode.RESOURCE_EXHAUSTED,
+                        "Subscriber too slow: result buffer overflowed",
+                    )
+                yield result
+        finally:
+            self.broker.unsubscribe(subscription)
+
+    async def CheckHealth(self, request, context):
+        model = self.queue.model
+        # A cascade serves as long as its CNN is loaded
+        loaded = getattr(getattr(model, "cnn", model), "model", None) is not None
+        return interface_pb2.HealthResponse(
+            serving=self.queue.running and loaded,
+            queued=self.queue.queue.qsize(),
+            processed=self.queue.processed,
         )
 
     # Keeping original Predict for compatibility/testing
@@ -48,39 +132,114 @@ class EmotionService(interface_pb2_grpc.EmotionServiceServicer):
         # Given the requirements, the new flow is SendDecryptionKey -> SendEncryptedImage.
         return interface_pb2.EmotionResponse(uid=request.uid, class_name="Deprecated: Use SendEncryptedImage")
 
+def make_backend(db_path: str):
+    """
+    Durable by default so queued requests survive restarts; QUEUE_BACKEND=memory opts out,
+    QUEUE_BACKEND=fair schedules per uid (in memory) so one busy client cannot starve the rest.
+    """
+    queue_backend = os.environ.get("QUEUE_BACKEND", "durable")
+    if queue_backend == "memory":
+        return MemoryQueue()
+    if queue_backend == "fair":
+        return FairQueue(
+            rate=float(os.environ.get("QUEUE_RATE_PER_UID", 5)),
+            burst=int(os.environ.get("QUEUE_BURST_PER_UID", 10)),
+            keep_newest=int(os.environ.get("QUEUE_KEEP_NEWEST", 0)),
+        )
+    return DurableQueue(
+        db_path=db_path,
+        hot_bytes=int(os.environ.get("QUEUE_HOT_BYTES", 64 * 1024 * 1024)),
+    )
+
 async def serve():
+    setup_logging_from_env()
+
     # Initialize components
-    storage = KeyStorage()
-    model = EmotionRecognitionModel(path="models/model_v1.pth") # Adjust path as needed
+    storage = KeyStorage(os.environ.get("KEY_DB_PATH", "keys.db"))
+    model = EmotionRecognitionModel(path=os.environ.get("MODEL_PATH", "models/model_v1.pth"))
+    if os.environ.get("EMOTION_CASCADE"):
+        # CNN first, SigLIP only for low-confidence faces
+        from cascade import CascadeEmotionModel, SiglipEmotionModel
+        model = CascadeEmotionModel(
+            model,
+            SiglipEmotionModel(),
+            min_confidence=float(os.environ.get("CASCADE_MIN_CONFIDENCE", 0.6)),
+            min_margin=float(os.environ.get("CASCADE_MIN_MARGIN", 0.2)),
+        )
     # We need to load the model. Since model.load is async, we do it here.
     
-    print("Loading model...")
+    logger.info("Loading model...")
     try:
         await model.load()
-        print("Model loaded.")
+        logger.info("Model loaded.")
     except Exception as e:
-        print(f"Failed to load model: {e}")
-        print("Continuing anyway - model will fail predictions until loaded")
+        logger.error("Failed to load model: %s", e)
+        logger.warning("Continuing anyway - model will fail predictions until loaded")
+
+    backend = make_backend(os.environ.get("QUEUE_DB_PATH", "queue.db"))
+    aggregator = DailyEmotionAggregator(
+        checkpoint_path=os.environ.get("AGGREGATES_DB_PATH", "aggregates.db"),
+        flush_interval=float(os.environ.get("AGGREGATE_FLUSH_SECONDS", 60)),
+        # Stable per node behind router.py, so the workers' daily totals are merged, not overwritten
+        worker_id=os.environ.get("WORKER_ID", ""),
+    )
+    # Raw per-frame rows are optional once daily aggregates are written
+    save_raw = os.environ.get("SAVE_RAW_EMOTIONS", "1") != "0"
+    broker = ResultBroker(
+        encode=encode_result,
+        default_buffer=int(os.environ.get("SUBSCRIBER_BUFFER", 256)),
+    )
+    queue = RequestQueue(model, storage, backend=backend, aggregator=aggregator, save_raw=save_raw, broker=broker)
 
-    queue = RequestQueue(model, storage)
+    # Landmark/embedding input path, enabled by EMBEDDING_MODEL_PATH (see training/train_landmarks.py)
+    embedding_queue, embedding_backend = None, None
+    embedding_model_path = os.environ.get("EMBEDDING_MODEL_PATH")
+    if embedding_model_path:
+        embedding_model = EmbeddingModel(embedding_model_path, version=os.environ.get("EMBEDDING_MODEL_VERSION", ""))
+        try:
+            await embedding_model.load()
+            logger.info("Embedding model loaded", extra={"input_dim": embedding_model.input_dim})
+            embedding_backend = make_backend(os.environ.get("EMBEDDING_QUEUE_DB_PATH", "queue_embeddings.db"))
+            embedding_queue = RequestQueue(
+                embedding_model, storage, backend=embedding_backend, aggregator=aggregator, save_raw=save_raw,
+                broker=broker, decrypt=functools.partial(decrypt_embedding, dim=embedding_model.input_dim),
+            )
+        except Exception as e:
+            logger.error("Failed to load embedding model, SendEncryptedEmbedding disabled: %s", e)
     
-    # Start queue worker
+    # Start queue workers
     worker_task = asyncio.create_task(queue.start_worker())
+    embedding_task = asyncio.create_task(embedding_queue.start_worker()) if embedding_queue else None
+    aggregator_task = asyncio.create_task(aggregator.run())
 
-    server = grpc.aio.server()
+    transport = TransportConfig.from_env()
+    server = create_server(transport)
     interface_pb2_grpc.add_EmotionServiceServicer_to_server(
-        EmotionService(queue, storage), server
+        EmotionService(queue, storage, broker, embedding_queue), server
     )
-    server.add_insecure_port("[::]:50051")
-    print("gRPC server running on port 50051")
+    add_ports(server, transport)
+    logger.info("gRPC server %s", transport.describe())
     
     await server.start()
     
     try:
         await server.wait_for_termination()
     finally:
-        queue.running = False
+        queue.stop()
+        aggregator.running = False
+        aggregator_task.cancel()
         await worker_task
+        queue.cancel_retries()
+        if embedding_queue is not None:
+            embedding_queue.stop()
+            await embedding_task
+            embedding_queue.cancel_retries()
+        # The last checkpoint acks its requests, so it goes before the queues close
+        await aggregator.close()
+        backend.close()
+        if embedding_backend is not None:
+            embedding_backend.close()
+        stop_logging()
 
 if __name__ == "__main__":
     asyncio.run(serve())
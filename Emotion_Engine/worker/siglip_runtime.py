@@ -0,0 +1,206 @@
+"""
+Loads and runs the SigLIP emotion classifier with a selectable CPU inference mode.
+
+Shared by the worker's cascade (cascade.SiglipEmotionModel, SIGLIP_* env vars)
+and open-model/SIGLIP.py (EmotionDetectionConfig.siglip_* fields). The default
+options reproduce the original FP32 eager model; training/evaluate_variants.py
+has a siglip-* variant per mode with parity against FP32 and latency.
+
+    precision   fp32 | bf16 | int8   bf16 weights and activations (only faster on CPUs
+                                     with AVX512-BF16/AMX), or int8 dynamic quantisation
+                                     of every Linear layer (weights int8, activations
+                                     quantised per batch)
+    attention   sdpa | eager         torch scaled_dot_product_attention or the reference
+                                     matmul/softmax implementation
+    backend     torch | compile | onnx
+                                     eager PyTorch, torch.compile, or the vision tower and
+                                     classifier exported once to ONNX and run in ONNX Runtime
+                                     (onnxruntime is only imported for this backend)
+    image_size  e.g. 160             resize crops to this instead of the native 224 and
+                                     interpolate the position embeddings; attention and MLP
+                                     cost scale with the patch count, (224/160)^2 ~ 2x fewer
+"""
+import logging
+import os
+import re
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "bf16", "int8")
+ATTENTIONS = ("sdpa", "eager")
+BACKENDS = ("torch", "compile", "onnx")
+
+
+class SiglipOptions:
+    def __init__(self, precision: str = "fp32", attention: str = "sdpa", backend: str = "torch",
+                 image_size: int | None = None, threads: int | None = None, onnx_dir: str = "onnx_cache"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+        if attention not in ATTENTIONS:
+            raise ValueError(f"attention must be one of {ATTENTIONS}, got {attention!r}")
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+        if backend == "onnx" and precision == "bf16":
+            raise ValueError("bf16 is not supported with the onnx backend; use fp32 or int8")
+        self.precision = precision
+        self.attention = attention
+        self.backend = backend
+        self.image_size = image_size or None
+        self.threads = threads or None
+        self.onnx_dir = onnx_dir
+
+    @classmethod
+    def from_env(cls) -> "SiglipOptions":
+        """SIGLIP_PRECISION, SIGLIP_ATTENTION, SIGLIP_BACKEND, SIGLIP_IMAGE_SIZE, SIGLIP_THREADS, SIGLIP_ONNX_DIR."""
+        return cls(
+            precision=os.environ.get("SIGLIP_PRECISION", "fp32"),
+            attention=os.environ.get("SIGLIP_ATTENTION", "sdpa"),
+            backend=os.environ.get("SIGLIP_BACKEND", "torch"),
+            image_size=int(os.environ.get("SIGLIP_IMAGE_SIZE", 0)),
+            threads=int(os.environ.get("SIGLIP_THREADS", 0)),
+            onnx_dir=os.environ.get("SIGLIP_ONNX_DIR", "onnx_cache"),
+        )
+
+    def describe(self) -> str:
+        size = self.image_size or "native"
+        return f"{self.precision}/{self.attention}/{self.backend}/size={size}"
+
+
+class _Logits(nn.Module):
+    """pixel_values -> logits, the graph that is compiled or exported."""
+
+    def __init__(self, model, interpolate: bool):
+        super().__init__()
+        self.model = model
+        self.interpolate = interpolate
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values, interpolate_pos_encoding=self.interpolate).logits
+
+
+class SiglipRunner:
+    """
+    Preprocessing and forward pass of SiglipForImageClassification for one set
+    of SiglipOptions. logits() takes the processor's pixel_values and always
+    returns float32 logits on the CPU.
+    """
+
+    def __init__(self, model_name: str, options: SiglipOptions | None = None, device=None):
+        self.model_name = model_name
+        self.options = options or SiglipOptions()
+        self.device = torch.device(device or "cpu")
+        self.model = None
+        self.processor = None
+        self.labels = {}
+        self.image_size = None
+        self.forward = None
+        self.session = None
+        self.onnx_path = None
+
+    def load(self):
+        # transformers is only needed when SigLIP is used
+        from transformers import AutoImageProcessor, SiglipForImageClassification
+
+        options = self.options
+        if options.threads:
+            torch.set_num_threads(options.threads)
+        try:
+            model = SiglipForImageClassification.from_pretrained(self.model_name, attn_implementation=options.attention)
+        except (ValueError, ImportError) as e:
+            logger.warning("Attention %s unavailable, using eager: %s", options.attention, e)
+            model = SiglipForImageClassification.from_pretrained(self.model_name, attn_implementation="eager")
+        model.eval()
+        self.labels = {int(k): v for k, v in model.config.id2label.items()}
+        self.processor = AutoImageProcessor.from_pretrained(self.model_name, use_fast=True)
+        native = model.config.vision_config.image_size
+        interpolate = options.image_size is not None and options.image_size != native
+        self.image_size = options.image_size or native
+
+        if options.backend == "onnx":
+            self.session = self._onnx_session(model, interpolate)
+            self.forward = self._run_onnx
+        else:
+            if options.precision == "bf16":
+                model = model.to(torch.bfloat16)
+            elif options.precision == "int8":
+                model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+            model.to(self.device)
+            graph = _Logits(model, interpolate)
+            self.forward = torch.compile(graph) if options.backend == "compile" else graph
+        self.model = model
+        self._warm_up()
+
+    def _warm_up(self):
+        pixel_values = torch.zeros(1, 3, self.image_size, self.image_size)
+        try:
+            self.logits(pixel_values)
+        except Exception as e:
+            if self.options.backend != "compile":
+                raise
+            # Some combinations (e.g. dynamically quantised Linear layers) do not compile everywhere
+            logger.warning("torch.compile failed, running eagerly: %s", e)
+            self.forward = self.forward._orig_mod
+            self.logits(pixel_values)
+
+    def _onnx_path(self, int8: bool) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", self.model_name.strip("/"))
+        suffix = "-int8" if int8 else ""
+        return os.path.join(self.options.onnx_dir, f"{name}-{self.image_size}{suffix}.onnx")
+
+    def _onnx_session(self, model, interpolate: bool):
+        import onnxruntime as ort
+
+        path = self._onnx_path(int8=False)
+        if not os.path.exists(path):
+            os.makedirs(self.options.onnx_dir, exist_ok=True)
+            logger.info("Exporting SigLIP to %s", path)
+            dummy = torch.zeros(1, 3, self.image_size, self.image_size)
+            torch.onnx.export(
+                _Logits(model, interpolate), (dummy,), path + ".tmp",
+                input_names=["pixel_values"], output_names=["logits"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=17, dynamo=False,
+            )
+            os.replace(path + ".tmp", path)
+        if self.options.precision == "int8":
+            int8_path = self._onnx_path(int8=True)
+            if not os.path.exists(int8_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantize_dynamic(path, int8_path + ".tmp", weight_type=QuantType.QInt8)
+                os.replace(int8_path + ".tmp", int8_path)
+            path = int8_path
+
+        self.onnx_path = path
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = self.options.threads or torch.get_num_threads()
+        return ort.InferenceSession(path, session_options, providers=["CPUExecutionProvider"])
+
+    def _run_onnx(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        (logits,) = self.session.run(["logits"], {"pixel_values": pixel_values.numpy()})
+        return torch.from_numpy(logits)
+
+    def preprocess(self, images) -> torch.Tensor:
+        """PIL images (RGB) -> pixel_values at the configured input size."""
+        kwargs = {}
+        if self.options.image_size:
+            kwargs["size"] = {"height": self.image_size, "width": self.image_size}
+        return self.processor(images=images, return_tensors="pt", **kwargs)["pixel_values"]
+
+    def logits(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        if self.forward is None:
+            raise RuntimeError("Model not loaded")
+        if self.session is not None:
+            return self.forward(pixel_values.float())
+        if self.options.precision == "bf16":
+            pixel_values = pixel_values.to(torch.bfloat16)
+        with torch.inference_mode():
+            return self.forward(pixel_values.to(self.device)).float().cpu()
+
+    def predict_proba(self, images) -> torch.Tensor:
+        """Softmax over the model's own labels (self.labels), shape (len(images), num_labels)."""
+        return F.softmax(self.logits(self.preprocess(images)), dim=1)
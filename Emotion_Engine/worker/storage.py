@@ -1,14 +1,29 @@
+import logging
 import sqlite3
 import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 class KeyStorage:
-    def __init__(self, db_path="keys.db"):
+    def __init__(self, db_path="keys.db", cache_size=100000):
         self.db_path = db_path
+        # In-process uid -> key lookup so image ingestion rarely touches SQLite
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # save_key/save_keys run in an executor thread while get_key runs on the
+        # event loop; the lock guards the cache and generation counts committed
+        # writes, so a lookup that raced a key rotation never caches the old key
+        self.lock = threading.Lock()
+        self.generation = 0
         self._init_db()
 
     def _init_db(self):
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
+            # WAL lets key lookups proceed while a provisioning batch is written
+            cursor.execute("PRAGMA journal_mode = WAL")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS decryption_keys (
                     uid TEXT PRIMARY KEY,
@@ -18,6 +33,13 @@ class KeyStorage:
             """)
             conn.commit()
 
+    def _cache_key(self, uid: str, key: str):
+        # Callers hold self.lock
+        self.cache[uid] = key
+        self.cache.move_to_end(uid)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
     def save_key(self, uid: str, key: str):
         try:
             with sqlite3.connect(self.db_path) as conn:
@@ -27,18 +49,73 @@ class KeyStorage:
                     VALUES (?, ?)
                 """, (uid, key))
                 conn.commit()
+            with self.lock:
+                self.generation += 1
+                self._cache_key(uid, key)
             return True
         except Exception as e:
-            print(f"Error saving key: {e}")
+            logger.error("Error saving key: %s", e)
             return False
 
+    def save_keys(self, items):
+        """
+        Stores many (uid, key) pairs in a single transaction and primes the lookup cache.
+        Returns a list of (uid, success, message) in input order; entries with an empty
+        uid or key are rejected individually, everything else succeeds or fails together.
+        """
+        statuses = []
+        valid = []
+        for uid, key in items:
+            if not uid or not key:
+                statuses.append((uid, False, "Missing uid or key"))
+            else:
+                statuses.append((uid, True, "Key saved successfully"))
+                valid.append((uid, key))
+
+        if not valid:
+            return statuses
+
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT OR REPLACE INTO decryption_keys (uid, key)
+                    VALUES (?, ?)
+                """, valid)
+                conn.commit()
+        except Exception as e:
+            logger.error("Error saving key batch: %s", e)
+            return [(uid, False, "Failed to save key") if ok else (uid, ok, message)
+                    for uid, ok, message in statuses]
+
+        with self.lock:
+            self.generation += 1
+            for uid, key in valid:
+                self._cache_key(uid, key)
+        return statuses
+
     def get_key(self, uid: str):
+        with self.lock:
+            key = self.cache.get(uid)
+            generation = self.generation
+        if key is not None:
+            return key
         try:
             with sqlite3.connect(self.db_path) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT key FROM decryption_keys WHERE uid = ?", (uid,))
                 result = cursor.fetchone()
-                return result[0] if result else None
+            if result:
+                with self.lock:
+                    # A save committed since the SELECT may have cached a newer key
+                    if self.generation == generation:
+                        self._cache_key(uid, result[0])
+            return result[0] if result else None
         except Exception as e:
-            print(f"Error retrieving key: {e}")
+            logger.error("Error retrieving key: %s", e)
             return None
+
+    def all_keys(self):
+        """Every stored (uid, key) pair, e.g. to re-provision keys on other nodes."""
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute("SELECT uid, key FROM decryption_keys").fetchall()
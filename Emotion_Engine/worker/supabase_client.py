@@ -1,14 +1,17 @@
+import logging
 import os
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
 
 if not url or not key:
-    print("Warning: SUPABASE_URL or SUPABASE_KEY not set in environment.")
+    logger.warning("SUPABASE_URL or SUPABASE_KEY not set in environment.")
 
 supabase: Client = create_client(url, key) if url and key else None
 
@@ -17,7 +20,7 @@ async def save_user_emotion(user_id: str, emotion: str, timestamp: str) -> bool:
     Saves the user emotion and timestamp to Supabase.
     """
     if not supabase:
-        print("Supabase client not initialized. Cannot save data.")
+        logger.warning("Supabase client not initialized. Cannot save data.", extra={"per_request": True})
         return False
 
     try:
@@ -34,12 +37,36 @@ async def save_user_emotion(user_id: str, emotion: str, timestamp: str) -> bool:
         # Check for success? The generic client raises exception on error usually 
         # or returns data.
         if response.data:
-            print(f"Saved for userid {user_id}: {emotion}")
+            logger.debug("Saved emotion: %s", emotion, extra={"uid": user_id, "per_request": True})
+            return True
+        else:
+            logger.warning("Failed to save emotion. Response: %s", response, extra={"uid": user_id})
+            return False
+
+    except Exception as e:
+        logger.warning("Error saving to Supabase: %s", e, extra={"uid": user_id})
+        return False
+
+
+async def save_daily_emotions(rows: list[dict]) -> bool:
+    """
+    Merges per-worker daily emotion totals into user_emotion_daily through the
+    merge_user_emotion_daily function (schemas/user_emotion_daily.sql), which
+    keeps one row per userId and Day summed over its workers. Rows carry one
+    worker's absolute totals for the day, so re-sending them is safe.
+    """
+    if not supabase:
+        logger.warning("Supabase client not initialized. Cannot save data.")
+        return False
+
+    try:
+        response = supabase.rpc("merge_user_emotion_daily", {"day_rows": rows}).execute()
+        if response.data:
             return True
         else:
-            print(f"Failed to save for {user_id}. Response: {response}")
+            logger.warning("Failed to save daily emotions. Response: %s", response)
             return False
 
     except Exception as e:
-        print(f"Error saving to Supabase for {user_id}: {e}")
+        logger.warning("Error saving daily emotions to Supabase: %s", e)
         return False
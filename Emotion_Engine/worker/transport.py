@@ -0,0 +1,159 @@
+import os
+
+import grpc
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+MiB = 1024 * 1024
+
+
+class TransportConfig:
+    """
+    gRPC server settings for EmotionService.
+
+    Defaults are sized for our traffic: a few long-lived backend connections
+    sending encrypted frames of tens to hundreds of KiB. Request compression is
+    chosen by the client per call; the server accepts every algorithm in
+    accepted_compression and answers with response_compression. Encrypted images
+    do not compress, so image responses are never compressed regardless.
+    """
+
+    def __init__(
+        self,
+        address: str = "[::]:50051",
+        uds_path: str | None = None,
+        max_receive_bytes: int = 16 * MiB,
+        max_send_bytes: int = 4 * MiB,
+        response_compression: str = "none",
+        accepted_compression=("none", "deflate", "gzip"),
+        keepalive_time_ms: int = 30000,
+        keepalive_timeout_ms: int = 10000,
+        min_ping_interval_ms: int = 10000,
+        keepalive_without_calls: bool = True,
+        max_concurrent_streams: int | None = 256,
+        max_concurrent_rpcs: int | None = None,
+        max_connection_idle_ms: int | None = None,
+    ):
+        self.address = address
+        self.uds_path = uds_path
+        self.max_receive_bytes = max_receive_bytes
+        self.max_send_bytes = max_send_bytes
+        self.response_compression = response_compression
+        self.accepted_compression = tuple(accepted_compression)
+        self.keepalive_time_ms = keepalive_time_ms
+        self.keepalive_timeout_ms = keepalive_timeout_ms
+        self.min_ping_interval_ms = min_ping_interval_ms
+        self.keepalive_without_calls = keepalive_without_calls
+        self.max_concurrent_streams = max_concurrent_streams
+        self.max_concurrent_rpcs = max_concurrent_rpcs
+        self.max_connection_idle_ms = max_connection_idle_ms
+        for name in (response_compression, *self.accepted_compression):
+            if name not in COMPRESSION:
+                raise ValueError(f"Unknown compression {name!r}, expected one of {list(COMPRESSION)}")
+
+    @classmethod
+    def from_env(cls):
+        """Reads GRPC_* environment variables; unset ones keep their defaults."""
+        def optional_int(name, default):
+            value = os.environ.get(name)
+            if value is None:
+                return default
+            # 0 means "use the gRPC default" for limits
+            return int(value) or None
+
+        defaults = cls()
+        address = os.environ.get("GRPC_ADDRESS")
+        if address is None and os.environ.get("GRPC_PORT"):
+            address = f"[::]:{os.environ['GRPC_PORT']}"
+        return cls(
+            address=address if address is not None else defaults.address,
+            uds_path=os.environ.get("GRPC_UDS_PATH") or None,
+            max_receive_bytes=int(os.environ.get("GRPC_MAX_RECEIVE_BYTES", defaults.max_receive_bytes)),
+            max_send_bytes=int(os.environ.get("GRPC_MAX_SEND_BYTES", defaults.max_send_bytes)),
+            response_compression=os.environ.get("GRPC_RESPONSE_COMPRESSION", defaults.response_compression),
+            accepted_compression=os.environ.get(
+                "GRPC_ACCEPTED_COMPRESSION", ",".join(defaults.accepted_compression)
+            ).split(","),
+            keepalive_time_ms=int(os.environ.get("GRPC_KEEPALIVE_TIME_MS", defaults.keepalive_time_ms)),
+            keepalive_timeout_ms=int(os.environ.get("GRPC_KEEPALIVE_TIMEOUT_MS", defaults.keepalive_timeout_ms)),
+            min_ping_interval_ms=int(os.environ.get("GRPC_MIN_PING_INTERVAL_MS", defaults.min_ping_interval_ms)),
+            keepalive_without_calls=os.environ.get("GRPC_KEEPALIVE_WITHOUT_CALLS", "1") != "0",
+            max_concurrent_streams=optional_int("GRPC_MAX_CONCURRENT_STREAMS", defaults.max_concurrent_streams),
+            max_concurrent_rpcs=optional_int("GRPC_MAX_CONCURRENT_RPCS", defaults.max_concurrent_rpcs),
+            max_connection_idle_ms=optional_int("GRPC_MAX_CONNECTION_IDLE_MS", defaults.max_connection_idle_ms),
+        )
+
+    def options(self) -> list[tuple[str, int]]:
+        """Channel arguments for grpc.aio.server."""
+        enabled = 0
+        for name in self.accepted_compression:
+            enabled |= 1 << int(COMPRESSION[name])
+        options = [
+            ("grpc.max_receive_message_length", self.max_receive_bytes),
+            ("grpc.max_send_message_length", self.max_send_bytes),
+            ("grpc.compression_enabled_algorithms_bitset", enabled | 1),
+            ("grpc.keepalive_time_ms", self.keepalive_time_ms),
+            ("grpc.keepalive_timeout_ms", self.keepalive_timeout_ms),
+            ("grpc.keepalive_permit_without_calls", int(self.keepalive_without_calls)),
+            # Clients may ping this often without being sent GOAWAY(too_many_pings)
+            ("grpc.http2.min_ping_interval_without_data_ms", self.min_ping_interval_ms),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+        if self.max_concurrent_streams is not None:
+            options.append(("grpc.max_concurrent_streams", self.max_concurrent_streams))
+        if self.max_connection_idle_ms is not None:
+            options.append(("grpc.max_connection_idle_ms", self.max_connection_idle_ms))
+        return options
+
+    def describe(self) -> str:
+        listeners = [self.address] if self.address else []
+        if self.uds_path:
+            listeners.append(f"unix:{self.uds_path}")
+        return (
+            f"listening on {', '.join(listeners)}; "
+            f"max receive {self.max_receive_bytes} bytes; "
+            f"compression accepted {','.join(self.accepted_compression)}, responses {self.response_compression}; "
+            f"keepalive {self.keepalive_time_ms}ms; "
+            f"max streams {self.max_concurrent_streams or 'default'}, max rpcs {self.max_concurrent_rpcs or 'unlimited'}"
+        )
+
+
+def create_server(config: TransportConfig) -> grpc.aio.Server:
+    return grpc.aio.server(
+        options=config.options(),
+        compression=COMPRESSION[config.response_compression],
+        maximum_concurrent_rpcs=config.max_concurrent_rpcs,
+    )
+
+
+def add_ports(server: grpc.aio.Server, config: TransportConfig) -> list[str]:
+    """Binds the TCP address and/or Unix socket; returns the bound targets."""
+    targets = []
+    if config.address:
+        port = server.add_insecure_port(config.address)
+        targets.append(f"{config.address.rsplit(':', 1)[0]}:{port}")
+    if config.uds_path:
+        # A stale socket file from an unclean shutdown would make the bind fail
+        if os.path.exists(config.uds_path):
+            os.unlink(config.uds_path)
+        server.add_insecure_port(f"unix:{config.uds_path}")
+        targets.append(f"unix:{config.uds_path}")
+    if not targets:
+        raise ValueError("TransportConfig needs an address or a uds_path")
+    return targets
+
+
+def channel_options(config: TransportConfig) -> list[tuple[str, int]]:
+    """Matching client-side options (used by the benchmark and Python clients)."""
+    return [
+        ("grpc.max_send_message_length", config.max_receive_bytes),
+        ("grpc.max_receive_message_length", config.max_send_bytes),
+        ("grpc.keepalive_time_ms", max(config.keepalive_time_ms, config.min_ping_interval_ms)),
+        ("grpc.keepalive_timeout_ms", config.keepalive_timeout_ms),
+        ("grpc.keepalive_permit_without_calls", int(config.keepalive_without_calls)),
+        ("grpc.http2.max_pings_without_data", 0),
+    ]
@@ -1,6 +1,6 @@
 import { Response } from "express";
 import { AuthRequest } from "../middlewares/auth.middleware.js";
-import { sendEncrytedData } from "../services/submit.service.js";
+import { sendEncrytedData, sendEncryptedEmbedding } from "../services/submit.service.js";
 
 export const getSubmit = async (
   req: AuthRequest,
@@ -35,3 +35,34 @@ export const getSubmit = async (
     res.status(500).json({ error: "Failed to queue request" });
   }
 };
+
+export const submitEmbedding = async (
+  req: AuthRequest,
+  res: Response
+): Promise<void> => {
+  try {
+    const { encryptedEmbedding } = req.body;
+
+    if (!encryptedEmbedding) {
+      res.status(400).json({ error: "encryptedEmbedding is required" });
+      return;
+    }
+
+    if (!req.user || !req.user.uuid) {
+      res.status(401).json({ error: "Unauthorized" });
+      return;
+    }
+
+    await sendEncryptedEmbedding({
+      userId: req.user.uuid,
+      encryptedEmbedding
+    });
+
+    res.status(202).json({
+      message: "Request queued successfully"
+    });
+  } catch (error) {
+    console.error("Submit embedding error:", error);
+    res.status(500).json({ error: "Failed to queue request" });
+  }
+};
@@ -1,8 +1,9 @@
 import { Router } from "express";
-import { getSubmit } from "../controllers/submit.controller.js";
+import { getSubmit, submitEmbedding } from "../controllers/submit.controller.js";
 import { authMiddleware } from "../middlewares/auth.middleware.js";
 
 const router = Router();
 router.post("/", authMiddleware, getSubmit);
+router.post("/embedding", authMiddleware, submitEmbedding);
 
 export default router;
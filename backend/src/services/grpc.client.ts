@@ -18,7 +18,18 @@ const packageDefinition = protoLoader.loadSync(PROTO_PATH, {
 
 const emotionProto = grpc.loadPackageDefinition(packageDefinition).emotion as any;
 
+// Keep in step with the worker's TransportConfig (Emotion_Engine/worker/transport.py):
+// the keepalive interval must not be shorter than its GRPC_MIN_PING_INTERVAL_MS.
+// GRPC_SERVER_URL may be a unix:///path socket when the worker runs on the same host.
+const channelOptions = {
+  'grpc.keepalive_time_ms': Number(process.env.GRPC_KEEPALIVE_TIME_MS || 30000),
+  'grpc.keepalive_timeout_ms': Number(process.env.GRPC_KEEPALIVE_TIMEOUT_MS || 10000),
+  'grpc.keepalive_permit_without_calls': 1,
+  'grpc.max_send_message_length': Number(process.env.GRPC_MAX_SEND_BYTES || 16 * 1024 * 1024),
+};
+
 export const grpcClient = new emotionProto.EmotionService(
   process.env.GRPC_SERVER_URL || 'localhost:50051',
-  grpc.credentials.createInsecure()
+  grpc.credentials.createInsecure(),
+  channelOptions
 );
@@ -22,3 +22,22 @@ export async function sendEncrytedData(
     });
   });
 }
+
+// encryptedEmbedding is Base64 of IV + AES-CBC ciphertext of the float32 vector
+// (e.g. MediaPipe face landmarks), encrypted with the same key as images.
+export async function sendEncryptedEmbedding(
+   { userId, encryptedEmbedding }: { userId: string, encryptedEmbedding: string }
+) {
+  return new Promise((resolve, reject) => {
+    const embeddingBuffer = Buffer.from(encryptedEmbedding, 'base64');
+
+    grpcClient.SendEncryptedEmbedding({ uid: userId, encrypted_embedding: embeddingBuffer }, (err: any, response: any) => {
+      if (err) {
+        console.error("gRPC SendEncryptedEmbedding Error:", err);
+        reject(err);
+      } else {
+        resolve(response);
+      }
+    });
+  });
+}